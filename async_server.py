@@ -0,0 +1,178 @@
+"""
+asyncio engine for the file transfer server.
+
+Connections are accepted, TLS-wrapped and read on a single event loop, so an
+idle client costs no thread. Each command is executed by the same handlers the
+threaded engine uses, on a bounded executor; their socket I/O is bridged back
+onto the event loop through AsyncSocket.
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import MeteredSocket
+from pipeline import RequestPipeline
+from scheduler import BULK_COMMANDS
+from protocol import (
+    FRAME_HEADER_SIZE, HANDSHAKE_MAGIC, FramedChannel, LegacyChannel, ProtocolError, frame_length, negotiate_version,
+    set_nodelay
+)
+
+
+class AsyncSocket:
+    """Socket-like facade over asyncio streams for handlers running on executor threads"""
+
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+
+    def recv(self, size):
+        return self._call(self.reader.read(size))
+
+    def recv_into(self, buffer, size):
+        data = self.recv(size)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self._call(self.write(data))
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class AsyncServerEngine:
+    """Serve a FileTransferServer's commands from an asyncio event loop"""
+
+    def __init__(self, server, max_workers=32):
+        self.server = server
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='command')
+        # Other commands get their own threads so transfers waiting for a stream slot cannot delay them
+        self.metadata_executor = ThreadPoolExecutor(max_workers=max(4, max_workers // 4), thread_name_prefix='metadata')
+
+    def run(self):
+        """Start the event loop and serve until interrupted"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("\nShutting down server...")
+        finally:
+            self.server.running = False
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.metadata_executor.shutdown(wait=False, cancel_futures=True)
+            self.server.command_pool.shutdown(wait=False, cancel_futures=True)
+            self.server.storage.stop()
+            self.server.user_db.flush_logins()
+            self.server.logger.info("Server stopped.")
+
+    async def serve(self):
+        server = self.server
+        listener = await asyncio.start_server(
+            self.handle_connection, server.host, server.port,
+            ssl=server.ssl_context, backlog=server.backlog, reuse_address=True, reuse_port=server.reuse_port or None
+        )
+        server.running = True
+        print(f"Server started with SSL on {server.host}:{server.port} (async engine)")
+        server.logger.info(f"Server started on {server.host}:{server.port} with async engine")
+        server.start_background_tasks()
+        async with listener:
+            await listener.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """Coroutine counterpart of FileTransferServer.handle_client"""
+        server = self.server
+        addr = writer.get_extra_info('peername')
+        set_nodelay(writer.get_extra_info('socket'))
+        sock = MeteredSocket(AsyncSocket(reader, writer, asyncio.get_running_loop()), server.metrics, server.tracer)
+        username = None
+        pipeline = None
+        failed = False
+        server.logger.info(f"Accepted connection from {addr}")
+        server.metrics.connection_opened()
+        try:
+            server.sessions.set_activity(addr, "Connected, authenticating...")
+            server.logger.info(f"Client {addr} connected")
+
+            channel = await self._handshake(sock)
+            if not channel:
+                return
+            auth_data = await self._read_message(channel)
+            if not auth_data:
+                return
+            username = await self._run(server.login, channel, addr, auth_data)
+            if not username:
+                return
+
+            pipeline = RequestPipeline(channel, server.command_pool, server.logger)
+            while server.running:
+                request = await self._read_message(channel)
+                if not request:
+                    break
+                executor = self.executor if request.get('command') in BULK_COMMANDS else self.metadata_executor
+                await self._run(server.handle_request, channel, username, addr, request, pipeline, executor=executor)
+        except (OSError, json.JSONDecodeError, ProtocolError) as e:
+            server.logger.error(f"Error handling client {addr}: {e}")
+            failed = True
+        finally:
+            if pipeline:
+                await self._run(pipeline.drain)
+            server.end_session(username, addr)
+            writer.close()
+            server.metrics.connection_closed(failed)
+
+    async def _handshake(self, sock):
+        first = await sock.reader.read(1)
+        if not first:
+            return None
+        if first == b'{':
+            return LegacyChannel(sock, first)
+        rest = await self._read_exact(sock.reader, len(HANDSHAKE_MAGIC))
+        if rest is None:
+            return None
+        channel = FramedChannel(sock)
+        channel.version = negotiate_version(first + rest)
+        await sock.write(HANDSHAKE_MAGIC + bytes([channel.version]))
+        return channel
+
+    async def _read_message(self, channel):
+        """Wait for the next request on the event loop"""
+        reader = channel.sock.reader
+        metrics = self.server.metrics
+        if channel.legacy:
+            while True:
+                message = channel.next_buffered()
+                if message is not None:
+                    return message
+                chunk = await reader.read(4096)
+                if not chunk:
+                    return None
+                metrics.transferred(received=len(chunk))
+                channel.feed(chunk)
+        header = await self._read_exact(reader, FRAME_HEADER_SIZE)
+        if header is None:
+            return None
+        payload = await self._read_exact(reader, frame_length(header))
+        if payload is None:
+            return None
+        metrics.transferred(received=FRAME_HEADER_SIZE + len(payload))
+        return json.loads(payload)
+
+    async def _read_exact(self, reader, size):
+        try:
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return None
+
+    def _run(self, func, *args, executor=None):
+        return asyncio.get_running_loop().run_in_executor(executor or self.executor, func, *args)
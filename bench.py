@@ -0,0 +1,383 @@
+"""
+Load generator for the file transfer server.
+
+Starts server.py with the in-memory storage backend in a scratch directory,
+so no GCS credentials are needed, and runs N concurrent synthetic clients for
+a fixed time. Each client logs in as its own user and picks operations from a
+weighted mix of list, upload, dedup (upload_file_dedup), download, view and
+delete, with upload sizes drawn from a weighted size distribution. The result is printed as JSON
+(ops/s, MB/s, latency percentiles per operation, peak RSS) so runs on
+different commits can be compared.
+
+    python bench.py --clients 16 --duration 30 --mix list=1,upload=2,download=4,view=2,delete=1 \\
+        --sizes 4KiB=60,1MiB=30,16MiB=10 --output result.json
+
+Client chatter goes to stderr while the benchmark runs.
+"""
+import argparse
+import json
+import random
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from threading import Barrier, Thread
+
+from client import FileTransferClient, client_ssl_context
+from database import UserDatabase
+from dedup import CHUNKER, chunk_file
+from protocol import ProtocolError
+
+OPERATIONS = ('list', 'upload', 'dedup', 'download', 'view', 'delete')
+DEFAULT_MIX = 'list=1,upload=2,download=4,view=2,delete=1'
+DEFAULT_SIZES = '4KiB=60,256KiB=30,4MiB=10'
+SEED_FILES = 4  # Files each client uploads before the clock starts, so reads have targets
+SERVER_START_TIMEOUT = 15  # Seconds to wait for the server to accept connections
+PASSWORD = 'bench-password'
+UNITS = {'': 1, 'B': 1, 'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3}
+
+
+def parse_weights(text, parse_key=str):
+    """Parse 'key=weight,key=weight' into a list of (key, weight)"""
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.strip().partition('=')
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    if not weights or any(weight < 0 for _, weight in weights) or not sum(weight for _, weight in weights):
+        raise ValueError(f"Invalid weights: {text}")
+    return weights
+
+
+def parse_operation(name):
+    if name not in OPERATIONS:
+        raise ValueError(f"Unknown operation: {name} (choose from {', '.join(OPERATIONS)})")
+    return name
+
+
+def parse_size(text):
+    """Parse a size such as 4096, 4KiB or 16MB into bytes"""
+    digits = text.rstrip('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    unit = text[len(digits):].upper()
+    if unit not in UNITS or not digits:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(digits) * UNITS[unit])
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def latency_summary(latencies):
+    """Latency statistics in milliseconds"""
+    ordered = sorted(latencies)
+    summary = {'mean': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else None}
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)):
+        value = percentile(ordered, fraction)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+class BenchServer:
+    """server.py running as a child process in a scratch directory"""
+
+    def __init__(self, workdir, port, engine, certfile, keyfile, extra_args=()):
+        self.workdir = Path(workdir)
+        self.port = port
+        self.engine = engine
+        self.extra_args = list(extra_args)
+        self.certfile = self.workdir / 'server.crt'
+        self.keyfile = self.workdir / 'server.key'
+        self._prepare_certificate(certfile, keyfile)
+        self.process = None
+
+    def _prepare_certificate(self, certfile, keyfile):
+        if Path(certfile).exists() and Path(keyfile).exists():
+            shutil.copyfile(certfile, self.certfile)
+            shutil.copyfile(keyfile, self.keyfile)
+            return
+        # Same throwaway certificate as `make generate_certs`
+        subprocess.run([
+            'openssl', 'req', '-new', '-newkey', 'rsa:2048', '-days', '1', '-nodes', '-x509',
+            '-keyout', str(self.keyfile), '-out', str(self.certfile), '-subj', '/CN=localhost'
+        ], check=True, capture_output=True)
+
+    def create_users(self, count):
+        """Add bench0..bench{count-1} to the server's user database; returns their names"""
+        database = UserDatabase(str(self.workdir / 'users.db'))
+        usernames = [f"bench{i}" for i in range(count)]
+        for username in usernames:
+            database.create_user(username, PASSWORD)
+        database.close()
+        return usernames
+
+    def start(self):
+        server_script = Path(__file__).resolve().parent / 'server.py'
+        command = [
+            sys.executable, str(server_script), '--backend', 'memory', '--port', str(self.port),
+            '--engine', self.engine, '--storage-root', str(self.workdir / 'storage'),
+            '--sessions-db', str(self.workdir / 'sessions.db'), '--slow-threshold', '0'
+        ] + self.extra_args
+        self.output = open(self.workdir / 'server.out', 'wb')
+        self.process = subprocess.Popen(command, cwd=self.workdir, stdout=self.output, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with status {self.process.returncode}; see {self.output.name}")
+            try:
+                # A complete TLS handshake; the threaded engine's accept loop fails on a bare TCP probe
+                with socket.create_connection(('localhost', self.port), timeout=1) as sock:
+                    client_ssl_context(str(self.certfile)).wrap_socket(sock, server_hostname='localhost').close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Server did not start within {SERVER_START_TIMEOUT}s")
+
+    def stop(self):
+        """Interrupt the server and return its peak RSS in bytes (None if unknown)"""
+        if not self.process:
+            return None
+        self.process.send_signal(signal.SIGINT)  # The same shutdown path as Ctrl+C
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.output.close()
+        return peak_rss(resource.RUSAGE_CHILDREN)
+
+
+def peak_rss(who):
+    """Peak resident set size in bytes; ru_maxrss is in KiB on Linux and bytes on macOS"""
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class BenchClient:
+    """One synthetic user issuing operations from the mix until the deadline"""
+
+    def __init__(self, port, certfile, username, workdir, mix, sizes, payloads, seed):
+        self.client = FileTransferClient('localhost', port, str(certfile))
+        self.username = username
+        self.workdir = Path(workdir)
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.operations, self.weights = zip(*mix)
+        self.sizes, self.size_weights = zip(*sizes)
+        self.payloads = payloads  # size -> path of a local file with that many bytes
+        self.random = random.Random(seed)
+        self.files = {}  # Remote name -> size of this client's files on the server
+        self.counter = 0
+        self.results = []  # (operation, seconds, ok, bytes)
+
+    def connect(self):
+        if not self.client.connect(self.username, PASSWORD):
+            raise RuntimeError(f"Login of {self.username} failed")
+        for _ in range(SEED_FILES):
+            self._upload()
+
+    def run(self, start, duration):
+        start.wait()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            operation = self.random.choices(self.operations, self.weights)[0]
+            if operation in ('download', 'view', 'delete') and not self.files:
+                operation = 'upload'
+            started = time.perf_counter()
+            try:
+                ok, size = getattr(self, f"_{operation}")()
+            except (OSError, ValueError, ProtocolError) as e:
+                print(f"{self.username}: {operation} failed: {e}")
+                self.results.append((operation, time.perf_counter() - started, False, 0))
+                return  # The connection is no longer usable
+            self.results.append((operation, time.perf_counter() - started, ok, size))
+
+    def close(self):
+        self.client.close()
+
+    def _list(self):
+        self.client.list_page()
+        return True, 0
+
+    def _upload(self):
+        size = self.random.choices(self.sizes, self.size_weights)[0]
+        self.counter += 1
+        name = f"f{self.counter}.bin"
+        ok = self.client.upload_file(str(self.payloads[size]), name)
+        if ok:
+            self.files[name] = size
+        return ok, size
+
+    def _dedup(self):
+        # Payloads repeat, so after the first upload of a size this mostly measures chunking
+        size = self.random.choices(self.sizes, self.size_weights)[0]
+        self.counter += 1
+        name = f"f{self.counter}.bin"
+        ok = self.client.upload_file_dedup(str(self.payloads[size]), name)
+        if ok:
+            self.files[name] = size
+        return ok, size
+
+    def _download(self):
+        name = self.random.choice(list(self.files))
+        ok = self.client.download_file(name, self.workdir)
+        # Without the local copy the next download of this file transfers the data again
+        (self.workdir / name).unlink(missing_ok=True)
+        return ok, self.files[name] if ok else 0
+
+    def _view(self):
+        name = self.random.choice(list(self.files))
+        return self.client.view_file(name) is not None, 0
+
+    def _delete(self):
+        name = self.random.choice(list(self.files))
+        ok = self.client.delete_file(name)
+        self.files.pop(name)
+        return ok, 0
+
+
+def summarize(results, elapsed):
+    """Aggregate (operation, seconds, ok, bytes) tuples into the report"""
+    report = {}
+    for operation in OPERATIONS + ('all',):
+        selected = [r for r in results if operation == 'all' or r[0] == operation]
+        if not selected:
+            continue
+        transferred = sum(r[3] for r in selected if r[2])
+        report[operation] = {
+            'ops': len(selected),
+            'errors': sum(not r[2] for r in selected),
+            'ops_per_sec': round(len(selected) / elapsed, 2),
+            'mb_per_sec': round(transferred / elapsed / 1e6, 3),
+            'bytes': transferred,
+            'latency_ms': latency_summary([r[1] for r in selected]),
+        }
+    return report
+
+
+def chunking_speed(path):
+    """Throughput of the dedup chunker, which runs on the client before a dedup upload"""
+    started = time.perf_counter()
+    chunk_file(path)
+    seconds = time.perf_counter() - started
+    return {'implementation': CHUNKER, 'bytes': path.stat().st_size,
+            'mb_per_sec': round(path.stat().st_size / seconds / 1e6, 3)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).resolve().parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def run(args):
+    mix = parse_weights(args.mix, parse_operation)
+    sizes = parse_weights(args.sizes, parse_size)
+    workdir = Path(tempfile.mkdtemp(prefix='dfs-bench-'))
+    server = BenchServer(workdir, args.port or free_port(), args.engine, args.certfile, args.keyfile,
+                         shlex.split(args.server_args))
+    server_rss = None
+    try:
+        usernames = server.create_users(args.clients)
+        payloads = {}
+        data_random = random.Random(args.seed)
+        for size, _ in sizes:
+            payloads[size] = workdir / 'payload' / f"{size}.bin"
+            payloads[size].parent.mkdir(exist_ok=True)
+            payloads[size].write_bytes(data_random.randbytes(size))
+        chunker = chunking_speed(payloads[max(payloads)]) if dict(mix).get('dedup') else None
+        server.start()
+
+        clients = [BenchClient(server.port, server.certfile, username, workdir / 'clients' / username,
+                               mix, sizes, payloads, args.seed + i) for i, username in enumerate(usernames)]
+        with redirect_stdout(sys.stderr):
+            for client in clients:
+                client.connect()
+            start = Barrier(len(clients) + 1)
+            threads = [Thread(target=client.run, args=(start, args.duration)) for client in clients]
+            for thread in threads:
+                thread.start()
+            start.wait()
+            started = time.monotonic()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+            for client in clients:
+                client.close()
+    finally:
+        server_rss = server.stop()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = [result for client in clients for result in client.results]
+    return {
+        'commit': git_commit(),
+        'config': {
+            'clients': args.clients,
+            'duration': args.duration,
+            'engine': args.engine,
+            'mix': dict(mix),
+            'sizes': {str(size): weight for size, weight in sizes},
+            'server_args': args.server_args,
+            'seed': args.seed,
+        },
+        'elapsed': round(elapsed, 3),
+        'operations': summarize(results, elapsed),
+        'chunker': chunker,
+        'server_peak_rss_bytes': server_rss,
+        'client_peak_rss_bytes': peak_rss(resource.RUSAGE_SELF),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the file transfer server with synthetic clients')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients, each logged in as its own user')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run the operation mix')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f"Operation weights, from {', '.join(OPERATIONS)} (default: {DEFAULT_MIX})")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f"Upload size weights; sizes take B, KiB, MiB, KB or MB (default: {DEFAULT_SIZES})")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded', help='Server engine')
+    parser.add_argument('--server-args', default='', help='Extra server.py arguments, e.g. "--workers 64"')
+    parser.add_argument('--port', type=int, default=0, help='Server port (default: a free port)')
+    parser.add_argument('--certfile', default='server.crt',
+                        help='Server certificate; a temporary one is generated if it does not exist')
+    parser.add_argument('--keyfile', default='server.key', help='Key of --certfile')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for operations, file choice and data')
+    parser.add_argument('--output', help='Also write the JSON result to this file')
+    parser.add_argument('--keep-workdir', action='store_true',
+                        help='Keep the scratch directory with server.out and server.log')
+    args = parser.parse_args()
+    if args.clients < 1 or args.duration <= 0:
+        parser.error('--clients and --duration must be positive')
+    try:
+        parse_weights(args.mix, parse_operation)
+        parse_weights(args.sizes, parse_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
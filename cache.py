@@ -0,0 +1,193 @@
+"""
+Caches used by the file transfer server
+"""
+import hashlib
+import os
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+
+class PreviewCache:
+    """LRU of file previews keyed by (blob name, generation), bounded by total bytes.
+
+    Writes through this server invalidate entries directly. Entries older than
+    `ttl` seconds count as misses, so files replaced or deleted elsewhere (by a
+    sibling pre-fork worker, say) are not previewed from a stale copy for long.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=5):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (name, generation) -> (preview bytes, monotonic time cached)
+        self._generations = {}  # name -> generation currently cached
+        self._lock = Lock()
+
+    def get(self, name):
+        """Return (generation, preview) for the cached version of name, or None"""
+        with self._lock:
+            generation = self._generations.get(name)
+            if generation is not None and time.monotonic() - self._entries[(name, generation)][1] >= self.ttl:
+                self._remove(name)
+                generation = None
+            if generation is None:
+                self.misses += 1
+                return None
+            key = (name, generation)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return generation, self._entries[key][0]
+
+    def put(self, name, generation, preview):
+        """Cache the preview of one generation of name, evicting least recently used entries"""
+        if len(preview) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(name)
+            self._entries[(name, generation)] = (preview, time.monotonic())
+            self._generations[name] = generation
+            self.size += len(preview)
+            while self.size > self.max_bytes:
+                (old_name, _), (old_preview, _) = self._entries.popitem(last=False)
+                del self._generations[old_name]
+                self.size -= len(old_preview)
+
+    def invalidate(self, name):
+        """Drop any cached preview of name"""
+        with self._lock:
+            self._remove(name)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+    def _remove(self, name):
+        generation = self._generations.pop(name, None)
+        if generation is not None:
+            self.size -= len(self._entries.pop((name, generation))[0])
+
+
+class DiskCache:
+    """Bounded on-disk read-through cache of blob contents keyed by (blob name, generation).
+
+    Entries are written to a temporary file and renamed into place once complete,
+    so readers never see a partial file. Least recently used entries are evicted
+    when the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes=1024 ** 3, max_entry_bytes=256 * 1024 ** 2):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # file name -> size, least recently used first
+        self._lock = Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def open(self, name, generation, size):
+        """Return an open binary file for the cached object, or None on a miss"""
+        key = self._key(name, generation)
+        with self._lock:
+            try:
+                f = open(self.root / key, 'rb')
+            except FileNotFoundError:
+                if key in self._entries:
+                    self.size -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            if os.fstat(f.fileno()).st_size != size:
+                # Truncated or foreign file; never serve it
+                f.close()
+                self._discard(key)
+                self.misses += 1
+                return None
+            if key not in self._entries:
+                # Written by a sibling worker process sharing the directory
+                self._entries[key] = size
+                self.size += size
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return f
+
+    def writer(self, name, generation, size):
+        """Return a writer that fills the entry for one generation, or None if it would not fit"""
+        if size > self.max_entry_bytes:
+            return None
+        return _CacheWriter(self, self._key(name, generation))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+    def _commit(self, key, temp_path, size):
+        try:
+            os.replace(temp_path, self.root / key)
+        except FileNotFoundError:
+            return  # Temp file removed by a restarting sibling worker
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)
+            self._entries[key] = size
+            self.size += size
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        """Forget an entry and delete its file; caller holds the lock"""
+        self.size -= self._entries.pop(key, 0)
+        try:
+            os.unlink(self.root / key)
+        except FileNotFoundError:
+            pass
+
+    def _scan(self):
+        """Adopt entries left by a previous run, oldest access first, and drop temp files"""
+        entries = []
+        for path in self.root.iterdir():
+            if path.name.startswith('.tmp-'):
+                path.unlink()
+            elif path.is_file():
+                stat = path.stat()
+                entries.append((stat.st_atime, path.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+    def _key(self, name, generation):
+        return hashlib.sha256(f"{name}#{generation}".encode()).hexdigest()
+
+
+class _CacheWriter:
+    """Temporary file that becomes a cache entry on commit"""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.path = cache.root / f".tmp-{uuid.uuid4().hex}"
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.file.close()
+        self.cache._commit(self.key, self.path, self.size)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -2,136 +2,493 @@ import socket
 import ssl
 import json
 import os
+import base64
+import hashlib
+import sys
+import time
 from pathlib import Path
 from getpass import getpass
+from queue import Empty, Queue
+from threading import Lock, Thread
+from compression import IDENTITY, SAMPLE_SIZE, FrameReader, FrameWriter, available_codecs, choose_codec
+from dedup import chunk_file
+from multipart import MAX_PARTS
+from protocol import LegacyChannel, ProtocolError, client_handshake, set_nodelay
+
+SEND_CHUNK_SIZE = 256 * 1024  # Bytes read from disk per socket write
+MULTIPART_PART_SIZE = 16 * 1024 * 1024  # Bytes per part of a multipart upload
+MULTIPART_CONNECTIONS = 4  # Parallel connections used by a multipart upload
+MULTIPART_THRESHOLD = 64 * 1024 * 1024  # Files at least this large are uploaded in parts
+PIPELINE_WINDOW = 32  # Requests kept in flight by run_pipelined
+MANIFEST_NAME = '.dfs-manifest.json'  # Per-directory record of downloaded file versions
+TOKEN_CACHE = Path.home() / '.dfs-tokens.json'  # Session tokens kept between runs of the command line client
+TOKEN_REFRESH_MARGIN = 60  # Seconds before expiry a cached token is no longer offered
+
+# Shared by every client of this process: TLS sessions can only be resumed
+# through the context that created them
+_ssl_contexts = {}  # certfile -> SSLContext
+_tls_sessions = {}  # (host, port) -> SSLSession of the latest connection
+_session_tokens = {}  # (host, port, username) -> (token, expiry)
+_session_lock = Lock()
+
+
+def client_ssl_context(certfile):
+    """The process-wide TLS context that verifies servers against `certfile`"""
+    with _session_lock:
+        context = _ssl_contexts.get(certfile)
+        if context is None:
+            context = _ssl_contexts[certfile] = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            context.load_verify_locations(certfile)
+        return context
+
+
+class DownloadManifest:
+    """Server versions of the files downloaded into one directory"""
+
+    def __init__(self, directory):
+        self.path = Path(directory) / MANIFEST_NAME
+        self._lock = Lock()
+        try:
+            self.entries = json.loads(self.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def lookup(self, filename, file_path):
+        """Return the recorded version of a local file, or None if it is unknown or changed locally"""
+        entry = self.entries.get(filename)
+        try:
+            stat = file_path.stat()
+        except FileNotFoundError:
+            return None
+        if not entry or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def record(self, filename, file_path, version, complete=True, save=True):
+        """Remember which server version a local file holds (or partially holds)"""
+        stat = file_path.stat()
+        with self._lock:
+            self.entries[filename] = {
+                'generation': version.get('generation'),
+                'md5': version.get('md5'),
+                'crc32c': version.get('crc32c'),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'complete': complete
+            }
+        if save:
+            self.save()
+
+    def forget(self, filename):
+        with self._lock:
+            self.entries.pop(filename, None)
+
+    def save(self):
+        with self._lock:
+            temp_path = self.path.with_name(self.path.name + '.tmp')
+            temp_path.write_text(json.dumps(self.entries))
+            os.replace(temp_path, self.path)
+
+
+def file_md5(path):
+    """Base64 MD5 digest of a local file, in the form storage reports it"""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+
 class FileTransferClient:
-    def __init__(self, host='localhost', port=9999, certfile='server.crt'):
+    def __init__(self, host='localhost', port=9999, certfile='server.crt', legacy=False, token_cache=None):
         self.host = host
         self.port = port
+        self.legacy = legacy  # Speak bare JSON for servers that predate framing
+        self.certfile = certfile
+        self.credentials = None  # Reused to attach extra connections to this session
+        self.codecs = []  # Compression codecs agreed with the server at login
         self.socket = None
-        self.ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        self.ssl_context.load_verify_locations(certfile)
+        self.channel = None
+        self.next_request_id = 1
+        self.ssl_context = client_ssl_context(certfile)
+        self.token_cache = Path(token_cache) if token_cache else None  # File sharing session tokens between runs
+        self.session_reused = False  # Whether the last connect resumed a TLS session
+
+    def connect(self, username, password=None, attach=False):
+        """Connect to server and authenticate; `attach` joins the session of an existing login.
 
-    def connect(self, username, password):
-        """Connect to server and authenticate"""
+        A session token from an earlier login is tried first and skips the
+        server's password check; the password is used if there is no token or
+        the server rejects it.
+        """
         try:
-            raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            raw_socket.settimeout(10)
-            self.socket = self.ssl_context.wrap_socket(raw_socket, server_hostname=self.host)
-            self.socket.connect((self.host, self.port))
-            
-            # Send authentication data
-            auth_data = {'username': username, 'password': password}
-            self.socket.send(json.dumps(auth_data).encode())
-            
-            # Receive authentication response
-            response = self._receive_data()
+            response = None
+            token = self.session_token(username)
+            if token:
+                response = self._authenticate({'username': username, 'token': token}, attach)
+                if not response or response.get('status') != 'success':
+                    self._forget_token(username)
+                    self.socket.close()
+                    response = None
+            if response is None:
+                if password is None:
+                    print("Connection error: A password is required")
+                    return False
+                response = self._authenticate({'username': username, 'password': password}, attach)
+
             if response and response.get('status') == 'success':
+                self.credentials = (username, password)
+                self.codecs = response.get('codecs', [])
+                if response.get('token'):
+                    self._store_token(username, response['token'], response['token_expires'])
                 return True
             else:
                 error_message = response.get('message', 'Authentication failed.') if response else 'Authentication failed.'
                 print(f"Connection error: {error_message}")
                 return False
-        except (socket.error, ssl.SSLError, json.JSONDecodeError) as e:
+        except (socket.error, ssl.SSLError, json.JSONDecodeError, ProtocolError) as e:
             print(f"Connection error: {e}")
             return False
+
+    def _authenticate(self, auth_data, attach):
+        """Open a connection, resuming the last TLS session to this server if possible, and log in"""
+        raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        raw_socket.settimeout(10)
+        set_nodelay(raw_socket)
+        with _session_lock:
+            session = _tls_sessions.get((self.host, self.port))
+        self.socket = self.ssl_context.wrap_socket(raw_socket, server_hostname=self.host, session=session)
+        self.socket.connect((self.host, self.port))
+        self.session_reused = self.socket.session_reused
+
+        # Negotiate the framed protocol
+        if self.legacy:
+            self.channel = LegacyChannel(self.socket)
+        else:
+            self.channel = client_handshake(self.socket)
+
+        # Send authentication data
+        auth_data = dict(auth_data, codecs=available_codecs())
+        if attach:
+            auth_data['attach'] = True
+        self._send_data(auth_data)
+
+        # Receive authentication response
+        response = self._receive_data()
+        # TLS 1.3 tickets arrive after the handshake, so the session is complete once a reply was read
+        if response and self.socket.session:
+            with _session_lock:
+                _tls_sessions[(self.host, self.port)] = self.socket.session
+        return response
+
+    def session_token(self, username):
+        """Return an unexpired session token for `username` on this server, or None"""
+        key = (self.host, self.port, username)
+        with _session_lock:
+            cached = _session_tokens.get(key)
+            if cached is None and self.token_cache:
+                cached = self._read_token_cache().get(f"{self.host}:{self.port}:{username}")
+        if cached and cached[1] - TOKEN_REFRESH_MARGIN > time.time():
+            return cached[0]
+        return None
+
+    def _store_token(self, username, token, expires):
+        with _session_lock:
+            _session_tokens[(self.host, self.port, username)] = (token, expires)
+            if self.token_cache:
+                tokens = self._read_token_cache()
+                tokens[f"{self.host}:{self.port}:{username}"] = [token, expires]
+                self._write_token_cache(tokens)
+
+    def _forget_token(self, username):
+        with _session_lock:
+            _session_tokens.pop((self.host, self.port, username), None)
+            if self.token_cache:
+                tokens = self._read_token_cache()
+                if tokens.pop(f"{self.host}:{self.port}:{username}", None):
+                    self._write_token_cache(tokens)
+
+    def _read_token_cache(self):
+        try:
+            with open(self.token_cache) as f:
+                return {key: value for key, value in json.load(f).items() if value[1] > time.time()}
+        except (OSError, ValueError, AttributeError, TypeError, IndexError):
+            return {}
+
+    def _write_token_cache(self, tokens):
+        temp_path = self.token_cache.with_name(self.token_cache.name + '.tmp')
+        try:
+            # Tokens log in as the user, so only the owner may read them
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tokens, f)
+            os.replace(temp_path, self.token_cache)
+        except OSError as e:
+            print(f"Could not save session token: {e}")
     
+    def _send_data(self, data):
+        """Helper function to send a message to the server."""
+        self.channel.send_message(data)
+
     def _receive_data(self):
-        """Helper function to receive data from the server."""
+        """Helper function to receive a message from the server."""
         try:
-            data = self.socket.recv(4096)
-            while data:
-                try:
-                    return json.loads(data.decode())
-                except json.JSONDecodeError:
-                    data += self.socket.recv(4096)
-            return None
+            return self.channel.recv_message()
         except socket.error as e:
             print(f"Data reception error: {e}")
             return None
+
     def _check_connection(self):
         """Check if socket is connected and ready"""
-        if not self.socket:
+        if not self.channel:
             print("Error: Not connected to server")
             return False
         return True
 
     def list_files(self):
         """List files in user's directory"""
+        return [entry['name'] for entry in self.list_entries()]
+
+    def list_entries(self, page_size=1000, refresh=False):
+        """Yield metadata for every file in the user's directory, one page at a time"""
+        cursor = None
+        while True:
+            entries, cursor = self.list_page(cursor, page_size, refresh)
+            yield from entries
+            if not cursor:
+                return
+            refresh = False
+
+    def list_page(self, cursor=None, page_size=1000, refresh=False):
+        """Fetch one page of file metadata; returns (entries, next_cursor)"""
         if not self._check_connection():
-            return []
-        self.socket.send(json.dumps({'command': 'list'}).encode())
+            return [], None
+        self._send_data({'command': 'list', 'cursor': cursor, 'page_size': page_size, 'refresh': refresh})
         response = self._receive_data()
-        return response.get('files', []) if response and response.get('status') == 'success' else []
+        if not response or response.get('status') != 'success':
+            return [], None
+        return response.get('entries', []), response.get('next_cursor')
     
-    def upload_file(self, filepath):
-        """Upload a file to the server"""
+    def upload_file(self, filepath, remote_name=None):
+        """Upload a file to the server, by default under its base name"""
         if not self._check_connection():
             return False
         if not os.path.exists(filepath):
             print("File not found.")
             return False
         
-        filename = os.path.basename(filepath)
+        filename = remote_name or os.path.basename(filepath)
         file_size = os.path.getsize(filepath)
         
-        # Send upload command
-        self.socket.send(json.dumps({
-            'command': 'upload',
-            'filename': filename,
-            'size': file_size
-        }).encode())
-        
-        # Send file data
         with open(filepath, 'rb') as f:
+            # Compress only if a sample of the file shrinks enough
+            encoding = choose_codec(self.codecs, f.read(SAMPLE_SIZE))
+            f.seek(0)
+
+            # Send upload command
+            request = {'command': 'upload', 'filename': filename, 'size': file_size}
+            if encoding != IDENTITY:
+                request['encoding'] = encoding
+            self._send_data(request)
+
+            # Send file data
+            out = self.channel if encoding == IDENTITY else FrameWriter(self.channel, encoding)
             while True:
-                chunk = f.read(4096)
+                chunk = f.read(SEND_CHUNK_SIZE)
                 if not chunk:
                     break
-                self.socket.sendall(chunk)
+                out.sendall(chunk)
+            if out is not self.channel:
+                out.close()
         
         response = self._receive_data()
         return response.get('status') == 'success' if response else False
+
+    def upload_file_dedup(self, filepath, remote_name=None):
+        """Upload a file sending only the content-defined chunks the server does not already store"""
+        if not self._check_connection():
+            return False
+        if not os.path.exists(filepath):
+            print("File not found.")
+            return False
+
+        chunks = chunk_file(filepath)
+        self._send_data({
+            'command': 'dedup_upload',
+            'filename': remote_name or os.path.basename(filepath),
+            'size': sum(size for _, _, size in chunks),
+            'chunks': [[digest, size] for digest, _, size in chunks]
+        })
+        response = self._receive_data()
+        if not response or response.get('status') != 'ready':
+            print(f"Upload failed: {response.get('message') if response else 'no response'}")
+            return False
+
+        locations = {}
+        for digest, offset, size in chunks:
+            locations.setdefault(digest, (offset, size))
+        with open(filepath, 'rb') as f:
+            for digest in response['missing']:
+                offset, size = locations[digest]
+                self.channel.sendfile(f, offset, size)
+
+        response = self._receive_data()
+        if response and response.get('status') == 'success':
+            print(f"Sent {response['sent']} of {os.path.getsize(filepath)} bytes")
+            return True
+        return False
+
+    def upload_file_multipart(self, filepath, connections=MULTIPART_CONNECTIONS, part_size=MULTIPART_PART_SIZE):
+        """Upload a file in parts sent in parallel over extra connections attached to this session"""
+        if not self._check_connection():
+            return False
+        if not os.path.exists(filepath):
+            print("File not found.")
+            return False
+
+        filename = os.path.basename(filepath)
+        file_size = os.path.getsize(filepath)
+        if file_size == 0:
+            return self.upload_file(filepath)
+        # Larger parts for files that would otherwise need more than the server accepts
+        part_size = max(part_size, -(-file_size // MAX_PARTS))
+        part_count = -(-file_size // part_size)
+
+        self._send_data({'command': 'multipart_start', 'filename': filename})
+        response = self._receive_data()
+        if not response or response.get('status') != 'success':
+            print(f"Upload failed: {response.get('message') if response else 'no response'}")
+            return False
+        upload_id = response['upload_id']
+
+        pending = Queue()
+        for part_number in range(1, part_count + 1):
+            pending.put(part_number)
+        failures = []
+
+        def send_parts():
+            worker = FileTransferClient(self.host, self.port, self.certfile, self.legacy)
+            try:
+                if not worker.connect(*self.credentials, attach=True):
+                    failures.append('connect')
+                    return
+                with open(filepath, 'rb') as f:
+                    while not failures:
+                        try:
+                            part_number = pending.get_nowait()
+                        except Empty:
+                            return
+                        offset = (part_number - 1) * part_size
+                        if not worker._send_part(upload_id, part_number, f, offset, min(part_size, file_size - offset)):
+                            failures.append(part_number)
+            except (socket.error, ProtocolError) as e:
+                failures.append(str(e))
+            finally:
+                # connect() leaves the socket open when the server refuses the login
+                if worker.socket:
+                    worker.socket.close()
+
+        threads = [Thread(target=send_parts) for _ in range(min(connections, part_count))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            print(f"Upload failed: could not send parts {failures}")
+            self._send_data({'command': 'multipart_abort', 'upload_id': upload_id})
+            self._receive_data()
+            return False
+        self._send_data({'command': 'multipart_complete', 'upload_id': upload_id, 'parts': part_count})
+        response = self._receive_data()
+        return response.get('status') == 'success' if response else False
+
+    def _send_part(self, upload_id, part_number, f, offset, size):
+        """Send one part of a multipart upload read from an open file"""
+        self._send_data({
+            'command': 'multipart_part',
+            'upload_id': upload_id,
+            'part_number': part_number,
+            'size': size
+        })
+        response = self._receive_data()
+        if not response or response.get('status') != 'ready':
+            return False
+        self.channel.sendfile(f, offset, size)
+        response = self._receive_data()
+        return response.get('status') == 'success' if response else False
     
-    def download_file(self, filename, save_path):
-        """Download a file from the server"""
+    def download_file(self, filename, save_path, resume=False, manifest=None, local_name=None):
+        """Download a file from the server, optionally resuming a partial local copy.
+
+        The file is saved as save_path/local_name (default: its server name). A
+        local copy that still matches the server is kept without transferring
+        any data; the versions downloaded are recorded in a manifest in save_path.
+        A caller passing its own `manifest` is responsible for saving it.
+        """
         if not self._check_connection():
             return False
         
-        self.socket.send(json.dumps({
-            'command': 'download',
-            'filename': filename
-        }).encode())
+        save_path = Path(save_path)
+        if not save_path.exists():
+            save_path.mkdir(parents=True, exist_ok=True)
+        local_name = local_name or filename
+        file_path = save_path / local_name
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        save_manifest = manifest is None
+        manifest = manifest or DownloadManifest(save_path)
+        entry = manifest.lookup(local_name, file_path)
+
+        request = {'command': 'download', 'filename': filename, 'offset': 0}
+        if self.codecs:
+            request['accept_encoding'] = self.codecs
+        if resume and file_path.exists():
+            request['offset'] = file_path.stat().st_size
+            if entry and not entry['complete']:
+                request['generation'] = entry['generation']  # Fail rather than splice two versions
+        elif entry and entry['complete']:
+            request['known'] = {'generation': entry['generation'], 'md5': entry['md5'], 'crc32c': entry['crc32c']}
+        elif file_path.exists():
+            request['known'] = {'md5': file_md5(file_path)}
+        self._send_data(request)
         
         response = self._receive_data()
+        if response and response.get('status') == 'not_modified':
+            manifest.record(local_name, file_path, response, save=save_manifest)
+            return True
         if response and response.get('status') == 'success':
-            file_size = response['size']
-            save_path = Path(save_path)
-            if not save_path.exists():
-                save_path.mkdir(parents=True, exist_ok=True)
-            file_path = Path(save_path) / filename
-            
-            with open(file_path, 'wb') as f:
+            offset = request['offset']
+            file_size = response['size']  # None when the length is only known after decompressing
+            encoding = response.get('encoding', IDENTITY)
+            source = self.channel if encoding == IDENTITY else FrameReader(self.channel, encoding)
+            with open(file_path, 'ab' if offset else 'wb') as f:
                 received = 0
-                while received < file_size:
-                    chunk = self.socket.recv(min(4096, file_size - received))
+                while file_size is None or received < file_size:
+                    chunk = source.recv(65536 if file_size is None else min(65536, file_size - received))
                     if not chunk:
                         break
                     f.write(chunk)
                     received += len(chunk)
-            return True
-        else:
-            print("Download failed or file not found on server.")
-            return False
+            if source is not self.channel:
+                source.finish()
+            complete = file_size is None or received == file_size
+            manifest.record(local_name, file_path, response, complete=complete, save=save_manifest)
+            return complete
+        if response and response.get('message') == 'File has changed':
+            print("File changed on the server since the partial download; downloading it again.")
+            return self.download_file(filename, save_path, manifest=None if save_manifest else manifest,
+                                      local_name=local_name)
+        print("Download failed or file not found on server.")
+        return False
     
     def view_file(self, filename):
         """View first 1024 bytes of a file"""
         if not self._check_connection():
             return None
-        self.socket.send(json.dumps({
+        self._send_data({
             'command': 'view',
             'filename': filename
-        }).encode())
+        })
         
         response = self._receive_data()
         return response.get('preview') if response and response.get('status') == 'success' else None
@@ -140,14 +497,191 @@ class FileTransferClient:
         """Delete a file from the server"""
         if not self._check_connection():
             return False
-        self.socket.send(json.dumps({
+        self._send_data({
             'command': 'delete',
             'filename': filename
-        }).encode())
+        })
         
         response = self._receive_data()
         return response.get('status') == 'success' if response else False
     
+    def copy_file(self, filename, destination):
+        """Copy a file (or a directory, named with a trailing '/') on the server; returns the reply or None"""
+        return self._copy_request('copy', filename, destination)
+
+    def move_file(self, filename, destination):
+        """Move a file (or a directory, named with a trailing '/') on the server; returns the reply or None"""
+        return self._copy_request('move', filename, destination)
+
+    def rename_file(self, filename, new_name):
+        """Give a file or directory a new name in the same directory; returns the reply or None"""
+        return self._copy_request('rename', filename, new_name)
+
+    def _copy_request(self, command, filename, destination):
+        if not self._check_connection():
+            return None
+        self._send_data({'command': command, 'filename': filename, 'destination': destination})
+        response = self._receive_data()
+        if not response or response.get('status') != 'success':
+            print(f"{command.capitalize()} failed: {response.get('message') if response else 'no response'}")
+            return None
+        return response
+
+    def stat_file(self, filename):
+        """Fetch size, generation and checksums of a file, or None if it does not exist"""
+        return self.stat_files([filename])[filename]
+
+    def stat_files(self, filenames):
+        """Fetch metadata of many files in one pipelined batch; returns {filename: entry or None}"""
+        replies = self.run_pipelined([{'command': 'stat', 'filename': name} for name in filenames])
+        return {name: reply if reply and reply.get('status') == 'success' else None
+                for name, reply in zip(filenames, replies)}
+
+    def view_files(self, filenames):
+        """Fetch previews of many files in one pipelined batch; returns {filename: preview or None}"""
+        replies = self.run_pipelined([{'command': 'view', 'filename': name} for name in filenames])
+        return {name: reply.get('preview') if reply and reply.get('status') == 'success' else None
+                for name, reply in zip(filenames, replies)}
+
+    def delete_files(self, filenames):
+        """Delete many files in one pipelined batch; returns {filename: deleted}"""
+        replies = self.run_pipelined([{'command': 'delete', 'filename': name} for name in filenames])
+        return {name: bool(reply) and reply.get('status') == 'success' for name, reply in zip(filenames, replies)}
+
+    def run_pipelined(self, requests, window=PIPELINE_WINDOW):
+        """Send metadata requests tagged with ids, keeping up to `window` unanswered at once.
+
+        Returns the replies in request order; a reply is None if the connection
+        dropped before it arrived.
+        """
+        replies = [None] * len(requests)
+        if not self._check_connection():
+            return replies
+        outstanding = {}  # request id -> index, oldest first
+        sent = 0
+        while sent < len(requests) or outstanding:
+            while sent < len(requests) and len(outstanding) < window:
+                request_id = self.next_request_id
+                self.next_request_id += 1
+                outstanding[request_id] = sent
+                self._send_data(dict(requests[sent], id=request_id))
+                sent += 1
+            response = self._receive_data()
+            if not response:
+                break
+            # Servers without pipelining answer in order and omit the id
+            request_id = response.pop('id', next(iter(outstanding)))
+            index = outstanding.pop(request_id, None)
+            if index is not None:
+                replies[index] = response
+        return replies
+
+    def batch_stat(self, filenames=None, pattern=None):
+        """Fetch metadata of the named files, or of every file matching a glob pattern, in one request.
+
+        Returns a list of per-file results with 'name' and 'status', or None if the request failed.
+        """
+        return self._batch_request('batch_stat', filenames, pattern)
+
+    def batch_delete(self, filenames=None, pattern=None):
+        """Delete the named files, or every file matching a glob pattern, in one request"""
+        return self._batch_request('batch_delete', filenames, pattern)
+
+    def batch_download(self, save_path, filenames=None, pattern=None):
+        """Download several files over one response; returns {filename: downloaded} or None"""
+        if not self._check_connection():
+            return None
+        save_path = Path(save_path)
+        save_path.mkdir(parents=True, exist_ok=True)
+        self._send_data(self._batch_command('batch_download', filenames, pattern))
+        results = {}
+        while True:
+            response = self._receive_data()
+            if not response or (response.get('status') == 'failed' and 'name' not in response):
+                print(f"Batch download failed: {response.get('message') if response else 'no response'}")
+                return None
+            if response['status'] == 'done':
+                return results
+            if response['status'] != 'success':
+                results[response['name']] = False
+                continue
+            file_path = save_path / response['name']
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(file_path, 'wb') as f:
+                remaining = response['size']
+                while remaining:
+                    chunk = self.channel.recv(min(65536, remaining))
+                    if not chunk:
+                        return None
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            results[response['name']] = True
+
+    def _batch_request(self, command, filenames, pattern):
+        if not self._check_connection():
+            return None
+        self._send_data(self._batch_command(command, filenames, pattern))
+        response = self._receive_data()
+        if not response or response.get('status') != 'success':
+            print(f"Batch request failed: {response.get('message') if response else 'no response'}")
+            return None
+        return response['results']
+
+    def _batch_command(self, command, filenames, pattern):
+        request = {'command': command}
+        if filenames is not None:
+            request['filenames'] = list(filenames)
+        else:
+            request['pattern'] = pattern
+        return request
+
+    def cache_stats(self):
+        """Fetch the server's cache hit/miss counters"""
+        if not self._check_connection():
+            return None
+        self._send_data({'command': 'cache_stats'})
+        response = self._receive_data()
+        return response if response and response.get('status') == 'success' else None
+
+    def scheduler_stats(self, limits=None):
+        """Fetch the server's transfer limits and per-user usage; admins may pass new `limits`"""
+        if not self._check_connection():
+            return None
+        request = {'command': 'scheduler'}
+        if limits is not None:
+            request['limits'] = limits
+        self._send_data(request)
+        response = self._receive_data()
+        if not response or response.get('status') != 'success':
+            print(f"Scheduler request failed: {response.get('message') if response else 'no response'}")
+            return None
+        return response
+
+    def server_stats(self):
+        """Fetch the server's command latencies, storage call counts and traffic (admins only)"""
+        if not self._check_connection():
+            return None
+        self._send_data({'command': 'stats'})
+        response = self._receive_data()
+        if not response or response.get('status') != 'success':
+            print(f"Stats request failed: {response.get('message') if response else 'no response'}")
+            return None
+        return response
+
+    def trace_settings(self, settings=None):
+        """Fetch the server's slow log and profiling settings; admins may pass new `settings`"""
+        if not self._check_connection():
+            return None
+        request = {'command': 'trace'}
+        if settings is not None:
+            request['settings'] = settings
+        self._send_data(request)
+        response = self._receive_data()
+        if not response or response.get('status') != 'success':
+            print(f"Trace request failed: {response.get('message') if response else 'no response'}")
+            return None
+        return response
+
     def close(self):
         """Close the connection"""
         if self.socket:
@@ -157,7 +691,41 @@ class FileTransferClient:
             except socket.error as e:
                 print(f"Error closing connection: {e}")
 
+def sync_main(argv):
+    """Run `client.py sync push|pull LOCAL_DIR` without the interactive menu"""
+    import argparse
+    import sync
+
+    parser = argparse.ArgumentParser(prog='client.py sync', description='Mirror a directory to or from the server')
+    parser.add_argument('direction', choices=['push', 'pull'])
+    parser.add_argument('local_dir', help='Local directory to upload from or download into')
+    parser.add_argument('--remote-dir', default='', help='Server directory to mirror (default: all files)')
+    parser.add_argument('--connections', type=int, default=sync.DEFAULT_CONNECTIONS,
+                        help='Parallel transfer connections')
+    parser.add_argument('--delete', action='store_true', help='Also delete files missing on the source side')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--cert', default='server.crt', help='CA certificate used to verify the server')
+    parser.add_argument('--username', required=True)
+    args = parser.parse_args(argv)
+
+    client = FileTransferClient(args.host, args.port, args.cert, token_cache=TOKEN_CACHE)
+    password = os.environ.get('DFS_PASSWORD')
+    if not password and not client.session_token(args.username):
+        password = getpass("Password: ")
+    if not client.connect(args.username, password):
+        return 1
+    try:
+        run = sync.push if args.direction == 'push' else sync.pull
+        stats = run(client, args.local_dir, args.remote_dir, args.connections, args.delete)
+    finally:
+        client.close()
+    print(stats.summary())
+    return 1 if stats.failed else 0
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'sync':
+        sys.exit(sync_main(sys.argv[2:]))
     client = FileTransferClient()
     
     try:
@@ -178,19 +746,24 @@ def main():
             print("3. Download file")
             print("4. View file")
             print("5. Delete file")
-            print("6. Exit")
+            print("6. Copy file")
+            print("7. Move/rename file")
+            print("8. Exit")
             
-            choice = input("\nEnter choice (1-6): ")
+            choice = input("\nEnter choice (1-8): ")
             
             if choice == '1':
-                files = client.list_files()
                 print("\nFiles in your directory:")
-                for file in files:
-                    print(f"- {file}")
+                for entry in client.list_entries():
+                    print(f"- {entry['name']} ({entry['size']} bytes, updated {entry['updated']})")
             
             elif choice == '2':
                 filepath = input("Enter file path to upload: ")
-                if client.upload_file(filepath):
+                if os.path.isfile(filepath) and os.path.getsize(filepath) >= MULTIPART_THRESHOLD:
+                    uploaded = client.upload_file_multipart(filepath)
+                else:
+                    uploaded = client.upload_file(filepath)
+                if uploaded:
                     print("File uploaded successfully.")
                 else:
                     print("Upload failed.")
@@ -198,7 +771,10 @@ def main():
             elif choice == '3':
                 filename = input("Enter filename to download: ")
                 save_path = input("Enter directory to save file: ")
-                if client.download_file(filename, save_path):
+                resume = False
+                if (Path(save_path) / filename).exists():
+                    resume = input("Resume partial download? (y/N): ").lower() == 'y'
+                if client.download_file(filename, save_path, resume):
                     print("File downloaded successfully.")
                 else:
                     print("Download failed.")
@@ -219,7 +795,13 @@ def main():
                 else:
                     print("Delete failed.")
             
-            elif choice == '6':
+            elif choice in ('6', '7'):
+                filename = input("Enter file (or directory ending in /): ")
+                destination = input("Enter destination path: ")
+                if (client.copy_file if choice == '6' else client.move_file)(filename, destination):
+                    print("Done.")
+            
+            elif choice == '8':
                 break
             
             else:
@@ -0,0 +1,275 @@
+"""
+On-the-wire compression for file transfers.
+
+Compressed data travels as a sequence of frames, each a 4-byte big-endian
+length followed by that many bytes of codec output; a zero-length frame ends
+the stream. Frames are produced from bounded blocks of input, so neither side
+holds more than a block in memory. zlib and gzip are always available; zstd and
+lz4 are used when the zstandard and lz4 packages are installed.
+"""
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from protocol import ProtocolError
+
+IDENTITY = 'identity'
+FRAME_INPUT_SIZE = 1024 * 1024  # Uncompressed bytes fed to the codec per frame
+MAX_FRAME_SIZE = 8 * 1024 * 1024  # Largest compressed frame a receiver accepts
+MAX_DECODED_CHUNK = FRAME_INPUT_SIZE  # Most decompressed bytes a receiver holds at once
+SAMPLE_SIZE = 64 * 1024  # Bytes compressed to decide whether compression pays off
+MIN_SAVINGS = 0.1  # Fraction of the sample that compression must save
+_FRAME = struct.Struct('!I')
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class _ZlibEncoder:
+    def __init__(self, wbits=zlib.MAX_WBITS):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def _zlib_decoder(payloads, wbits=zlib.MAX_WBITS):
+    """Yield the decompressed data of a zlib or gzip stream in chunks of at most MAX_DECODED_CHUNK bytes"""
+    decompressor = zlib.decompressobj(wbits)
+    for data in payloads:
+        while data:
+            out = decompressor.decompress(data, MAX_DECODED_CHUNK)
+            if decompressor.eof:
+                data = decompressor.unused_data
+                if data:
+                    # Concatenated gzip members (e.g. composed objects) each start a new stream
+                    decompressor = zlib.decompressobj(wbits)
+            else:
+                data = decompressor.unconsumed_tail
+            if out:
+                yield out
+
+
+class _ZstdEncoder:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _PayloadReader:
+    """File-like view of an iterable of payloads, for zstandard's streaming reader"""
+
+    def __init__(self, payloads):
+        self._payloads = iter(payloads)
+        self._pending = b''
+
+    def read(self, size):
+        if not self._pending:
+            self._pending = next(self._payloads, b'')
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+def _zstd_decoder(payloads):
+    reader = _PayloadReader(payloads)
+    return zstandard.ZstdDecompressor().read_to_iter(reader, write_size=MAX_DECODED_CHUNK)
+
+
+class _Lz4Encoder:
+    """Each wire frame carries one self-contained LZ4 frame"""
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def finish(self):
+        return b''
+
+
+def _lz4_decoder(payloads):
+    for data in payloads:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        while not decompressor.eof:
+            out = decompressor.decompress(data, MAX_DECODED_CHUNK)
+            data = b''
+            if out:
+                yield out
+            elif decompressor.needs_input:
+                raise ProtocolError("Truncated LZ4 frame")
+
+
+# name -> (encoder factory, decoder), most preferred first. A decoder takes an
+# iterable of compressed payloads and yields the decompressed data in bounded chunks.
+CODECS = {}
+if zstandard:
+    CODECS['zstd'] = (_ZstdEncoder, _zstd_decoder)
+if lz4:
+    CODECS['lz4'] = (_Lz4Encoder, _lz4_decoder)
+CODECS['zlib'] = (_ZlibEncoder, _zlib_decoder)
+CODECS['gzip'] = (lambda: _ZlibEncoder(_GZIP_WBITS), lambda payloads: _zlib_decoder(payloads, _GZIP_WBITS))
+
+
+def available_codecs():
+    """Names of the codecs this process supports, most preferred first"""
+    return list(CODECS)
+
+
+def negotiate(offered):
+    """Codecs supported by both sides, in this side's order of preference"""
+    if not isinstance(offered, list):
+        return []
+    return [name for name in CODECS if name in offered]
+
+
+def is_compressible(sample):
+    """Whether a fast compression of the sample saves enough to be worth it"""
+    sample = sample[:SAMPLE_SIZE]
+    return bool(sample) and len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVINGS)
+
+
+def choose_codec(accepted, sample):
+    """Pick the codec to send `sample`-like data with, or IDENTITY"""
+    codecs = negotiate(accepted)
+    if not codecs or not is_compressible(sample):
+        return IDENTITY
+    return codecs[0]
+
+
+def gunzip_chunks(chunks, start=0, end=None):
+    """Yield bytes [start, end) of the decompressed data of a gzip stream given as an iterable of chunks"""
+    position = 0  # Decompressed bytes seen so far
+    for data in _zlib_decoder(chunks, _GZIP_WBITS):
+        skip = max(0, start - position)
+        position += len(data)
+        if end is not None and position >= end:
+            data = data[skip:len(data) - (position - end)]
+            if data:
+                yield data
+            return
+        if skip < len(data):
+            yield data[skip:]
+
+
+class FrameWriter:
+    """Compress data written to a channel into frames; close() ends the stream.
+
+    With codec None the data is framed as-is, for bytes that are already encoded.
+    """
+
+    def __init__(self, channel, codec):
+        self.channel = channel
+        self._encoder = CODECS[codec][0]() if codec else None
+        self._pending = bytearray()
+
+    def sendall(self, data):
+        self._pending += data
+        while len(self._pending) >= FRAME_INPUT_SIZE:
+            self._send_frame(bytes(self._pending[:FRAME_INPUT_SIZE]))
+            del self._pending[:FRAME_INPUT_SIZE]
+
+    def close(self):
+        if self._pending:
+            self._send_frame(bytes(self._pending))
+            self._pending.clear()
+        if self._encoder:
+            self._write(self._encoder.finish())
+        self.channel.sendall(_FRAME.pack(0))
+
+    def _send_frame(self, data):
+        self._write(self._encoder.compress(data) if self._encoder else data)
+
+    def _write(self, payload):
+        if payload:
+            self.channel.sendall(_FRAME.pack(len(payload)) + payload)
+
+
+class FrameReader:
+    """Socket-like reader returning the decompressed data of a framed stream.
+
+    Frames are decompressed at most MAX_DECODED_CHUNK bytes at a time, so a
+    small frame that expands hugely is never held in memory whole. recv()
+    returns b'' once the end frame has been read.
+    """
+
+    def __init__(self, channel, codec):
+        self.channel = channel
+        payloads = self._read_frames()
+        self._chunks = CODECS[codec][1](payloads) if codec else payloads
+        self._buffer = b''
+        self.finished = False
+
+    def recv(self, size):
+        if not self._buffer:
+            self._buffer = self._next_chunk()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def finish(self):
+        """Consume the rest of the stream; raises ProtocolError if it carried extra data"""
+        if self._buffer or self._next_chunk():
+            raise ProtocolError("Compressed stream is longer than announced")
+
+    def _next_chunk(self):
+        """Next non-empty piece of decompressed data, or b'' at the end of the stream"""
+        try:
+            for data in self._chunks:
+                if data:
+                    return data
+            return b''
+        except (ProtocolError, OSError):
+            raise
+        except Exception as e:
+            raise ProtocolError(f"Corrupt compressed frame: {e}") from e
+
+    def _read_frames(self):
+        """Yield frame payloads up to the end frame"""
+        while True:
+            header = self.channel.recv_exact(_FRAME.size)
+            if len(header) < _FRAME.size:
+                raise ConnectionError("Connection closed inside a compressed stream")
+            length = _FRAME.unpack(header)[0]
+            if length == 0:
+                self.finished = True
+                return
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Compressed frame of {length} bytes exceeds limit")
+            payload = self.channel.recv_exact(length)
+            if len(payload) < length:
+                raise ConnectionError("Connection closed inside a compressed stream")
+            yield payload
+
+
+class GzipWriter:
+    """Storage writer wrapper that gzips data before it reaches storage"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+        self.info = None
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+
+    def close(self):
+        self.writer.write(self._compressor.flush())
+        self.writer.close()
+        self.info = self.writer.info
+
+    def abort(self):
+        self.writer.abort()
@@ -1,120 +1,189 @@
 import sqlite3
 import hashlib
 import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
 import logging
 
+POOL_SIZE = 4  # SQLite connections shared by authenticating threads
+CREDENTIAL_TTL = 60  # Seconds a cached password hash is trusted before re-reading it
+LAST_LOGIN_FLUSH_INTERVAL = 5  # Seconds between batched last_login writes
+BUSY_TIMEOUT = 30  # Seconds a connection waits for another writer's lock
+
 class UserDatabase:
-    def __init__(self, db_path='users.db'):
+    """Users table in SQLite.
+
+    Connections come from a small pool and use WAL mode, so logins read while a
+    write is in progress. Password hashes are cached for `credential_ttl`
+    seconds; create_user and delete_user invalidate the cache of this process,
+    and changes made by other processes show up once the entry expires.
+    last_login times are collected in memory and written in one transaction
+    every few seconds.
+    """
+
+    def __init__(self, db_path='users.db', pool_size=POOL_SIZE, credential_ttl=CREDENTIAL_TTL,
+                 flush_interval=LAST_LOGIN_FLUSH_INTERVAL):
         self.db_path = db_path
+        self.credential_ttl = credential_ttl
+        self.flush_interval = flush_interval
+        self._pool = Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        self._credentials = {}  # username -> (password hash or None for unknown users, expiry)
+        self._credentials_lock = Lock()
+        self._pending_logins = {}  # username -> last login time not yet written
+        self._logins_lock = Lock()
+        self._flusher = None
         self.init_database()
-    
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent; only the last commits may be lost on power loss
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection; the transaction is committed, or rolled back on error"""
+        conn = self._pool.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._pool.put(conn)
+
     def init_database(self):
         """Initialize the database with users table"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
-        
+        with self._connection() as conn:
+            # Create users table
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_login TIMESTAMP
+                )
+            ''')
+            empty = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0
+
         # Create default admin user if no users exist
-        cursor.execute('SELECT COUNT(*) FROM users')
-        if cursor.fetchone()[0] == 0:
+        if empty:
             self.create_user('admin', 'admin123')
             self.create_user('testuser', 'test123')
             logging.info("Created default users: admin and testuser")
-        
-        conn.commit()
-        conn.close()
-    
+
     def _hash_password(self, password):
         """Hash password using SHA-256"""
         return hashlib.sha256(password.encode()).hexdigest()
-    
+
     def create_user(self, username, password):
         """Create a new user"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             password_hash = self._hash_password(password)
-            cursor.execute(
-                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                (username, password_hash)
-            )
-            
-            conn.commit()
-            conn.close()
+            with self._connection() as conn:
+                conn.execute(
+                    'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                    (username, password_hash)
+                )
+            self._invalidate(username)
             return True
         except sqlite3.IntegrityError:
             return False  # User already exists
         except Exception as e:
             logging.error(f"Error creating user: {e}")
             return False
-    
+
     def authenticate(self, username, password):
         """Authenticate user credentials"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            password_hash = self._hash_password(password)
-            cursor.execute(
-                'SELECT id FROM users WHERE username = ? AND password_hash = ?',
-                (username, password_hash)
-            )
-            
-            result = cursor.fetchone()
-            
-            if result:
-                # Update last login
-                cursor.execute(
-                    'UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE username = ?',
-                    (username,)
-                )
-                conn.commit()
-            
-            conn.close()
-            return result is not None
+            stored_hash = self._password_hash(username)
+            if stored_hash is None or stored_hash != self._hash_password(password):
+                return False
+            self._record_login(username)
+            return True
         except Exception as e:
             logging.error(f"Error during authentication: {e}")
             return False
-    
+
+    def _password_hash(self, username):
+        """Return the stored password hash of a user (None if unknown), from the cache when fresh"""
+        now = time.monotonic()
+        with self._credentials_lock:
+            cached = self._credentials.get(username)
+        if cached and cached[1] > now:
+            return cached[0]
+        with self._connection() as conn:
+            row = conn.execute('SELECT password_hash FROM users WHERE username = ?', (username,)).fetchone()
+        password_hash = row[0] if row else None
+        with self._credentials_lock:
+            self._credentials[username] = (password_hash, now + self.credential_ttl)
+        return password_hash
+
+    def _invalidate(self, username):
+        with self._credentials_lock:
+            self._credentials.pop(username, None)
+
+    def _record_login(self, username):
+        """Queue a last_login update for the next batched write"""
+        with self._logins_lock:
+            # Same format as SQLite's CURRENT_TIMESTAMP
+            self._pending_logins[username] = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_logins()
+
+    def flush_logins(self):
+        """Write queued last_login times in one transaction"""
+        with self._logins_lock:
+            pending, self._pending_logins = self._pending_logins, {}
+        if not pending:
+            return
+        try:
+            with self._connection() as conn:
+                conn.executemany(
+                    'UPDATE users SET last_login = ? WHERE username = ?',
+                    [(login, username) for username, login in pending.items()]
+                )
+        except Exception as e:
+            logging.error(f"Error writing last login times: {e}")
+            with self._logins_lock:
+                # Keep them for the next flush unless newer logins replaced them
+                for username, login in pending.items():
+                    self._pending_logins.setdefault(username, login)
+
     def list_users(self):
         """List all users (for admin purposes)"""
+        self.flush_logins()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT username, created_at, last_login FROM users')
-            users = cursor.fetchall()
-            
-            conn.close()
-            return users
+            with self._connection() as conn:
+                return conn.execute('SELECT username, created_at, last_login FROM users').fetchall()
         except Exception as e:
             logging.error(f"Error listing users: {e}")
             return []
-    
+
     def delete_user(self, username):
         """Delete a user"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM users WHERE username = ?', (username,))
-            deleted = cursor.rowcount > 0
-            
-            conn.commit()
-            conn.close()
+            with self._connection() as conn:
+                deleted = conn.execute('DELETE FROM users WHERE username = ?', (username,)).rowcount > 0
+            self._invalidate(username)
             return deleted
         except Exception as e:
             logging.error(f"Error deleting user: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    def close(self):
+        """Write pending last_login times and close the pooled connections"""
+        self.flush_logins()
+        while not self._pool.empty():
+            self._pool.get().close()
@@ -0,0 +1,142 @@
+"""
+Content-defined chunking for dedup uploads.
+
+The client cuts a file where a rolling gear hash of the last 64 bytes hits a
+fixed bit pattern, so inserting or removing bytes only changes the chunks
+around the edit, and names every chunk by its SHA-256. The server keeps one
+object per chunk under CHUNK_PREFIX/{username}/ and rebuilds an uploaded file by
+composing the chunks in the order the client lists them; only chunks the store
+does not already hold are sent.
+
+With numpy installed the gear hash is computed a block at a time with array
+operations; otherwise a byte-at-a-time loop finds the same cut points, so
+clients with and without numpy share chunks.
+"""
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from storage_backend import STAGING_PREFIX, StorageError
+
+CHUNK_PREFIX = f"{STAGING_PREFIX}chunks/"
+MIN_CHUNK_SIZE = 256 * 1024  # No cut point is considered before this many bytes
+AVG_CHUNK_SIZE = 1024 * 1024  # Expected distance past the minimum between cut points (power of two)
+MAX_CHUNK_SIZE = 4 * 1024 * 1024  # Chunks are cut here when no cut point was found
+READ_SIZE = 8 * 1024 * 1024  # Bytes read from the file at a time while chunking
+SCAN_BLOCK_SIZE = 256 * 1024  # Bytes hashed per array operation when looking for a cut point
+
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+_HASH_MASK = (1 << 64) - 1
+# Test the top bits, which depend on the last 64 bytes rather than the last few
+_BOUNDARY_MASK = (AVG_CHUNK_SIZE - 1) << (64 - AVG_CHUNK_SIZE.bit_length() + 1)
+_WINDOW = 64  # Bytes that affect the hash; older ones are shifted out of the 64-bit value
+CHUNKER = 'numpy' if numpy else 'python'  # Implementation finding cut points, reported by bench.py
+if numpy:
+    _GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint64)
+
+
+def chunk_file(path):
+    """Return [(sha256 hex digest, offset, size)] for the content-defined chunks of a file.
+
+    The file is read once; each chunk is hashed as soon as it is cut.
+    """
+    chunks = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for data in iter_chunks(f):
+            chunks.append((hashlib.sha256(data).hexdigest(), offset, len(data)))
+            offset += len(data)
+    return chunks
+
+
+def iter_chunks(f):
+    """Yield the content-defined chunks of a binary file object as bytes"""
+    buffer = b''
+    start = 0  # Start of the next chunk in buffer
+    while True:
+        data = f.read(READ_SIZE)
+        buffer = buffer[start:] + data
+        start = 0
+        while len(buffer) - start >= MAX_CHUNK_SIZE or (start < len(buffer) and not data):
+            cut = _cut_point(buffer, start)
+            yield buffer[start:cut]
+            start = cut
+        if not data:
+            return
+
+
+def _cut_point(data, start):
+    """End of the chunk of `data` that begins at `start`"""
+    end = min(len(data), start + MAX_CHUNK_SIZE)
+    if end - start <= MIN_CHUNK_SIZE:
+        return end
+    if numpy:
+        return _find_boundary_numpy(data, start + MIN_CHUNK_SIZE, end)
+    gear = _GEAR
+    mask = _BOUNDARY_MASK
+    h = 0
+    position = start + MIN_CHUNK_SIZE
+    for byte in data[position:end]:
+        h = ((h << 1) + gear[byte]) & _HASH_MASK
+        position += 1
+        if not h & mask:
+            return position
+    return end
+
+
+def _find_boundary_numpy(data, scan_start, scan_end):
+    """Vectorised version of the loop in _cut_point: the end of the first byte in
+    [scan_start, scan_end) where the gear hash, started at scan_start, hits the boundary mask.
+    """
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    mask = numpy.uint64(_BOUNDARY_MASK)
+    for block_start in range(scan_start, scan_end, SCAN_BLOCK_SIZE):
+        block_end = min(block_start + SCAN_BLOCK_SIZE, scan_end)
+        # The hash at a position covers up to the 63 bytes before it, but none before scan_start
+        context = min(_WINDOW - 1, block_start - scan_start)
+        hashes = _GEAR_ARRAY[data[block_start - context:block_end]]
+        # Sum gear[byte] << age over the window by doubling the span: 1, 2, 4, ... 64 bytes
+        span = 1
+        while span < _WINDOW:
+            hashes[span:] += hashes[:-span] << numpy.uint64(span)
+            span *= 2
+        hits = numpy.flatnonzero((hashes[context:] & mask) == 0)
+        if hits.size:
+            return block_start + int(hits[0]) + 1
+    return scan_end
+
+
+def chunk_name(username, digest):
+    """Object name of a chunk in a user's chunk store"""
+    return f"{CHUNK_PREFIX}{username}/{digest}"
+
+
+def is_digest(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class VerifyingWriter:
+    """Storage writer that only commits data whose SHA-256 matches the expected digest"""
+
+    def __init__(self, writer, digest):
+        self.writer = writer
+        self.digest = digest
+        self.hash = hashlib.sha256()
+        self.info = None
+
+    def write(self, data):
+        self.hash.update(data)
+        self.writer.write(data)
+
+    def close(self):
+        if self.hash.hexdigest() != self.digest:
+            self.writer.abort()
+            raise StorageError(f"Chunk data does not match digest {self.digest}")
+        self.writer.close()
+        self.info = self.writer.info
+
+    def abort(self):
+        self.writer.abort()
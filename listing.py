@@ -0,0 +1,101 @@
+"""
+Per-user listing index for the list command
+"""
+import time
+from bisect import bisect_right, insort
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+class _UserListing:
+    def __init__(self, entries):
+        self.entries = {entry['name']: entry for entry in entries}
+        self.names = sorted(self.entries)
+        self.loaded_at = time.monotonic()
+
+    def upsert(self, entry):
+        if entry['name'] not in self.entries:
+            insort(self.names, entry['name'])
+        self.entries[entry['name']] = entry
+
+    def remove(self, name):
+        if self.entries.pop(name, None) is not None:
+            del self.names[bisect_right(self.names, name) - 1]
+
+
+class ListingIndex:
+    """File metadata per user, loaded from storage on first use and updated in place by writes.
+
+    `load_entries(username)` returns the user's entries as dicts with at least a
+    'name' key. An index older than `ttl` seconds is reloaded on the next access
+    so writes made outside this server become visible.
+    """
+
+    def __init__(self, load_entries, ttl=60, max_users=1024):
+        self.load_entries = load_entries
+        self.ttl = ttl
+        self.max_users = max_users
+        self._users = OrderedDict()  # username -> _UserListing, least recently used first
+        self._loading = {}  # username -> writes seen while its index was being loaded
+        self._lock = Lock()
+
+    def page(self, username, cursor=None, page_size=DEFAULT_PAGE_SIZE, refresh=False):
+        """Return (entries, next_cursor) for the names sorted after `cursor`"""
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        listing = self._get(username, refresh)
+        with self._lock:
+            start = bisect_right(listing.names, cursor) if cursor else 0
+            names = listing.names[start:start + page_size]
+            entries = [listing.entries[name] for name in names]
+            more = start + page_size < len(listing.names)
+        return entries, (names[-1] if more else None)
+
+    def names(self, username, refresh=False):
+        """Return every file name of a user"""
+        listing = self._get(username, refresh)
+        with self._lock:
+            return list(listing.names)
+
+    def upsert(self, username, entry):
+        """Record a new or replaced file"""
+        self._apply(username, 'upsert', entry)
+
+    def remove(self, username, name):
+        """Record a deleted file"""
+        self._apply(username, 'remove', name)
+
+    def _apply(self, username, op, value):
+        with self._lock:
+            if username in self._loading:
+                self._loading[username].append((op, value))
+            listing = self._users.get(username)
+            if listing is not None:
+                getattr(listing, op)(value)
+
+    def _get(self, username, refresh):
+        with self._lock:
+            listing = self._users.get(username)
+            if listing is not None and not refresh and time.monotonic() - listing.loaded_at < self.ttl:
+                self._users.move_to_end(username)
+                return listing
+            self._loading.setdefault(username, [])
+
+        try:
+            listing = _UserListing(self.load_entries(username))
+        except Exception:
+            with self._lock:
+                self._loading.pop(username, None)
+            raise
+
+        with self._lock:
+            # Replay writes that raced with the load so they are not lost
+            for op, value in self._loading.pop(username, []):
+                getattr(listing, op)(value)
+            self._users[username] = listing
+            self._users.move_to_end(username)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return listing
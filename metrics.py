@@ -0,0 +1,246 @@
+"""
+Server metrics: command latencies, storage calls, traffic and connections.
+
+Latencies are counted in fixed buckets, so recording one costs a bisect and a
+few additions under a lock; percentiles are interpolated from the bucket counts
+when a snapshot is taken. The same numbers are reported by the `stats` command
+and, in Prometheus text format, by an optional HTTP endpoint.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, local
+
+# Upper bounds in seconds; slower observations fall into a final overflow bucket
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MAX_LABELS = 64  # Distinct command or storage call names tracked; others are counted as 'other'
+
+
+class Histogram:
+    """Latency distribution over fixed buckets"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self._lock = Lock()
+
+    def observe(self, seconds, failed=False):
+        index = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if failed:
+                self.errors += 1
+
+    def snapshot(self):
+        """Count, errors, mean and estimated p50/p95/p99 in seconds"""
+        with self._lock:
+            counts = list(self.counts)
+            total, elapsed, errors = self.count, self.sum, self.errors
+        result = {'count': total, 'errors': errors, 'mean': round(elapsed / total, 6) if total else None}
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            result[name] = self._percentile(counts, total, fraction)
+        return result
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) pairs, ending with +Inf, plus the sum"""
+        with self._lock:
+            counts = list(self.counts)
+            elapsed = self.sum
+        buckets = []
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            seen += count
+            buckets.append((bound, seen))
+        return buckets, elapsed
+
+    def _percentile(self, counts, total, fraction):
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                if index == len(self.bounds):
+                    return lower  # Overflow bucket has no upper bound
+                return round(lower + (self.bounds[index] - lower) * (rank - seen) / count, 6)
+            seen += count
+        return self.bounds[-1]
+
+
+class ServerMetrics:
+    """Counters and histograms shared by every connection of one server process"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}  # command -> Histogram
+        self.storage_calls = {}  # storage call name -> Histogram
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_connections = 0
+        self.connections = 0
+        self.connection_errors = 0
+        self._lock = Lock()
+        self._request = local()  # Whether the command running on this thread has failed
+
+    @contextmanager
+    def command(self, name):
+        """Time the command run by the block; it counts as an error if it raises or replies 'failed'"""
+        self._request.failed = False
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._request.failed = True
+            raise
+        finally:
+            self._histogram(self.commands, name).observe(time.perf_counter() - started, self._request.failed)
+
+    def replied(self, data):
+        """Note a reply sent by the current thread's command"""
+        if data.get('status') == 'failed':
+            self._request.failed = True
+
+    def storage_call(self, name, seconds, failed=False):
+        self._histogram(self.storage_calls, name).observe(seconds, failed)
+
+    def transferred(self, received=0, sent=0):
+        with self._lock:
+            self.bytes_in += received
+            self.bytes_out += sent
+
+    def connection_opened(self):
+        with self._lock:
+            self.active_connections += 1
+            self.connections += 1
+
+    def connection_closed(self, failed=False):
+        with self._lock:
+            self.active_connections -= 1
+            if failed:
+                self.connection_errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {
+                'uptime': round(time.time() - self.started, 1),
+                'active_connections': self.active_connections,
+                'connections': self.connections,
+                'connection_errors': self.connection_errors,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+            commands = dict(self.commands)
+            storage_calls = dict(self.storage_calls)
+        result['commands'] = {name: histogram.snapshot() for name, histogram in sorted(commands.items())}
+        result['storage_calls'] = {name: histogram.snapshot() for name, histogram in sorted(storage_calls.items())}
+        return result
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            lines = [
+                '# TYPE dfs_uptime_seconds gauge', f'dfs_uptime_seconds {time.time() - self.started:.1f}',
+                '# TYPE dfs_active_connections gauge', f'dfs_active_connections {self.active_connections}',
+                '# TYPE dfs_connections_total counter', f'dfs_connections_total {self.connections}',
+                '# TYPE dfs_connection_errors_total counter', f'dfs_connection_errors_total {self.connection_errors}',
+                '# TYPE dfs_received_bytes_total counter', f'dfs_received_bytes_total {self.bytes_in}',
+                '# TYPE dfs_sent_bytes_total counter', f'dfs_sent_bytes_total {self.bytes_out}',
+            ]
+            commands = dict(self.commands)
+            storage_calls = dict(self.storage_calls)
+        for metric, label, histograms in (('dfs_command', 'command', commands),
+                                          ('dfs_storage_call', 'call', storage_calls)):
+            lines.append(f'# TYPE {metric}_seconds histogram')
+            errors = []
+            for name, histogram in sorted(histograms.items()):
+                name = name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                buckets, elapsed = histogram.cumulative()
+                for bound, count in buckets:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="{le}"}} {count}')
+                lines.append(f'{metric}_seconds_sum{{{label}="{name}"}} {elapsed:.6f}')
+                lines.append(f'{metric}_seconds_count{{{label}="{name}"}} {buckets[-1][1]}')
+                errors.append(f'{metric}_errors_total{{{label}="{name}"}} {histogram.errors}')
+            lines.append(f'# TYPE {metric}_errors_total counter')
+            lines.extend(errors)
+        return '\n'.join(lines) + '\n'
+
+    def _histogram(self, histograms, name):
+        if not isinstance(name, str):
+            name = 'other'
+        histogram = histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                if name not in histograms and len(histograms) >= MAX_LABELS:
+                    name = 'other'  # Keeps clients sending made-up commands from growing the table
+                histogram = histograms.setdefault(name, Histogram())
+        return histogram
+
+
+class MeteredSocket:
+    """Socket wrapper that adds the bytes it carries to the server's traffic counters.
+
+    With a tracer, the time spent in each call also counts as the current
+    request's socket phase.
+    """
+
+    def __init__(self, sock, metrics, tracer=None):
+        self.sock = sock
+        self.metrics = metrics
+        self.tracer = tracer
+
+    def recv(self, size):
+        started = time.perf_counter()
+        data = self.sock.recv(size)
+        self._count(started, received=len(data))
+        return data
+
+    def recv_into(self, buffer, size):
+        started = time.perf_counter()
+        received = self.sock.recv_into(buffer, size)
+        self._count(started, received=received)
+        return received
+
+    def sendall(self, data):
+        started = time.perf_counter()
+        self.sock.sendall(data)
+        self._count(started, sent=len(data))
+
+    def _count(self, started, received=0, sent=0):
+        if self.tracer:
+            self.tracer.add('socket', time.perf_counter() - started)
+        self.metrics.transferred(received, sent)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def serve_metrics(metrics, host, port):
+    """Serve GET /metrics in Prometheus text format from a daemon thread; returns the HTTP server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would flood the server log
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,104 @@
+"""
+Multipart upload sessions.
+
+A session lives entirely in storage under STAGING_PREFIX, so parts may arrive
+on any connection, engine or worker process:
+
+    .staging/multipart/{username}/{upload_id}/manifest    JSON with filename and creation time
+    .staging/multipart/{username}/{upload_id}/part-000001 one object per numbered part
+
+Completing a session composes the parts into "{username}/{filename}" and
+deletes the staging objects. Sessions idle for longer than the expiry are
+removed by cleanup().
+"""
+import json
+import string
+import time
+import uuid
+
+from storage_backend import STAGING_PREFIX, ObjectNotFound
+
+MULTIPART_PREFIX = f"{STAGING_PREFIX}multipart/"
+MAX_PARTS = 1024  # Upper bound on parts per upload (and on GCS composite components)
+SESSION_EXPIRY = 24 * 60 * 60  # Seconds an unfinished upload is kept
+
+
+class MultipartError(Exception):
+    """Raised for invalid multipart requests; the message is safe to show to clients"""
+
+
+class MultipartUploads:
+    """Multipart upload sessions stored in a storage backend"""
+
+    def __init__(self, storage, expiry=SESSION_EXPIRY):
+        self.storage = storage
+        self.expiry = expiry
+
+    def start(self, username, filename):
+        """Open a session for `filename` and return its upload id"""
+        upload_id = uuid.uuid4().hex
+        writer = self.storage.open_writer(self._manifest_name(username, upload_id))
+        writer.write(json.dumps({'filename': filename, 'created': time.time()}).encode())
+        writer.close()
+        return upload_id
+
+    def open_part(self, username, upload_id, part_number):
+        """Return a storage writer for one part of an existing session"""
+        if not isinstance(part_number, int) or not 1 <= part_number <= MAX_PARTS:
+            raise MultipartError(f"Part number must be between 1 and {MAX_PARTS}")
+        self._manifest(username, upload_id)
+        return self.storage.open_writer(self._part_name(username, upload_id, part_number))
+
+    def complete(self, username, upload_id, part_count):
+        """Compose parts 1..part_count into the target file; returns (filename, ObjectInfo)"""
+        manifest = self._manifest(username, upload_id)
+        prefix = self._session_prefix(username, upload_id)
+        parts = sorted(info.name for info in self.storage.list(f"{prefix}part-"))
+        expected = [self._part_name(username, upload_id, number) for number in range(1, part_count + 1)]
+        if parts != expected:
+            raise MultipartError(f"Expected {part_count} parts, server has {len(parts)}")
+        info = self.storage.compose(parts, f"{username}/{manifest['filename']}")
+        self.abort(username, upload_id)
+        return manifest['filename'], info
+
+    def abort(self, username, upload_id):
+        """Delete every staged object of a session"""
+        self._delete_prefix(self._session_prefix(username, upload_id))
+
+    def cleanup(self):
+        """Delete sessions whose newest object is older than the expiry; returns how many"""
+        newest = {}
+        for info in self.storage.list(MULTIPART_PREFIX):
+            session = info.name.rsplit('/', 1)[0]
+            updated = info.updated.timestamp() if info.updated else time.time()
+            newest[session] = max(newest.get(session, 0), updated)
+        expired = [session for session, updated in newest.items() if time.time() - updated > self.expiry]
+        for session in expired:
+            self._delete_prefix(f"{session}/")
+        return len(expired)
+
+    def _manifest(self, username, upload_id):
+        try:
+            name = self._manifest_name(username, upload_id)
+            info = self.storage.stat(name)
+            return json.loads(self.storage.read_range(name, 0, info.size))
+        except ObjectNotFound:
+            raise MultipartError("Unknown upload id") from None
+
+    def _delete_prefix(self, prefix):
+        for info in list(self.storage.list(prefix)):
+            try:
+                self.storage.delete(info.name)
+            except ObjectNotFound:
+                pass
+
+    def _session_prefix(self, username, upload_id):
+        if not isinstance(upload_id, str) or not upload_id or not set(upload_id) <= set(string.hexdigits):
+            raise MultipartError("Unknown upload id")
+        return f"{MULTIPART_PREFIX}{username}/{upload_id}/"
+
+    def _manifest_name(self, username, upload_id):
+        return f"{self._session_prefix(username, upload_id)}manifest"
+
+    def _part_name(self, username, upload_id, part_number):
+        return f"{self._session_prefix(username, upload_id)}part-{part_number:06d}"
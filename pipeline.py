@@ -0,0 +1,72 @@
+"""
+Request pipelining for one client connection.
+
+Clients may tag requests with an 'id' and send more before the replies arrive.
+Independent metadata commands are run concurrently on a shared executor and
+their replies carry the request id, so they can complete in any order. Commands
+that stream raw bytes wait until every earlier request of the connection has
+replied, which keeps file data from interleaving with other replies.
+"""
+from concurrent.futures import wait
+from threading import BoundedSemaphore, Lock
+
+PIPELINED_COMMANDS = {'list', 'view', 'delete', 'stat', 'batch_stat', 'batch_delete', 'cache_stats', 'scheduler',
+                      'stats', 'trace'}
+MAX_IN_FLIGHT = 64  # Requests of one connection running at once; reading pauses beyond this
+
+
+class RequestPipeline:
+    """In-flight requests of one connection"""
+
+    def __init__(self, channel, executor, logger, max_in_flight=MAX_IN_FLIGHT):
+        self.channel = channel
+        self.executor = executor
+        self.logger = logger
+        self._send_lock = Lock()
+        self._slots = BoundedSemaphore(max_in_flight)
+        self._in_flight = set()
+        self._lock = Lock()
+
+    def submit(self, handler, request_id, *args):
+        """Run handler(reply_channel, *args) on the executor"""
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(handler, self.reply_channel(request_id), *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_flight.add(future)
+        future.add_done_callback(self._finished)
+
+    def drain(self):
+        """Block until every submitted request has finished"""
+        with self._lock:
+            pending = list(self._in_flight)
+        wait(pending)
+
+    def reply_channel(self, request_id):
+        return _ReplyChannel(self.channel, request_id, self._send_lock)
+
+    def _finished(self, future):
+        with self._lock:
+            self._in_flight.discard(future)
+        self._slots.release()
+        if not future.cancelled() and future.exception():
+            self.logger.error(f"Pipelined request failed: {future.exception()}")
+
+
+class _ReplyChannel:
+    """Channel whose replies carry a request id and never interleave with other replies"""
+
+    def __init__(self, channel, request_id, send_lock):
+        self.channel = channel
+        self.request_id = request_id
+        self.send_lock = send_lock
+
+    def send_message(self, data):
+        with self.send_lock:
+            self.channel.send_message(dict(data, id=self.request_id))
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
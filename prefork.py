@@ -0,0 +1,72 @@
+"""
+Pre-fork supervisor: runs several server worker processes on one port.
+
+Each worker builds its own server and binds the port with SO_REUSEPORT, so the
+kernel spreads incoming connections across processes and TLS work across cores.
+"""
+import os
+import signal
+import socket
+import time
+
+
+def run_workers(count, serve, on_tick=None, interval=15):
+    """Fork `count` workers running serve(index) and respawn any that exit until interrupted.
+
+    A respawned worker gets the index of the one it replaces. `on_tick` is
+    called in the supervisor every `interval` seconds.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+    children = {}  # pid -> worker index
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(index)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"Worker {os.getpid()} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    for index in range(count):
+        spawn(index)
+    print(f"Started {count} worker processes")
+
+    next_tick = time.monotonic() + interval
+    try:
+        while True:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid and pid in children:
+                index = children.pop(pid)
+                print(f"Worker {pid} exited with status {status}, restarting")
+                spawn(index)
+            if on_tick and time.monotonic() >= next_tick:
+                on_tick()
+                next_tick = time.monotonic() + interval
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("\nShutting down workers...")
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -0,0 +1,203 @@
+"""
+Wire protocol shared by the file transfer server and client.
+
+A client opts in to framing by sending HANDSHAKE_MAGIC followed by the highest
+protocol version it speaks (one byte). The server answers with the magic and
+the version it accepted. From then on every control message is a 4-byte
+big-endian length followed by that many bytes of UTF-8 JSON. Raw file data
+follows the message that announces its size and is read with exact reads.
+
+Connections whose first byte is '{' come from legacy clients that send bare
+JSON documents; they are served through LegacyChannel.
+"""
+import json
+import socket
+import ssl
+import struct
+
+HANDSHAKE_MAGIC = b'DFSP'
+PROTOCOL_VERSION = 1
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024  # Upper bound for a single control message
+SENDFILE_BLOCK_SIZE = 1024 * 1024  # Read size when a file cannot be sent zero-copy
+
+_LENGTH = struct.Struct('!I')
+FRAME_HEADER_SIZE = _LENGTH.size
+
+
+class ProtocolError(Exception):
+    """Raised when the peer violates the wire protocol"""
+
+
+class Channel:
+    """Base wrapper around a connected (TLS) socket"""
+
+    legacy = False
+    version = 0  # Negotiated protocol version, 0 for legacy JSON
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def recv_exact(self, size):
+        """Read exactly `size` bytes, or fewer if the peer closed the connection"""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.recv_into(view[received:], size - received)
+            if not count:
+                return bytes(buffer[:received])
+            received += count
+        return bytes(buffer)
+
+    def recv_into(self, buffer, size):
+        return self.sock.recv_into(buffer, size)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        """Send `count` bytes of a file from `offset`; zero-copy unless the socket is TLS-wrapped"""
+        if isinstance(self.sock, socket.socket) and not isinstance(self.sock, ssl.SSLSocket):
+            return self.sock.sendfile(file, offset, count)
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            data = file.read(SENDFILE_BLOCK_SIZE if count is None else min(SENDFILE_BLOCK_SIZE, count - sent))
+            if not data:
+                break
+            self.sock.sendall(data)
+            sent += len(data)
+        return sent
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+
+class FramedChannel(Channel):
+    """Length-prefixed JSON messages (protocol version 1)"""
+
+    def send_message(self, data):
+        payload = json.dumps(data).encode()
+        self.sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+    def recv_message(self):
+        """Return the next message, or None if the peer closed the connection"""
+        header = self.recv_exact(_LENGTH.size)
+        if len(header) < _LENGTH.size:
+            return None
+        length = frame_length(header)
+        payload = self.recv_exact(length)
+        if len(payload) < length:
+            return None
+        return json.loads(payload)
+
+
+class LegacyChannel(Channel):
+    """Bare JSON documents as sent by clients that predate framing"""
+
+    legacy = True
+
+    def __init__(self, sock, initial=b''):
+        super().__init__(sock)
+        self._buffer = bytearray(initial)  # Bytes received but not yet consumed
+        self._decoder = json.JSONDecoder()
+
+    def send_message(self, data):
+        self.sock.sendall(json.dumps(data).encode())
+
+    def recv_message(self):
+        """Return the next JSON document, keeping any bytes that follow it buffered"""
+        while True:
+            message = self.next_buffered()
+            if message is not None:
+                return message
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return None
+            self.feed(chunk)
+
+    def feed(self, data):
+        """Append bytes received from the socket by the caller"""
+        self._buffer += data
+
+    def next_buffered(self):
+        """Pop the next complete JSON document from the buffer, or return None"""
+        if not self._buffer:
+            return None
+        text = self._buffer.decode(errors='replace')
+        stripped = text.lstrip()
+        try:
+            message, end = self._decoder.raw_decode(stripped)
+        except json.JSONDecodeError:
+            return None
+        del self._buffer[:len(text[:len(text) - len(stripped) + end].encode())]
+        return message
+
+    def recv(self, size):
+        if self._buffer:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer, size):
+        if self._buffer:
+            count = min(size, len(self._buffer))
+            buffer[:count] = self._buffer[:count]
+            del self._buffer[:count]
+            return count
+        return self.sock.recv_into(buffer, size)
+
+
+def set_nodelay(sock):
+    """Send writes immediately instead of holding small ones back (Nagle's algorithm).
+
+    A request and the file data after it go out as separate writes; with Nagle
+    the second one waits for the peer's delayed ACK, adding ~40 ms per exchange.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def client_handshake(sock, version=PROTOCOL_VERSION):
+    """Offer framing to the server and return the FramedChannel it accepted"""
+    sock.sendall(HANDSHAKE_MAGIC + bytes([version]))
+    channel = FramedChannel(sock)
+    reply = channel.recv_exact(len(HANDSHAKE_MAGIC) + 1)
+    if len(reply) != len(HANDSHAKE_MAGIC) + 1 or reply[:-1] != HANDSHAKE_MAGIC:
+        raise ProtocolError("Server does not support framed protocol")
+    channel.version = reply[-1]
+    return channel
+
+
+def frame_length(header):
+    """Decode a frame length prefix, rejecting oversized messages"""
+    (length,) = _LENGTH.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Message of {length} bytes exceeds limit")
+    return length
+
+
+def negotiate_version(offer):
+    """Validate a client handshake (magic plus version byte) and return the version to use"""
+    if len(offer) != len(HANDSHAKE_MAGIC) + 1 or offer[:-1] != HANDSHAKE_MAGIC or offer[-1] < 1:
+        raise ProtocolError("Unrecognised protocol handshake")
+    return min(offer[-1], PROTOCOL_VERSION)
+
+
+def server_handshake(sock):
+    """Detect the client protocol from its first bytes and return the matching channel"""
+    first = sock.recv(1)
+    if not first:
+        return None
+    if first == b'{':
+        return LegacyChannel(sock, first)
+    channel = FramedChannel(sock)
+    channel.version = negotiate_version(first + channel.recv_exact(len(HANDSHAKE_MAGIC)))
+    sock.sendall(HANDSHAKE_MAGIC + bytes([channel.version]))
+    return channel
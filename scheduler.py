@@ -0,0 +1,218 @@
+"""
+Fair-share scheduling of bulk transfers.
+
+Uploads and downloads ("streams") take a slot before they touch storage: at
+most `max_streams` run at once server-wide and `max_user_streams` per user.
+When slots are scarce the next one goes to the waiting user with the fewest
+streams running, so one user's many transfers cannot starve others. The file
+data of each stream is paced by a per-user token bucket. Metadata commands
+(list, view, stat, delete, ...) take no slot and are never paced, so they are
+not queued behind bulk transfers.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import count
+from threading import Condition, Lock
+
+BULK_COMMANDS = {'upload', 'download', 'dedup_upload', 'multipart_part', 'batch_download'}
+MAX_STREAMS = 32  # Bulk transfers running at once across all users
+MAX_USER_STREAMS = 8  # Bulk transfers running at once per user
+THROTTLE_BLOCK_SIZE = 256 * 1024  # Largest piece of a sendfile paced as one unit
+
+
+class TokenBucket:
+    """Byte budget refilled at `rate` bytes/s up to `burst` bytes; a rate of 0 means unlimited"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waited = 0.0  # Seconds callers spent throttled
+        self._lock = Lock()
+
+    def consume(self, amount):
+        """Take `amount` tokens, sleeping for as long as that overdraws the bucket"""
+        with self._lock:
+            if self.rate <= 0:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            # Concurrent streams of a user share the debt, so each waits its turn
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+    def configure(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst or rate
+            self.tokens = min(self.tokens, self.burst)
+
+
+class TransferScheduler:
+    """Stream slots and bandwidth limits for bulk transfers"""
+
+    def __init__(self, max_streams=MAX_STREAMS, max_user_streams=MAX_USER_STREAMS, user_rate=0, user_burst=0):
+        self.max_streams = max_streams
+        self.max_user_streams = max_user_streams
+        self.user_rate = user_rate  # Default bytes/s per user, 0 for unlimited
+        self.user_burst = user_burst  # Bytes a user may send above the rate at once (default: one second's worth)
+        self.user_rates = {}  # username -> bytes/s overriding user_rate
+        self.active = 0
+        self.waits = 0  # Streams that had to wait for a slot
+        self._user_streams = defaultdict(int)
+        self._user_bytes = defaultdict(int)
+        self._buckets = {}  # username -> TokenBucket
+        self._waiting = []  # (ticket, username) in arrival order
+        self._tickets = count()
+        self._condition = Condition()
+
+    @contextmanager
+    def stream(self, username):
+        """Hold a stream slot for `username` while the block runs"""
+        self._acquire(username)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._user_streams[username] -= 1
+                if not self._user_streams[username]:
+                    del self._user_streams[username]
+                self._condition.notify_all()
+
+    def throttled(self, channel, username):
+        """Wrap a channel so the file data it carries counts against the user's bandwidth"""
+        return ThrottledChannel(channel, self._bucket(username), self, username)
+
+    def configure(self, **limits):
+        """Change limits at runtime; keys are max_streams, max_user_streams, user_rate, user_burst, user_rates"""
+        for key, value in limits.items():
+            if key == 'user_rates':
+                if not isinstance(value, dict) or not all(
+                        isinstance(rate, int) and rate >= 0 for rate in value.values()):
+                    raise ValueError("user_rates must map usernames to bytes per second")
+            elif key not in ('max_streams', 'max_user_streams', 'user_rate', 'user_burst'):
+                raise ValueError(f"Unknown limit: {key}")
+            elif not isinstance(value, int) or value < 0 or (key.startswith('max_') and value == 0):
+                raise ValueError(f"Invalid value for {key}")
+        with self._condition:
+            for key, value in limits.items():
+                if key == 'user_rates':
+                    self.user_rates.update(value)
+                else:
+                    setattr(self, key, value)
+            for username, bucket in self._buckets.items():
+                bucket.configure(self._user_rate(username), self.user_burst)
+            self._condition.notify_all()  # Raised caps may let waiters start
+
+    def stats(self):
+        with self._condition:
+            users = set(self._user_streams) | set(self._user_bytes)
+            return {
+                'max_streams': self.max_streams,
+                'max_user_streams': self.max_user_streams,
+                'user_rate': self.user_rate,
+                'user_burst': self.user_burst,
+                'user_rates': dict(self.user_rates),
+                'active_streams': self.active,
+                'waiting_streams': len(self._waiting),
+                'slot_waits': self.waits,
+                'users': {username: {
+                    'streams': self._user_streams.get(username, 0),
+                    'bytes': self._user_bytes[username],
+                    'throttled_seconds': round(self._buckets[username].waited, 3) if username in self._buckets else 0
+                } for username in sorted(users)}
+            }
+
+    def _acquire(self, username):
+        with self._condition:
+            ticket = next(self._tickets)
+            self._waiting.append((ticket, username))
+            if self._next_ticket() != ticket:
+                self.waits += 1
+                while self._next_ticket() != ticket:
+                    self._condition.wait()
+            self._waiting.remove((ticket, username))
+            self.active += 1
+            self._user_streams[username] += 1
+            self._condition.notify_all()  # Another waiter may be eligible too
+
+    def _next_ticket(self):
+        """Ticket of the waiter that may start now, or None if none can"""
+        if self.active >= self.max_streams:
+            return None
+        eligible = [(self._user_streams.get(username, 0), ticket) for ticket, username in self._waiting
+                    if self._user_streams.get(username, 0) < self.max_user_streams]
+        return min(eligible)[1] if eligible else None
+
+    def _bucket(self, username):
+        with self._condition:
+            bucket = self._buckets.get(username)
+            if bucket is None:
+                bucket = self._buckets[username] = TokenBucket(self._user_rate(username), self.user_burst)
+            return bucket
+
+    def _user_rate(self, username):
+        return self.user_rates.get(username, self.user_rate)
+
+    def _count(self, username, amount):
+        with self._condition:
+            self._user_bytes[username] += amount
+
+
+class ThrottledChannel:
+    """Channel whose raw file data is paced by a token bucket; messages pass through unpaced"""
+
+    def __init__(self, channel, bucket, scheduler, username):
+        self.channel = channel
+        self.bucket = bucket
+        self.scheduler = scheduler
+        self.username = username
+
+    def recv(self, size):
+        data = self.channel.recv(size)
+        self._pace(len(data))
+        return data
+
+    def recv_exact(self, size):
+        data = self.channel.recv_exact(size)
+        self._pace(len(data))
+        return data
+
+    def recv_into(self, buffer, size):
+        received = self.channel.recv_into(buffer, size)
+        self._pace(received)
+        return received
+
+    def sendall(self, data):
+        self._pace(len(data))
+        self.channel.sendall(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        if count is None:
+            count = max(0, file.seek(0, 2) - offset)
+        if self.bucket.rate <= 0:
+            self.scheduler._count(self.username, count)
+            return self.channel.sendfile(file, offset, count)
+        sent = 0
+        while sent < count:
+            block = min(THROTTLE_BLOCK_SIZE, count - sent)
+            self._pace(block)
+            done = self.channel.sendfile(file, offset + sent, block)
+            if not done:
+                break
+            sent += done
+        return sent
+
+    def _pace(self, amount):
+        if amount:
+            self.scheduler._count(self.username, amount)
+            self.bucket.consume(amount)
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
@@ -1,67 +1,141 @@
+import argparse
+import codecs
+import fnmatch
+import itertools
+import os
+import re
 import socket
 import ssl
 import json
-import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from threading import Thread, Lock
 import logging
 import time
-from google.cloud import storage
-import os
 from dotenv import load_dotenv
+from compression import (
+    CODECS, IDENTITY, SAMPLE_SIZE, FrameReader, FrameWriter, GzipWriter, choose_codec, gunzip_chunks, negotiate
+)
 from database import UserDatabase
+from dedup import MAX_CHUNK_SIZE, VerifyingWriter, chunk_name, is_digest
+from async_server import AsyncServerEngine
+from cache import DiskCache, PreviewCache
+from listing import ListingIndex
+from metrics import MeteredSocket, ServerMetrics, serve_metrics
+from multipart import MultipartError, MultipartUploads
+from pipeline import PIPELINED_COMMANDS, RequestPipeline
+from prefork import run_workers
+from scheduler import BULK_COMMANDS, MAX_STREAMS, MAX_USER_STREAMS, TransferScheduler
+from session_registry import SessionRegistry, SqliteSessionRegistry
+from spool import SPOOL_WORKERS, WriteBehindBackend
+from protocol import ProtocolError, server_handshake, set_nodelay
+from tokens import TOKEN_TTL, SessionTokens, load_secret
+from tracing import SLOW_THRESHOLD, Tracer
+from storage_backend import COPY_CHUNK_SIZE, GCS_DATA_CALLS, ObjectNotFound, StorageError, create_backend
+from transfer import (
+    receive_to_writer, iter_ranges, iter_slices,
+    DOWNLOAD_SLICE_SIZE, DOWNLOAD_PARALLELISM, SLICED_DOWNLOAD_THRESHOLD
+)
 load_dotenv()
 
+PREVIEW_SIZE = 1024  # Bytes returned by the view command
+MULTIPART_CLEANUP_INTERVAL = 60 * 60  # Seconds between sweeps of abandoned multipart uploads
+DIRECTORY_COPY_PARALLELISM = 16  # Concurrent storage copies when copying or moving a directory
+
+def create_ssl_context(certfile, keyfile):
+    """Server TLS context; OpenSSL's default session tickets let returning clients skip the full handshake"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
+
 class FileTransferServer:
-    def __init__(self, host='localhost', port=9999, storage_root='server_storage', certfile='server.crt', keyfile='server.key'):
+    def __init__(self, host='localhost', port=9999, storage_root='server_storage', certfile='server.crt', keyfile='server.key',
+                 download_slice_size=DOWNLOAD_SLICE_SIZE, download_parallelism=DOWNLOAD_PARALLELISM,
+                 sliced_download_threshold=SLICED_DOWNLOAD_THRESHOLD, preview_cache_bytes=32 * 1024 * 1024,
+                 preview_cache_ttl=5,
+                 backlog=128, sessions=None, reuse_port=False, listing_ttl=60,
+                 disk_cache_bytes=1024 ** 3, disk_cache_entry_bytes=256 * 1024 ** 2, storage=None,
+                 command_workers=16, store_compressed=False, write_behind=False, spool_workers=SPOOL_WORKERS,
+                 max_streams=MAX_STREAMS, max_user_streams=MAX_USER_STREAMS, user_rate=0, user_burst=0,
+                 admin_users=('admin',), ssl_context=None, token_secret=None, token_ttl=TOKEN_TTL, metrics_port=0,
+                 slow_log='slow.log', slow_threshold=SLOW_THRESHOLD, profile_rate=0.0):
         self.host = host
         self.port = port
+        self.backlog = backlog  # Pending connections the kernel queues before refusing
+        self.download_slice_size = download_slice_size  # Byte range fetched per parallel GCS read
+        self.download_parallelism = download_parallelism  # Concurrent GCS reads per large download
+        self.sliced_download_threshold = sliced_download_threshold  # Below this a single read stream is used
         self.storage_root = Path(storage_root)
         self.certfile = certfile
         self.keyfile = keyfile
-        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        self.ssl_context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+        # Pre-fork workers share one context so tickets issued by any worker resume on all of them
+        self.ssl_context = ssl_context or create_ssl_context(self.certfile, self.keyfile)
         self.running = False
         self.user_db=UserDatabase()
 
         if not self.storage_root.exists():
             self.storage_root.mkdir(parents=True)
+        # Tokens let clients reconnect without another password check
+        self.tokens = SessionTokens(token_secret or load_secret(self.storage_root / 'token.key'), token_ttl)
+        self.storage = storage or create_backend('gcs')  # Where file contents live
+        self.metrics = ServerMetrics()  # Command latencies, storage calls, traffic and connections
+        self.metrics_port = metrics_port  # HTTP port of the Prometheus endpoint, 0 to disable it
+        # Request ids, phase timings, the slow request log and sampled profiles
+        self.tracer = Tracer(slow_log, slow_threshold, profile_rate, self.storage_root / 'profiles')
+        self.storage.call_observer = self._storage_call
+        if write_behind:
+            # Acknowledge uploads once spooled to local disk and upload them in the background
+            self.storage = WriteBehindBackend(self.storage, self.storage_root / 'spool', spool_workers,
+                                              on_flush=self._spool_flushed, logger=logging.getLogger())
+        # Read-through cache of hot blobs for remote storage, disabled when the budget is 0
+        self.disk_cache = None
+        if disk_cache_bytes > 0 and self.storage.remote:
+            self.disk_cache = DiskCache(self.storage_root / 'cache', disk_cache_bytes, disk_cache_entry_bytes)
 
-        self.client_activities = {}  # Dictionary to track client activities
-        self.client_activities_lock = Lock()  # Lock for thread-safe updates to client_activities
         self.client_sockets = []  # List to track client sockets
         self.client_sockets_lock = Lock()  # Lock for thread-safe updates to client_sockets
-        self.logged_in_users = {}  # Set to track logged-in users
-        self.logged_in_users_lock = Lock()  # Lock for thread-safe updates to logged_in_users
+        self.sessions = sessions or SessionRegistry()  # Logged-in users and client activities
+        self.reuse_port = reuse_port  # Share the port with sibling worker processes
+        self.monitor_activities = True  # Print client activities periodically
+        # Previews keyed by (blob name, generation), expired after a few seconds in case another worker changed the file
+        self.preview_cache = PreviewCache(preview_cache_bytes, preview_cache_ttl)
+        self.listing = ListingIndex(self._load_listing, ttl=listing_ttl)  # Per-user file metadata for list
+        self.multipart = MultipartUploads(self.storage)  # Uploads sent in parts over several connections
+        # Keep compressible uploads gzip-encoded in storage when the backend can record that
+        self.store_compressed = store_compressed and self.storage.stores_content_encoding
+        # Stream slots and per-user bandwidth for uploads and downloads
+        self.scheduler = TransferScheduler(max_streams, max_user_streams, user_rate, user_burst)
+        self.admin_users = set(admin_users)  # Users allowed to change server settings at runtime
+        # Runs pipelined metadata commands of all connections
+        self.command_pool = ThreadPoolExecutor(max_workers=command_workers, thread_name_prefix='pipeline')
         logging.basicConfig(
             filename='server.log',
             level=logging.INFO,
             format='%(asctime)s - %(levelname)s - %(message)s'
         )
         self.logger = logging.getLogger()
-        self.gcs_client = storage.Client.from_service_account_json(
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
-        )
-        self.gcs_bucket_name = os.environ.get("GCS_BUCKET_NAME", "your-bucket-name")  
-        self.gcs_bucket = self.gcs_client.bucket(self.gcs_bucket_name)
 
     def start(self):
         """Start the server"""
         raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket = self.ssl_context.wrap_socket(raw_socket, server_side=True)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
         self.running = True
 
         print(f"Server started with SSL on {self.host}:{self.port}")
         self.logger.info(f"Server started on {self.host}:{self.port}")
 
-        Thread(target=self.monitor_client_activities, daemon=True).start()  # Start monitoring client activities
+        self.start_background_tasks()
 
         try:
             while self.running:
                 client_socket, addr = self.server_socket.accept()
+                set_nodelay(client_socket)
                 self.logger.info(f"Accepted connection from {addr}")
                 with self.client_sockets_lock:
                     self.client_sockets.append(client_socket)  # Add client socket to list
@@ -73,6 +147,16 @@ class FileTransferServer:
         finally:
             self.logger.info("Server stopped.")
 
+    def start_background_tasks(self):
+        """Start the activity monitor, the multipart upload janitor, storage background work and the metrics endpoint"""
+        if self.monitor_activities:
+            Thread(target=self.monitor_client_activities, daemon=True).start()  # Start monitoring client activities
+        Thread(target=self.clean_multipart_uploads, daemon=True).start()
+        self.storage.start()
+        if self.metrics_port:
+            serve_metrics(self.metrics, self.host, self.metrics_port)
+            self.logger.info(f"Serving metrics on http://{self.host}:{self.metrics_port}/metrics")
+
     def stop(self):
         """Stop the server and close all client connections"""
         self.running = False
@@ -84,213 +168,957 @@ class FileTransferServer:
                     self.logger.error(f"Error closing client socket: {e}")
         if self.server_socket:
             self.server_socket.close()
+        self.command_pool.shutdown(wait=False, cancel_futures=True)
+        self.storage.stop()
+        self.user_db.flush_logins()
 
     def handle_client(self, client_socket, addr):
         """Handle client requests"""
+        username = None
+        pipeline = None
+        failed = False
+        self.metrics.connection_opened()
         try:
-            with self.client_activities_lock:
-                self.client_activities[addr] = "Connected, authenticating..."
+            self.sessions.set_activity(addr, "Connected, authenticating...")
             self.logger.info(f"Client {addr} connected")
 
+            # Negotiate framed or legacy JSON protocol
+            channel = server_handshake(MeteredSocket(client_socket, self.metrics, self.tracer))
+            if not channel:
+                return
+
             # Receive authentication data
-            auth_data = self._receive_data(client_socket)
-            username = auth_data.get('username')
-            password = auth_data.get('password')
-            
-            if not self.authenticate(username, password):
-                self.logger.warning(f"Authentication failed for {addr}")
-                self._send_data(client_socket, {'status': 'failed', 'message': 'Authentication failed'})
-                client_socket.close()
+            auth_data = self._receive_data(channel)
+            if not auth_data:
+                return
+            username = self.login(channel, addr, auth_data)
+            if not username:
                 return
-            with self.logged_in_users_lock:
-                if username in self.logged_in_users:
-                    self.logger.warning(f"User {username} is already logged in from {self.logged_in_users[username]}")
-                    self._send_data(client_socket, {'status': 'failed', 'message': 'User already logged in'})
-                    client_socket.close()
-                    return
-    
-                # Add user to logged_in_users
-                self.logged_in_users[username] = addr
-            self.logger.info(f"Client {username} authenticated from {addr}")
-            self._send_data(client_socket, {'status': 'success'})
 
+            pipeline = RequestPipeline(channel, self.command_pool, self.logger)
             while self.running:
-                request = self._receive_data(client_socket)
+                request = self._receive_data(channel)
                 if not request:
                     break
-                
-                command = request.get('command')
-                filename = request.get('filename', '')
-                with self.client_activities_lock:
-                    self.client_activities[addr] = f"Executing command: {command} for file: {filename}"
-                self.logger.info(f"{addr}: Executing command '{command}' on file '{filename}'")
-
-                if command == 'list':
-                    self.handle_list(client_socket, username)
-                elif command == 'upload':
-                    self.handle_upload(client_socket, username, filename, request.get('size'))
-                elif command == 'download':
-                    self.handle_download(client_socket, username, filename)
-                elif command == 'view':
-                    self.handle_view(client_socket, username, filename)
-                elif command == 'delete':
-                    self.handle_delete(client_socket, username, filename)
-                else:
-                    self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid command'})
-        except (socket.error, json.JSONDecodeError) as e:
+                self.handle_request(channel, username, addr, request, pipeline)
+        except (socket.error, json.JSONDecodeError, ProtocolError) as e:
             self.logger.error(f"Error handling client {addr}: {e}")
+            failed = True
         finally:
-            # Get username before removing from activities
-            username = None
-            for addr_key, activity in self.client_activities.items():
-                if addr_key == addr:
-                    # Try to extract username from activity logging
-                    for user, address in self.logged_in_users.items():
-                        if address == addr:
-                            username = user
-                            break
-            with self.client_activities_lock:
-                self.client_activities.pop(addr, None)
+            if pipeline:
+                pipeline.drain()
             with self.client_sockets_lock:
                 if client_socket in self.client_sockets:
                     self.client_sockets.remove(client_socket)
-            if username:
-                with self.logged_in_users_lock:
-                    if username in self.logged_in_users:
-                        self.logged_in_users.pop(username)
-                        self.logger.info(f"User {username} logged out")
-            self.logger.info(f"Client {addr} disconnected")
+            self.end_session(username, addr)
             client_socket.close()
+            self.metrics.connection_closed(failed)
+
+    def login(self, channel, addr, auth_data):
+        """Authenticate a connection and register the session; returns the username or None"""
+        with self.tracer.request('login', auth_data.get('username')), self.metrics.command('login'):
+            return self._login(channel, addr, auth_data)
+
+    def _login(self, channel, addr, auth_data):
+        username = auth_data.get('username')
+        password = auth_data.get('password')
+        token = auth_data.get('token')
+
+        with self.tracer.span('auth'):
+            if token is not None:
+                # Proof of an earlier password login; the user database is not consulted
+                authenticated = username is not None and self.tokens.verify(token) == username
+            else:
+                authenticated = self.authenticate(username, password)
+        if not authenticated:
+            self.logger.warning(f"Authentication failed for {addr}")
+            self._send_data(channel, {'status': 'failed', 'message': 'Authentication failed'})
+            return None
+        # Compression codecs both sides support, in the server's order of preference
+        reply = {'status': 'success', 'codecs': negotiate(auth_data.get('codecs'))}
+        if token is None:
+            reply['token'], reply['token_expires'] = self.tokens.issue(username)
+        if auth_data.get('attach'):
+            # Extra connection of a logged-in user, e.g. for parallel multipart uploads
+            if not self.sessions.is_logged_in(username):
+                self._send_data(channel, {'status': 'failed', 'message': 'No active session to attach to'})
+                return None
+            self.logger.info(f"Client {username} attached connection from {addr}")
+            self._send_data(channel, reply)
+            return username
+        holder = self.sessions.claim(username, addr)
+        if holder is not None:
+            self.logger.warning(f"User {username} is already logged in from {holder}")
+            self._send_data(channel, {'status': 'failed', 'message': 'User already logged in'})
+            return None
+        self.logger.info(f"Client {username} authenticated from {addr}{' with a session token' if token else ''}")
+        self._send_data(channel, reply)
+        return username
+
+    def handle_request(self, channel, username, addr, request, pipeline=None):
+        """Run one request, concurrently with others if it carries an id and touches only metadata"""
+        request_id = request.get('id')
+        if pipeline:
+            if request_id is not None and request.get('command') in PIPELINED_COMMANDS:
+                pipeline.submit(self.execute_request, request_id, username, addr, request)
+                return
+            # Other commands own the connection once earlier requests have replied
+            pipeline.drain()
+            if request_id is not None:
+                channel = pipeline.reply_channel(request_id)
+        self.execute_request(channel, username, addr, request)
+
+    def execute_request(self, channel, username, addr, request):
+        """Dispatch one command from an authenticated client"""
+        command = request.get('command')
+        filename = request.get('filename', '')
+        self.sessions.set_activity(addr, f"Executing command: {command} for file: {filename}")
+        with self.tracer.request(command, username, filename) as trace, self.metrics.command(command):
+            self.logger.info(f"{addr}: [{trace.id}] Executing command '{command}' on file '{filename}'")
+            if command in BULK_COMMANDS:
+                # Bulk transfers wait for a fair share of stream slots and are paced per user
+                with self.scheduler.stream(username):
+                    trace.add('queue', time.perf_counter() - trace.started)  # Waiting for a stream slot
+                    self.dispatch_command(self.scheduler.throttled(channel, username), username, request)
+            else:
+                self.dispatch_command(channel, username, request)
+
+    def dispatch_command(self, channel, username, request):
+        """Run the handler of one command"""
+        command = request.get('command')
+        filename = request.get('filename', '')
+        if command == 'list':
+            self.handle_list(channel, username, request.get('cursor'), request.get('page_size'),
+                             request.get('refresh', False))
+        elif command == 'upload':
+            self.handle_upload(channel, username, filename, request.get('size'), request.get('encoding'))
+        elif command == 'download':
+            self.handle_download(channel, username, filename, request.get('offset', 0),
+                                 request.get('length'), request.get('generation'), request.get('known'),
+                                 request.get('accept_encoding'))
+        elif command == 'view':
+            self.handle_view(channel, username, filename)
+        elif command == 'stat':
+            self.handle_stat(channel, username, filename)
+        elif command == 'delete':
+            self.handle_delete(channel, username, filename)
+        elif command in ('copy', 'move', 'rename'):
+            self.handle_copy(channel, username, command, filename, request.get('destination'))
+        elif command == 'dedup_upload':
+            self.handle_dedup_upload(channel, username, filename, request.get('size'), request.get('chunks'))
+        elif command == 'multipart_start':
+            self.handle_multipart_start(channel, username, filename)
+        elif command == 'multipart_part':
+            self.handle_multipart_part(channel, username, request.get('upload_id'),
+                                       request.get('part_number'), request.get('size'))
+        elif command == 'multipart_complete':
+            self.handle_multipart_complete(channel, username, request.get('upload_id'), request.get('parts'))
+        elif command == 'multipart_abort':
+            self.handle_multipart_abort(channel, username, request.get('upload_id'))
+        elif command == 'batch_stat':
+            self.handle_batch_stat(channel, username, request.get('filenames'), request.get('pattern'))
+        elif command == 'batch_delete':
+            self.handle_batch_delete(channel, username, request.get('filenames'), request.get('pattern'))
+        elif command == 'batch_download':
+            self.handle_batch_download(channel, username, request.get('filenames'), request.get('pattern'))
+        elif command == 'cache_stats':
+            self.handle_cache_stats(channel)
+        elif command == 'scheduler':
+            self.handle_scheduler(channel, username, request.get('limits'))
+        elif command == 'stats':
+            self.handle_stats(channel, username)
+        elif command == 'trace':
+            self.handle_trace(channel, username, request.get('settings'))
+        else:
+            self._send_data(channel, {'status': 'failed', 'message': 'Invalid command'})
+
+    def end_session(self, username, addr):
+        """Forget a disconnected client and log its user out"""
+        self.sessions.clear_activity(addr)
+        if username and self.sessions.release(username, addr):
+            self.logger.info(f"User {username} logged out")
+        self.logger.info(f"Client {addr} disconnected")
 
     def authenticate(self, username, password):
         """Authenticate user against id_passwd.txt file"""
         return self.user_db.authenticate(username,password)
 
-    def handle_list(self, client_socket, username):
+    def handle_list(self, client_socket, username, cursor=None, page_size=None, refresh=False):
         """Handle list command"""
-        # user_dir = self.storage_root / username
-        # if not user_dir.exists():
-        #     user_dir.mkdir()
-        files = []
-        for blob in self.gcs_client.list_blobs(self.gcs_bucket_name, prefix=f"{username}/"):
-            files.append(blob.name.split("/")[-1])
-        self._send_data(client_socket, {'status': 'success', 'files': files})
-        # self._send_data(client_socket, {'status': 'success', 'files': files})
-
-    def handle_upload(self, client_socket, username, filename, size):
-        """Handle upload command"""
-        if not size or size <= 0:
+        # Pages larger than MAX_PAGE_SIZE are cut down to it by the listing index
+        if page_size is not None and (isinstance(page_size, bool) or not isinstance(page_size, int) or page_size < 1):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid page size'})
+            return
+        if cursor is not None and not isinstance(cursor, str):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid cursor'})
+            return
+        try:
+            if page_size is None:
+                # Legacy clients expect every name in a single reply
+                self._send_data(client_socket, {'status': 'success', 'files': self.listing.names(username, refresh)})
+                return
+            entries, next_cursor = self.listing.page(username, cursor, page_size, refresh)
+        except StorageError as e:
+            self.logger.error(f"Error listing files for {username}: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Error listing files'})
+            return
+        self._send_data(client_socket, {
+            'status': 'success',
+            'files': [entry['name'] for entry in entries],
+            'entries': entries,
+            'next_cursor': next_cursor
+        })
+
+    def _load_listing(self, username):
+        """Fetch a user's file metadata from storage for the listing index"""
+        prefix = f"{username}/"
+        return [self._listing_entry(info, prefix) for info in self.storage.list(prefix)]
+
+    def _spool_flushed(self, info):
+        """Record the final metadata of a write-behind upload once it reached storage"""
+        username = info.name.split('/', 1)[0]
+        self.preview_cache.invalidate(info.name)
+        self.listing.upsert(username, self._listing_entry(info, f"{username}/"))
+
+    def _storage_call(self, call, seconds, failed):
+        """Count a remote storage call in the metrics and the current request's trace"""
+        self.metrics.storage_call(call, seconds, failed)
+        self.tracer.add('storage_data' if call in GCS_DATA_CALLS else 'storage_meta', seconds, call)
+
+    def _listing_entry(self, info, prefix):
+        return {
+            'name': info.name[len(prefix):],
+            'size': info.data_size,
+            'updated': info.updated.isoformat() if info.updated else None,
+            'generation': info.generation
+        }
+
+    def handle_upload(self, client_socket, username, filename, size, encoding=None):
+        """Handle upload command; `encoding` names the codec of a framed, compressed upload"""
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
             self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid file size'})
             return
+        encoding = encoding or IDENTITY
+        if encoding != IDENTITY and encoding not in CODECS:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Unsupported encoding'})
+            return
         # user_dir = self.storage_root / username
         # if not user_dir.exists():
         #     user_dir.mkdir()
         # safe_filename = os.path.basename(filename)
         # file_path = user_dir / safe_filename
 
-        blob = self.gcs_bucket.blob(f"{username}/{filename}")
+        name = f"{username}/{filename}"
+        # The client only compresses data its sampling found compressible
+        store_gzip = self.store_compressed and encoding != IDENTITY
+        try:
+            writer = self.storage.open_writer(name, 'gzip', size) if store_gzip else self.storage.open_writer(name)
+        except StorageError as e:
+            self.logger.error(f"Error opening upload of '{filename}': {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+            return
+        if store_gzip:
+            writer = GzipWriter(writer)
 
-        received = 0
-        chunks = []
-        while received < size:
-            chunk = client_socket.recv(min(4096, size - received))
-            if not chunk:
-                break
-            chunks.append(chunk)
-            received += len(chunk)
+        # Stream socket data into storage through a bounded buffer
+        source = client_socket if encoding == IDENTITY else FrameReader(client_socket, encoding)
+        received, error = receive_to_writer(source, size, self.tracer.bind_writer(writer))
+        if source is not client_socket and received == size:
+            source.finish()
 
         if received != size:
             self.logger.warning(f"Upload error: Expected {size} bytes but received {received} for file '{filename}'")
             self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+        elif error:
+            self.logger.error(f"Error uploading file '{filename}' to storage: {error}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
         else:
-            blob.upload_from_string(b''.join(chunks))
+            self.preview_cache.invalidate(name)
+            self.listing.upsert(username, self._listing_entry(writer.info, f"{username}/"))
             self._send_data(client_socket, {'status': 'success'})
             self.logger.info(f"File '{filename}' uploaded by {username}")
      
-    def handle_download(self, client_socket, username, filename):
-        """Handle download command"""
-        safe_filename = os.path.basename(filename)
-        file_path = self.storage_root / username / safe_filename
-        safe_filename = os.path.basename(filename)
-        blob = self.gcs_bucket.blob(f"{username}/{filename}")
-
-        if blob.exists():
-            data = blob.download_as_bytes()
-            self._send_data(client_socket, {'status': 'success', 'size': len(data)})
-            client_socket.sendall(data)
+    def handle_dedup_upload(self, client_socket, username, filename, size, chunks):
+        """Handle dedup_upload command.
+
+        The client lists the file as [sha256, size] chunks; the server replies with
+        the digests its chunk store lacks, receives just those chunks back to back
+        and composes the file from the store.
+        """
+        if not filename or not isinstance(chunks, list) or not all(
+                isinstance(chunk, list) and len(chunk) == 2 and is_digest(chunk[0])
+                and isinstance(chunk[1], int) and 0 < chunk[1] <= MAX_CHUNK_SIZE for chunk in chunks):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid chunk list'})
+            return
+        if sum(chunk_size for _, chunk_size in chunks) != size:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Chunk sizes do not add up to the file size'})
+            return
+        if not chunks:
+            self.handle_upload(client_socket, username, filename, size)
+            return
+
+        sizes = dict(chunks)
+        if any(sizes[digest] != chunk_size for digest, chunk_size in chunks):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid chunk list'})
+            return
+        try:
+            stored = self.storage.stat_many([chunk_name(username, digest) for digest in sizes])
+        except StorageError as e:
+            self.logger.error(f"Error checking chunk store of {username}: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+            return
+        missing = []
+        for digest, chunk_size in sizes.items():
+            info = stored[chunk_name(username, digest)]
+            if isinstance(info, StorageError) or info.size != chunk_size:
+                missing.append(digest)
+        self._send_data(client_socket, {'status': 'ready', 'missing': missing})
+
+        for digest in missing:
+            try:
+                writer = VerifyingWriter(self.storage.open_writer(chunk_name(username, digest)), digest)
+            except StorageError as e:
+                self.logger.error(f"Error opening chunk {digest} of '{filename}': {e}")
+                raise ConnectionAbortedError(f"Dedup upload of '{filename}' aborted") from e
+            received, error = receive_to_writer(client_socket, sizes[digest], self.tracer.bind_writer(writer))
+            if received != sizes[digest] or error:
+                # The rest of the chunk stream cannot be skipped reliably, so drop the connection
+                self.logger.error(f"Error storing chunk {digest} of '{filename}': {error or 'connection closed'}")
+                raise ConnectionAbortedError(f"Dedup upload of '{filename}' aborted")
+
+        name = f"{username}/{filename}"
+        try:
+            info = self.storage.compose([chunk_name(username, digest) for digest, _ in chunks], name)
+        except StorageError as e:
+            self.logger.error(f"Error assembling '{filename}' from chunks: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+            return
+        self.preview_cache.invalidate(name)
+        self.listing.upsert(username, self._listing_entry(info, f"{username}/"))
+        sent = sum(sizes[digest] for digest in missing)
+        self._send_data(client_socket, {'status': 'success', 'sent': sent})
+        self.logger.info(f"File '{filename}' uploaded by {username} with dedup ({sent} of {size} bytes sent)")
+
+    def handle_multipart_start(self, client_socket, username, filename):
+        """Handle multipart_start command"""
+        if not filename:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid file name'})
+            return
+        try:
+            upload_id = self.multipart.start(username, filename)
+        except StorageError as e:
+            self.logger.error(f"Error starting multipart upload of '{filename}': {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+            return
+        self.logger.info(f"Multipart upload {upload_id} of '{filename}' started by {username}")
+        self._send_data(client_socket, {'status': 'success', 'upload_id': upload_id})
+
+    def handle_multipart_part(self, client_socket, username, upload_id, part_number, size):
+        """Handle multipart_part command"""
+        if not isinstance(size, int) or size <= 0:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid part size'})
+            return
+        try:
+            writer = self.multipart.open_part(username, upload_id, part_number)
+        except MultipartError as e:
+            self._send_data(client_socket, {'status': 'failed', 'message': str(e)})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error opening part {part_number} of upload {upload_id}: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+            return
+        self._send_data(client_socket, {'status': 'ready'})
+
+        received, error = receive_to_writer(client_socket, size, self.tracer.bind_writer(writer))
+
+        if received != size:
+            self.logger.warning(f"Part {part_number} of upload {upload_id}: expected {size} bytes but received {received}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+        elif error:
+            self.logger.error(f"Error storing part {part_number} of upload {upload_id}: {error}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
         else:
+            self._send_data(client_socket, {'status': 'success'})
+
+    def handle_multipart_complete(self, client_socket, username, upload_id, parts):
+        """Handle multipart_complete command"""
+        if not isinstance(parts, int) or parts <= 0:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid part count'})
+            return
+        try:
+            filename, info = self.multipart.complete(username, upload_id, parts)
+        except MultipartError as e:
+            self._send_data(client_socket, {'status': 'failed', 'message': str(e)})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error assembling multipart upload {upload_id}: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Upload failed'})
+            return
+        name = f"{username}/{filename}"
+        self.preview_cache.invalidate(name)
+        self.listing.upsert(username, self._listing_entry(info, f"{username}/"))
+        self._send_data(client_socket, {'status': 'success', 'size': info.size})
+        self.logger.info(f"File '{filename}' uploaded by {username} in {parts} parts")
+
+    def handle_multipart_abort(self, client_socket, username, upload_id):
+        """Handle multipart_abort command"""
+        try:
+            self.multipart.abort(username, upload_id)
+        except MultipartError as e:
+            self._send_data(client_socket, {'status': 'failed', 'message': str(e)})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error aborting multipart upload {upload_id}: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Abort failed'})
+            return
+        self._send_data(client_socket, {'status': 'success'})
+
+    def handle_download(self, client_socket, username, filename, offset=0, length=None, generation=None, known=None,
+                        accept_encoding=None):
+        """Handle download command.
+
+        `known` describes the client's local copy ({'generation', 'md5', 'crc32c'});
+        if it matches the stored object only the metadata is sent back.
+        `accept_encoding` lists codecs the client can decode; compressible data is
+        then sent as compressed frames.
+        """
+        offset = 0 if offset is None else offset
+        if not self._is_count(offset) or (length is not None and not self._is_count(length)):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid range'})
+            return
+        name = f"{username}/{filename}"
+        try:
+            info = self.storage.stat(name)
+        except ObjectNotFound:
             self._send_data(client_socket, {'status': 'failed', 'message': 'File not found'})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error reading metadata of '{filename}': {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Error reading file'})
+            return
 
-    def handle_view(self, client_socket, username, filename):
-        """Handle view command"""
-        # Sanitize filename to prevent path traversal
-        safe_filename = os.path.basename(filename)
-        blob = self.gcs_bucket.blob(f"{username}/{filename}")
+        if known and self._same_version(info, known):
+            self._send_data(client_socket, {
+                'status': 'not_modified',
+                'total_size': info.data_size,
+                'generation': info.generation,
+                'md5': info.md5,
+                'crc32c': info.crc32c
+            })
+            return
+
+        if generation and generation != info.generation:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'File has changed'})
+            return
+        if info.content_encoding == 'gzip':
+            self._send_gzipped_object(client_socket, username, filename, info, offset, length, accept_encoding)
+            return
+        if offset < 0 or offset > info.size or (length is not None and length < 0):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid range'})
+            return
+        end = info.size if length is None else min(info.size, offset + length)
+
+        header = {
+            'status': 'success',
+            'size': end - offset,
+            'offset': offset,
+            'total_size': info.size,
+            'generation': info.generation,
+            'md5': info.md5,
+            'crc32c': info.crc32c
+        }
+        self._send_object(client_socket, username, filename, info, offset, end, header, accept_encoding)
+
+    def _is_count(self, value):
+        """Whether a request field is a non-negative integer (JSON booleans excluded)"""
+        return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+    def _same_version(self, info, known):
+        """Whether the client's description of its copy matches the stored object"""
+        if not isinstance(known, dict):
+            return False
+        if known.get('generation') and known['generation'] == info.generation:
+            return True
+        # A re-upload of identical content gets a new generation but keeps its checksums
+        return any(known.get(field) and known[field] == getattr(info, field) for field in ('md5', 'crc32c'))
+
+    def _send_object(self, client_socket, username, filename, info, offset, end, header, accept_encoding=None):
+        """Send a header followed by bytes [offset, end) of one object version"""
+        name = info.name
+        # Local files (backend or disk cache) go straight from the page cache to the socket
+        local = self.storage.open_local(name, info.generation)
+        if not local and self.disk_cache:
+            with self.tracer.span('cache'):
+                local = self.disk_cache.open(name, info.generation, info.size)
+        if local:
+            with local:
+                self._send_file(client_socket, local, offset, end, header, accept_encoding)
+            return
 
-        if blob.exists():
+        chunks = self._read_chunks(info, offset, end)
+        # Fill the disk cache from full downloads as they stream past
+        cache_writer = None
+        if self.disk_cache and offset == 0 and end == info.size:
+            cache_writer = self.disk_cache.writer(name, info.generation, info.size)
+        try:
+            # Sample the first chunk to decide on compression before the header goes out
+            first = next(chunks, b'')
+            encoding = choose_codec(accept_encoding, first) if accept_encoding else IDENTITY
+            self._send_data(client_socket, dict(header, encoding=encoding))
+            out = client_socket if encoding == IDENTITY else FrameWriter(client_socket, encoding)
+            for data in itertools.chain([first], chunks):
+                if cache_writer:
+                    cache_writer.write(data)
+                out.sendall(data)
+            if out is not client_socket:
+                out.close()
+        except StorageError as e:
+            # The header is already out, so the only way to signal failure is to drop the connection
+            self.logger.error(f"Error streaming file '{filename}' to {username}: {e}")
+            raise ConnectionAbortedError(f"Download of '{filename}' aborted") from e
+        finally:
+            if cache_writer:
+                if cache_writer.size == info.size:
+                    cache_writer.commit()
+                else:
+                    cache_writer.abort()
+
+    def _send_file(self, client_socket, f, offset, end, header, accept_encoding=None):
+        """Send a header followed by bytes [offset, end) of a local file"""
+        encoding = IDENTITY
+        if accept_encoding:
+            encoding = choose_codec(accept_encoding, os.pread(f.fileno(), SAMPLE_SIZE, offset))
+        self._send_data(client_socket, dict(header, encoding=encoding))
+        if encoding == IDENTITY:
+            client_socket.sendfile(f, offset, end - offset)
+            return
+        out = FrameWriter(client_socket, encoding)
+        f.seek(offset)
+        remaining = end - offset
+        while remaining:
+            data = f.read(min(COPY_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            out.sendall(data)
+            remaining -= len(data)
+        out.close()
+
+    def _read_chunks(self, info, start, end):
+        """Iterate over bytes [start, end) of one object version as stored"""
+        # Pin the generation so every range comes from the same object version; reads may run on other threads
+        read_range = self.tracer.bind(lambda range_start, range_end: self.storage.read_range(
+            info.name, range_start, range_end, info.generation))
+        if self.download_parallelism > 1 and end - start >= self.sliced_download_threshold:
+            return iter_slices(read_range, start, end, self.download_slice_size, self.download_parallelism)
+        return iter_ranges(read_range, start, end)
+
+    def _send_gzipped_object(self, client_socket, username, filename, info, offset, length, accept_encoding):
+        """Send an object stored gzip-encoded.
+
+        Clients that accept gzip get the stored bytes unchanged; otherwise the
+        object is decompressed as it streams out, skipping the data before
+        `offset`, so ranges refer to the original data.
+        """
+        header = {'status': 'success', 'generation': info.generation, 'md5': info.md5, 'crc32c': info.crc32c}
+        if not offset and length is None and 'gzip' in negotiate(accept_encoding):
+            self._send_data(client_socket, dict(header, size=None, offset=0, total_size=None, encoding='gzip'))
+            out = FrameWriter(client_socket, None)
             try:
-                data = blob.download_as_bytes()
-                preview_data = data[:1024]
+                for data in self._read_chunks(info, 0, info.size):
+                    out.sendall(data)
+            except StorageError as e:
+                self.logger.error(f"Error streaming file '{filename}' to {username}: {e}")
+                raise ConnectionAbortedError(f"Download of '{filename}' aborted") from e
+            out.close()
+            return
+
+        try:
+            total_size = self._decoded_size(info)
+            if offset < 0 or offset > total_size or (length is not None and length < 0):
+                self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid range'})
+                return
+            end = total_size if length is None else min(total_size, offset + length)
+            header.update(size=end - offset, offset=offset, total_size=total_size)
+            self._send_decoded_object(client_socket, username, filename, info, offset, end, header, accept_encoding)
+        except (StorageError, zlib.error) as e:
+            self.logger.error(f"Error decompressing file '{filename}': {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Error reading file'})
+
+    def _decoded_size(self, info):
+        """Original size of a gzip-stored object"""
+        if info.decoded_size is not None:
+            return info.decoded_size
+        # Stored before uploads recorded their original size; a decoding pass counts it
+        return sum(len(data) for data in gunzip_chunks(self._read_chunks(info, 0, info.size)))
+
+    def _send_decoded_object(self, client_socket, username, filename, info, offset, end, header, accept_encoding=None):
+        """Send a header followed by bytes [offset, end) of the decompressed data of a gzip-stored object.
+
+        Raises StorageError or zlib.error if the object cannot be read before the header goes out.
+        """
+        chunks = gunzip_chunks(self._read_chunks(info, 0, info.size), offset, end)
+        # Sample the first chunk to decide on compression before the header goes out
+        first = next(chunks, b'')
+        encoding = choose_codec(accept_encoding, first) if accept_encoding else IDENTITY
+        self._send_data(client_socket, dict(header, encoding=encoding))
+        out = client_socket if encoding == IDENTITY else FrameWriter(client_socket, encoding)
+        sent = 0
+        try:
+            for data in itertools.chain([first], chunks):
+                out.sendall(data)
+                sent += len(data)
+        except (StorageError, zlib.error) as e:
+            self.logger.error(f"Error streaming file '{filename}' to {username}: {e}")
+            raise ConnectionAbortedError(f"Download of '{filename}' aborted") from e
+        if sent != end - offset:
+            # The header promised more than the object decompressed to
+            self.logger.error(f"File '{filename}' decompressed to fewer bytes than its recorded size")
+            raise ConnectionAbortedError(f"Download of '{filename}' aborted")
+        if out is not client_socket:
+            out.close()
+
+    def handle_batch_stat(self, client_socket, username, filenames=None, pattern=None):
+        """Handle batch_stat command"""
+        try:
+            found = self._resolve_batch(username, filenames, pattern)
+            if filenames is not None:
+                found = self.storage.stat_many(list(found))
+        except (StorageError, ValueError) as e:
+            self._send_batch_error(client_socket, username, e)
+            return
+        prefix = f"{username}/"
+        results = []
+        for name, info in found.items():
+            if isinstance(info, StorageError):
+                results.append(self._batch_failure(name[len(prefix):], info))
+            else:
+                entry = self._listing_entry(info, prefix)
+                entry.update(md5=info.md5, crc32c=info.crc32c, status='success')
+                results.append(entry)
+        self._send_data(client_socket, {'status': 'success', 'results': results})
+
+    def handle_batch_delete(self, client_socket, username, filenames=None, pattern=None):
+        """Handle batch_delete command"""
+        try:
+            found = self._resolve_batch(username, filenames, pattern)
+            outcomes = self.storage.delete_many(list(found))
+        except (StorageError, ValueError) as e:
+            self._send_batch_error(client_socket, username, e)
+            return
+        prefix = f"{username}/"
+        results = []
+        for name, error in outcomes.items():
+            filename = name[len(prefix):]
+            if error:
+                results.append(self._batch_failure(filename, error))
+                continue
+            self.preview_cache.invalidate(name)
+            self.listing.remove(username, filename)
+            results.append({'name': filename, 'status': 'success'})
+        deleted = sum(result['status'] == 'success' for result in results)
+        self.logger.info(f"{deleted} of {len(results)} files deleted by {username} in one batch")
+        self._send_data(client_socket, {'status': 'success', 'results': results})
+
+    def handle_batch_download(self, client_socket, username, filenames=None, pattern=None):
+        """Handle batch_download command.
+
+        Each file is announced by its own header (name, status, size, generation)
+        followed by its bytes; a final {'status': 'done'} message ends the batch.
+        """
+        try:
+            found = self._resolve_batch(username, filenames, pattern)
+            if filenames is not None:
+                found = self.storage.stat_many(list(found))
+        except (StorageError, ValueError) as e:
+            self._send_batch_error(client_socket, username, e)
+            return
+        prefix = f"{username}/"
+        for name, info in found.items():
+            filename = name[len(prefix):]
+            if isinstance(info, StorageError):
+                self._send_data(client_socket, self._batch_failure(filename, info))
+                continue
+            if info.content_encoding == 'gzip':
+                # Batch downloads carry plain bytes, so gzip-stored objects are decompressed
                 try:
-                    preview_text = preview_data.decode('utf-8')
-                    is_text = True
-                except UnicodeDecodeError:
-                    preview_text = "[Binary file content - preview not available]"
-                    is_text = False
-                self._send_data(client_socket, {
-                    'status': 'success',
-                    'preview': preview_text,
-                    'is_binary': not is_text
-                })
-            except Exception as e:
+                    size = self._decoded_size(info)
+                    header = {'name': filename, 'status': 'success', 'size': size, 'generation': info.generation}
+                    self._send_decoded_object(client_socket, username, filename, info, 0, size, header)
+                except (StorageError, zlib.error) as e:
+                    self.logger.error(f"Error decompressing file '{filename}': {e}")
+                    self._send_data(client_socket, {'name': filename, 'status': 'failed',
+                                                    'message': 'Error reading file'})
+                continue
+            header = {'name': filename, 'status': 'success', 'size': info.size, 'generation': info.generation}
+            self._send_object(client_socket, username, filename, info, 0, info.size, header)
+        self._send_data(client_socket, {'status': 'done', 'count': len(found)})
+
+    def _resolve_batch(self, username, filenames, pattern):
+        """Map the object names a batch command targets to their ObjectInfo (None when not listed).
+
+        Explicit filenames are returned as given; a glob pattern is matched
+        against the user's files as currently stored.
+        """
+        prefix = f"{username}/"
+        if filenames is not None:
+            if not isinstance(filenames, list) or not all(isinstance(name, str) and name for name in filenames):
+                raise ValueError("filenames must be a list of names")
+            return {f"{prefix}{filename}": None for filename in filenames}
+        if not isinstance(pattern, str) or not pattern:
+            raise ValueError("A list of filenames or a pattern is required")
+        # Only list the part of the namespace before the first wildcard
+        literal = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+        return {info.name: info for info in self.storage.list(f"{prefix}{literal}")
+                if fnmatch.fnmatchcase(info.name[len(prefix):], pattern)}
+
+    def _batch_failure(self, filename, error):
+        message = 'File not found' if isinstance(error, ObjectNotFound) else 'Storage error'
+        return {'name': filename, 'status': 'failed', 'message': message}
+
+    def _send_batch_error(self, client_socket, username, error):
+        if isinstance(error, StorageError):
+            self.logger.error(f"Error running batch for {username}: {error}")
+            error = 'Storage error'
+        self._send_data(client_socket, {'status': 'failed', 'message': str(error)})
+
+    def handle_cache_stats(self, client_socket):
+        """Handle cache_stats command"""
+        self._send_data(client_socket, {
+            'status': 'success',
+            'disk_cache': self.disk_cache.stats() if self.disk_cache else None,
+            'spool': self.storage.stats() if isinstance(self.storage, WriteBehindBackend) else None,
+            'preview_cache': self.preview_cache.stats()
+        })
+
+    def handle_scheduler(self, client_socket, username, limits=None):
+        """Handle scheduler command: report transfer limits and usage; admins may pass new `limits`"""
+        if limits is not None:
+            if username not in self.admin_users:
+                self._send_data(client_socket, {'status': 'failed', 'message': 'Permission denied'})
+                return
+            try:
+                if not isinstance(limits, dict):
+                    raise ValueError("limits must be an object")
+                self.scheduler.configure(**limits)
+            except ValueError as e:
+                self._send_data(client_socket, {'status': 'failed', 'message': str(e)})
+                return
+            self.logger.info(f"Transfer limits changed by {username}: {limits}")
+        self._send_data(client_socket, dict(self.scheduler.stats(), status='success'))
+
+    def handle_stats(self, client_socket, username):
+        """Handle stats command: server metrics, for admins only"""
+        if username not in self.admin_users:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Permission denied'})
+            return
+        self._send_data(client_socket, dict(self.metrics.snapshot(), status='success'))
+
+    def handle_trace(self, client_socket, username, settings=None):
+        """Handle trace command: report slow log and profiling settings; admins may pass new `settings`"""
+        if settings is not None:
+            if username not in self.admin_users:
+                self._send_data(client_socket, {'status': 'failed', 'message': 'Permission denied'})
+                return
+            try:
+                if not isinstance(settings, dict):
+                    raise ValueError("settings must be an object")
+                self.tracer.configure(**settings)
+            except ValueError as e:
+                self._send_data(client_socket, {'status': 'failed', 'message': str(e)})
+                return
+            self.logger.info(f"Trace settings changed by {username}: {settings}")
+        self._send_data(client_socket, dict(self.tracer.stats(), status='success'))
+
+    def handle_stat(self, client_socket, username, filename):
+        """Handle stat command"""
+        try:
+            info = self.storage.stat(f"{username}/{filename}")
+        except ObjectNotFound:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'File not found'})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error reading metadata of '{filename}': {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Error reading file'})
+            return
+        entry = self._listing_entry(info, f"{username}/")
+        entry.update(md5=info.md5, crc32c=info.crc32c)
+        self._send_data(client_socket, dict(entry, status='success'))
+
+    def handle_view(self, client_socket, username, filename):
+        """Handle view command"""
+        name = f"{username}/{filename}"
+        with self.tracer.span('cache'):
+            cached = self.preview_cache.get(name)
+        if cached:
+            preview_data = cached[1]
+        else:
+            try:
+                # Only fetch the bytes the preview needs
+                generation, preview_data = self.storage.read_head(name, PREVIEW_SIZE)
+            except ObjectNotFound:
+                self._send_data(client_socket, {'status': 'failed', 'message': 'File not found'})
+                return
+            except StorageError as e:
                 self.logger.error(f"Error viewing file: {e}")
                 self._send_data(client_socket, {'status': 'failed', 'message': 'Error reading file'})
-        else:
-            self._send_data(client_socket, {'status': 'failed', 'message': 'File not found'})
+                return
+            if preview_data[:2] == b'\x1f\x8b':
+                preview_data = self._gzipped_preview(name, generation, preview_data)
+            if generation:
+                self.preview_cache.put(name, generation, preview_data)
+
+        try:
+            # A multi-byte character cut off at the preview boundary is not a decode error
+            preview_text = codecs.getincrementaldecoder('utf-8')().decode(preview_data)
+            is_text = True
+        except UnicodeDecodeError:
+            preview_text = "[Binary file content - preview not available]"
+            is_text = False
+        self._send_data(client_socket, {
+            'status': 'success',
+            'preview': preview_text,
+            'is_binary': not is_text
+        })
+
+    def _gzipped_preview(self, name, generation, head):
+        """Decompress the preview of an object stored gzip-encoded; other objects keep their head"""
+        try:
+            info = self.storage.stat(name)
+            if info.content_encoding != 'gzip' or info.generation != generation:
+                return head
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            stored = self.storage.read_range(name, 0, min(info.size, SAMPLE_SIZE), generation)
+            return decompressor.decompress(stored, PREVIEW_SIZE)
+        except (StorageError, zlib.error):
+            return head
+
     def handle_delete(self, client_socket, username, filename):
         """Handle delete command"""
-        safe_filename = os.path.basename(filename)
-        blob = self.gcs_bucket.blob(f"{username}/{filename}")
+        name = f"{username}/{filename}"
+        try:
+            self.storage.delete(name)
+        except ObjectNotFound:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'File not found'})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error deleting file: {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': f'Error: {str(e)}'})
+            return
+        self.preview_cache.invalidate(name)
+        self.listing.remove(username, filename)
+        self._send_data(client_socket, {'status': 'success'})
+        self.logger.info(f"File '{filename}' deleted by {username}")
 
-        if blob.exists():
-            try:
-                blob.delete()
-                self._send_data(client_socket, {'status': 'success'})
-                self.logger.info(f"File '{safe_filename}' deleted by {username}")
-            except Exception as e:
-                self.logger.error(f"Error deleting file: {e}")
-                self._send_data(client_socket, {'status': 'failed', 'message': f'Error: {str(e)}'})
-        else:
+    def handle_copy(self, client_socket, username, command, filename, destination):
+        """Handle copy, move and rename commands.
+
+        The data is copied inside the storage backend and never passes through
+        the server. A filename ending in '/' names a directory, whose files are
+        copied or moved to the same relative paths under the destination; a
+        file copied to a destination ending in '/' keeps its name. rename takes
+        a new name for the file or directory within its parent.
+        """
+        if not filename or not isinstance(destination, str) or not destination.strip('/'):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Invalid destination'})
+            return
+        is_directory = filename.endswith('/')
+        if command == 'rename':
+            if '/' in destination.strip('/'):
+                self._send_data(client_socket, {'status': 'failed', 'message': 'A new name cannot contain /'})
+                return
+            parent = filename.rstrip('/').rpartition('/')[0]
+            destination = f"{parent}/{destination.strip('/')}" if parent else destination.strip('/')
+        if is_directory:
+            self._copy_directory(client_socket, username, command != 'copy', filename, destination.rstrip('/') + '/')
+            return
+        if destination.endswith('/'):
+            destination += filename.rpartition('/')[2]  # Into that directory, keeping the name
+        if destination == filename:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Source and destination are the same'})
+            return
+
+        move = command != 'copy'
+        prefix = f"{username}/"
+        try:
+            info = (self.storage.move if move else self.storage.copy)(prefix + filename, prefix + destination)
+        except ObjectNotFound:
             self._send_data(client_socket, {'status': 'failed', 'message': 'File not found'})
+            return
+        except StorageError as e:
+            self.logger.error(f"Error during {command} of '{filename}' to '{destination}': {e}")
+            self._send_data(client_socket, {'status': 'failed', 'message': f'{command.capitalize()} failed'})
+            return
+        self._record_copy(username, prefix + filename, info, move)
+        self._send_data(client_socket, dict(self._listing_entry(info, prefix), status='success'))
+        self.logger.info(f"File '{filename}' {'moved' if move else 'copied'} to '{destination}' by {username}")
+
+    def _copy_directory(self, client_socket, username, move, source, destination):
+        """Copy or move every file under the `source` directory; both names end in '/'"""
+        if destination.startswith(source):
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Cannot copy a directory into itself'})
+            return
+        prefix = f"{username}/"
+        try:
+            names = [info.name for info in self.storage.list(prefix + source)]
+        except StorageError as e:
+            self._send_batch_error(client_socket, username, e)
+            return
+        if not names:
+            self._send_data(client_socket, {'status': 'failed', 'message': 'Directory not found'})
+            return
+
+        def transfer(name):
+            relative = name[len(prefix + source):]
+            result = {'name': source + relative, 'destination': destination + relative}
+            try:
+                info = (self.storage.move if move else self.storage.copy)(name, prefix + destination + relative)
+            except StorageError as e:
+                return dict(self._batch_failure(result['name'], e), destination=result['destination'])
+            self._record_copy(username, name, info, move)
+            return dict(result, status='success')
+
+        with ThreadPoolExecutor(max_workers=DIRECTORY_COPY_PARALLELISM) as executor:
+            results = list(executor.map(transfer, names))
+        done = sum(result['status'] == 'success' for result in results)
+        self.logger.info(f"{done} of {len(results)} files {'moved' if move else 'copied'} "
+                         f"from '{source}' to '{destination}' by {username}")
+        self._send_data(client_socket, {'status': 'success', 'results': results})
+
+    def _record_copy(self, username, source, info, moved):
+        """Update the caches and listing index after a copy or move of `source` to info.name"""
+        prefix = f"{username}/"
+        self.preview_cache.invalidate(info.name)
+        self.listing.upsert(username, self._listing_entry(info, prefix))
+        if moved:
+            self.preview_cache.invalidate(source)
+            self.listing.remove(username, source[len(prefix):])
 
     def _send_data(self, client_socket, data):
-        """Helper function to send JSON data to the client"""
-        client_socket.send(json.dumps(data).encode())
+        """Helper function to send a JSON message to the client"""
+        self.metrics.replied(data)
+        self.tracer.replied(data)
+        client_socket.send_message(data)
 
     def _receive_data(self, client_socket):
-        """Helper function to receive JSON data from the client"""
+        """Helper function to receive a JSON message from the client"""
         try:
-            data = client_socket.recv(4096)
-            while data:
-                try:
-                    return json.loads(data.decode())
-                except json.JSONDecodeError:
-                    # Keep receiving data until we can parse valid JSON
-                    chunk = client_socket.recv(4096)
-                    if not chunk:
-                        break
-                    data += chunk
-            return None
+            return client_socket.recv_message()
         except socket.error as e:
             self.logger.error(f"Error receiving data: {e}")
             return None
 
     def show_client_activities(self):
         """Display current client activities"""
-        with self.client_activities_lock:
-            print("\nCurrent Client Activities:")
-            for addr, activity in self.client_activities.items():
-                print(f"{addr}: {activity}")
+        print("\nCurrent Client Activities:")
+        for addr, activity in self.sessions.activities():
+            print(f"{addr}: {activity}")
+        stats = self.scheduler.stats()
+        print(f"Transfers: {stats['active_streams']}/{stats['max_streams']} streams active, "
+              f"{stats['waiting_streams']} waiting for a slot")
+        if self.disk_cache:
+            stats = self.disk_cache.stats()
+            print(f"Disk cache: {stats['hits']} hits, {stats['misses']} misses, "
+                  f"{stats['bytes']}/{stats['max_bytes']} bytes in {stats['entries']} entries")
 
     def monitor_client_activities(self):
         """Monitor and display client activities periodically"""
@@ -298,8 +1126,149 @@ class FileTransferServer:
             self.show_client_activities()
             time.sleep(15)  # Adjust interval as needed
 
+    def clean_multipart_uploads(self):
+        """Periodically delete multipart uploads that were never completed"""
+        while self.running:
+            try:
+                removed = self.multipart.cleanup()
+                if removed:
+                    self.logger.info(f"Removed {removed} expired multipart uploads")
+            except StorageError as e:
+                self.logger.error(f"Error cleaning multipart uploads: {e}")
+            time.sleep(MULTIPART_CLEANUP_INTERVAL)
+
 def main():
-    server = FileTransferServer()
+    parser = argparse.ArgumentParser(description='Distributed File System server')
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=9999, help='Port to listen on')
+    parser.add_argument('--ssl', action='store_true', help='Accepted for compatibility; TLS is always enabled')
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded',
+                        help='Thread-per-connection or asyncio connection handling')
+    parser.add_argument('--workers', type=int, default=32,
+                        help='Command executor threads for the async engine')
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog for pending connections')
+    parser.add_argument('--command-workers', type=int, default=16,
+                        help='Threads running pipelined metadata commands (list/view/delete/stat)')
+    parser.add_argument('--download-slice-size', type=int, default=DOWNLOAD_SLICE_SIZE,
+                        help='Bytes per slice when fetching large objects in parallel')
+    parser.add_argument('--download-parallelism', type=int, default=DOWNLOAD_PARALLELISM,
+                        help='Concurrent GCS range reads per large download (1 disables slicing)')
+    parser.add_argument('--sliced-download-threshold', type=int, default=SLICED_DOWNLOAD_THRESHOLD,
+                        help='Minimum download size in bytes that uses parallel slices')
+    parser.add_argument('--max-streams', type=int, default=MAX_STREAMS,
+                        help='Uploads and downloads running at once across all users')
+    parser.add_argument('--max-user-streams', type=int, default=MAX_USER_STREAMS,
+                        help='Uploads and downloads running at once per user')
+    parser.add_argument('--user-rate', type=int, default=0,
+                        help='Bandwidth limit per user in bytes per second (0 for unlimited)')
+    parser.add_argument('--user-burst', type=int, default=0,
+                        help='Bytes a user may transfer above the rate at once (default: one second of rate)')
+    parser.add_argument('--admin-users', nargs='+', default=['admin'],
+                        help='Users allowed to change transfer limits at runtime')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve Prometheus metrics over HTTP on this port (0 disables; pre-fork worker N uses port+N)')
+    parser.add_argument('--slow-threshold', type=float, default=SLOW_THRESHOLD,
+                        help='Seconds after which a request is written to the slow log (0 disables it)')
+    parser.add_argument('--slow-log', default='slow.log',
+                        help='File receiving one JSON line with phase timings per slow request')
+    parser.add_argument('--profile-rate', type=float, default=0.0,
+                        help='Fraction of requests run under cProfile (stats saved under <storage root>/profiles)')
+    parser.add_argument('--token-ttl', type=int, default=TOKEN_TTL,
+                        help='Seconds a session token lets a client reconnect without its password')
+    parser.add_argument('--preview-cache-bytes', type=int, default=32 * 1024 * 1024,
+                        help='Memory budget for cached file previews')
+    parser.add_argument('--preview-cache-ttl', type=float, default=5,
+                        help='Seconds a cached preview is served before the file is read again')
+    parser.add_argument('--store-compressed', action='store_true',
+                        help='Store compressible uploads gzip-encoded (GCS content_encoding)')
+    parser.add_argument('--listing-ttl', type=int, default=60,
+                        help='Seconds before a cached user listing is reloaded from GCS')
+    parser.add_argument('--disk-cache-bytes', type=int, default=1024 ** 3,
+                        help='Size budget of the blob cache under the storage root (0 disables it)')
+    parser.add_argument('--disk-cache-entry-bytes', type=int, default=256 * 1024 ** 2,
+                        help='Largest object kept in the disk cache')
+    parser.add_argument('--storage-root', default='server_storage',
+                        help='Directory for the disk cache and local backend objects')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='Acknowledge uploads once spooled under the storage root and upload them in the background')
+    parser.add_argument('--spool-workers', type=int, default=SPOOL_WORKERS,
+                        help='Background uploader threads for --write-behind')
+    parser.add_argument('--backend', choices=['gcs', 'local', 'memory'], default='gcs',
+                        help='Where file contents are stored')
+    parser.add_argument('--local-root', default=None,
+                        help='Object directory for the local backend (default: <storage root>/objects)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes sharing the port via SO_REUSEPORT (pre-fork mode)')
+    parser.add_argument('--sessions-db', default='sessions.db',
+                        help='SQLite file shared by worker processes for logins and activities')
+    args = parser.parse_args()
+    if args.write_behind and args.processes > 1:
+        parser.error('--write-behind keeps its spool per process and cannot be used with --processes')
+
+    if args.processes > 1:
+        registry = SqliteSessionRegistry(args.sessions_db)
+        registry.reset()
+        # Created before forking so every worker shares the TLS ticket keys and token secret
+        Path(args.storage_root).mkdir(parents=True, exist_ok=True)
+        shared = {'ssl_context': create_ssl_context('server.crt', 'server.key'),
+                  'token_secret': load_secret(Path(args.storage_root) / 'token.key')}
+
+        def serve(index):
+            metrics_port = args.metrics_port + index if args.metrics_port else 0  # Each worker has its own metrics
+            server = build_server(args, sessions=SqliteSessionRegistry(args.sessions_db), reuse_port=True,
+                                  metrics_port=metrics_port, **shared)
+            server.monitor_activities = False  # The supervisor reports for all workers
+            run_server(server, args)
+
+        def show_activities():
+            print("\nCurrent Client Activities:")
+            for addr, activity in registry.activities():
+                print(f"{addr}: {activity}")
+
+        run_workers(args.processes, serve, show_activities)
+        return
+
+    run_server(build_server(args), args)
+
+def build_server(args, **kwargs):
+    """Create a server from parsed command line arguments"""
+    kwargs.setdefault('metrics_port', args.metrics_port)
+    storage = create_backend(args.backend, args.local_root or Path(args.storage_root) / 'objects')
+    return FileTransferServer(
+        host=args.host,
+        port=args.port,
+        storage_root=args.storage_root,
+        download_slice_size=args.download_slice_size,
+        download_parallelism=args.download_parallelism,
+        sliced_download_threshold=args.sliced_download_threshold,
+        preview_cache_bytes=args.preview_cache_bytes,
+        preview_cache_ttl=args.preview_cache_ttl,
+        backlog=args.backlog,
+        listing_ttl=args.listing_ttl,
+        disk_cache_bytes=args.disk_cache_bytes,
+        disk_cache_entry_bytes=args.disk_cache_entry_bytes,
+        storage=storage,
+        command_workers=args.command_workers,
+        store_compressed=args.store_compressed,
+        write_behind=args.write_behind,
+        spool_workers=args.spool_workers,
+        max_streams=args.max_streams,
+        max_user_streams=args.max_user_streams,
+        user_rate=args.user_rate,
+        user_burst=args.user_burst,
+        admin_users=args.admin_users,
+        token_ttl=args.token_ttl,
+        slow_log=args.slow_log,
+        slow_threshold=args.slow_threshold,
+        profile_rate=args.profile_rate,
+        **kwargs
+    )
+
+def run_server(server, args):
+    """Serve with the engine selected on the command line"""
+    if args.engine == 'async':
+        AsyncServerEngine(server, max_workers=args.workers).run()
+        return
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,142 @@
+"""
+Registries of logged-in users and client activities.
+
+SessionRegistry keeps them in process memory for a single server process.
+SqliteSessionRegistry keeps them in a local SQLite file so that pre-forked
+worker processes share the "already logged in" check and activity monitoring.
+"""
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class SessionRegistry:
+    """Logged-in users and client activities of a single server process"""
+
+    def __init__(self):
+        self._logged_in_users = {}  # username -> address of the session
+        self._client_activities = {}  # address -> current activity
+        self._lock = Lock()
+
+    def claim(self, username, addr):
+        """Register a login; returns the address already holding the session, or None on success"""
+        with self._lock:
+            holder = self._logged_in_users.get(username)
+            if holder is not None:
+                return holder
+            self._logged_in_users[username] = addr
+            return None
+
+    def release(self, username, addr):
+        """Drop the session of username if it belongs to addr; returns True if it did"""
+        with self._lock:
+            if self._logged_in_users.get(username) == addr:
+                del self._logged_in_users[username]
+                return True
+            return False
+
+    def is_logged_in(self, username):
+        with self._lock:
+            return username in self._logged_in_users
+
+    def set_activity(self, addr, activity):
+        with self._lock:
+            self._client_activities[addr] = activity
+
+    def clear_activity(self, addr):
+        with self._lock:
+            self._client_activities.pop(addr, None)
+
+    def activities(self):
+        """Return a list of (address, activity) pairs"""
+        with self._lock:
+            return list(self._client_activities.items())
+
+
+class SqliteSessionRegistry(SessionRegistry):
+    """Sessions shared across worker processes through a local SQLite database"""
+
+    def __init__(self, db_path='sessions.db'):
+        self.db_path = db_path
+        self._lock = Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                username TEXT PRIMARY KEY,
+                addr TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                started REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS activities (
+                addr TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                activity TEXT NOT NULL
+            )
+        ''')
+
+    def reset(self):
+        """Forget every session, e.g. when the supervising process starts"""
+        with self._lock:
+            self._conn.execute('DELETE FROM sessions')
+            self._conn.execute('DELETE FROM activities')
+
+    def claim(self, username, addr):
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                row = cursor.execute('SELECT addr, pid FROM sessions WHERE username = ?', (username,)).fetchone()
+                if row and _process_alive(row[1]):
+                    return row[0]
+                # Sessions left behind by a dead worker do not block the login
+                cursor.execute(
+                    'INSERT OR REPLACE INTO sessions (username, addr, pid, started) VALUES (?, ?, ?, ?)',
+                    (username, str(addr), os.getpid(), time.time())
+                )
+                return None
+            finally:
+                cursor.execute('COMMIT')
+
+    def release(self, username, addr):
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM sessions WHERE username = ? AND addr = ? AND pid = ?',
+                (username, str(addr), os.getpid())
+            )
+            return cursor.rowcount > 0
+
+    def is_logged_in(self, username):
+        with self._lock:
+            row = self._conn.execute('SELECT pid FROM sessions WHERE username = ?', (username,)).fetchone()
+        return bool(row) and _process_alive(row[0])
+
+    def set_activity(self, addr, activity):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO activities (addr, pid, activity) VALUES (?, ?, ?)',
+                (str(addr), os.getpid(), activity)
+            )
+
+    def clear_activity(self, addr):
+        with self._lock:
+            self._conn.execute('DELETE FROM activities WHERE addr = ? AND pid = ?', (str(addr), os.getpid()))
+
+    def activities(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT addr, pid, activity FROM activities ORDER BY addr').fetchall()
+        return [(f"{addr} [pid {pid}]", activity) for addr, pid, activity in rows if _process_alive(pid)]
+
+
+def _process_alive(pid):
+    """Check whether a worker process still exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,420 @@
+"""
+Write-behind upload spooling.
+
+WriteBehindBackend wraps another storage backend (normally GCS). New objects
+are written to files under a local spool directory and acknowledged as soon as
+they are on disk; background uploader threads then copy them to the wrapped
+backend, retrying with exponential backoff until the upload succeeds. Each
+spooled object is two files:
+
+    {spool_dir}/{id}.data    the object bytes, fsynced before the write is acknowledged
+    {spool_dir}/{id}.json    name, size, generation, MD5 and content encoding
+
+Metadata is written last, so a data file without metadata is an interrupted
+write; the spool is scanned on startup and surviving objects are queued again.
+Until an object has been uploaded, stat, list and reads answer from the spool,
+so clients see their writes immediately. Objects under STAGING_PREFIX
+(multipart parts, dedup chunks) are written straight through.
+"""
+import base64
+import datetime
+import hashlib
+import heapq
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from itertools import count
+from pathlib import Path
+from queue import Queue
+from threading import Condition, Lock, Thread
+
+from storage_backend import COPY_CHUNK_SIZE, STAGING_PREFIX, ObjectInfo, ObjectNotFound, StorageBackend, StorageError
+
+SPOOL_WORKERS = 4  # Uploader threads flushing the spool
+RETRY_BASE_DELAY = 1  # Seconds before the first retry of a failed upload
+RETRY_MAX_DELAY = 300  # Upper bound on the delay between retries
+NAME_LOCK_STRIPES = 64  # Locks serializing uploads and direct writes per object name
+FLUSHED_GENERATIONS = 4096  # Spool generations remembered after upload, for reads pinned to them
+
+
+class _SpoolEntry:
+    """One spooled object version"""
+
+    def __init__(self, spool_dir, entry_id, name, size, generation, md5, content_encoding=None, decoded_size=None):
+        self.id = entry_id
+        self.name = name
+        self.size = size
+        self.generation = generation
+        self.md5 = md5
+        self.content_encoding = content_encoding
+        self.decoded_size = decoded_size
+        self.data_path = spool_dir / f"{entry_id}.data"
+        self.meta_path = spool_dir / f"{entry_id}.json"
+        self.attempts = 0
+
+    def info(self):
+        updated = datetime.datetime.fromtimestamp(self.generation / 1e9, datetime.timezone.utc)
+        return ObjectInfo(self.name, self.size, self.generation, updated, self.md5,
+                          content_encoding=self.content_encoding, decoded_size=self.decoded_size)
+
+    def metadata(self):
+        return {'name': self.name, 'size': self.size, 'generation': self.generation,
+                'md5': self.md5, 'content_encoding': self.content_encoding, 'decoded_size': self.decoded_size}
+
+
+class WriteBehindBackend(StorageBackend):
+    """Storage backend that acknowledges writes once they are spooled to local disk"""
+
+    def __init__(self, inner, spool_dir, workers=SPOOL_WORKERS, on_flush=None, logger=None):
+        self.inner = inner
+        self.remote = inner.remote
+        self.stores_content_encoding = inner.stores_content_encoding
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.on_flush = on_flush  # Called with the uploaded ObjectInfo of each flushed object
+        self.logger = logger or logging.getLogger()
+        self.running = False
+        self._pending = {}  # name -> newest _SpoolEntry not yet uploaded
+        self._flushed = OrderedDict()  # (name, spool generation) -> generation in the wrapped backend
+        self._last_generation = 0
+        self._lock = Lock()
+        self._name_locks = [Lock() for _ in range(NAME_LOCK_STRIPES)]
+        self._queue = Queue()
+        self._retries = []  # Heap of (monotonic due time, sequence, entry) waiting out a backoff
+        self._retry_sequence = count()
+        self._retry_ready = Condition()
+        self._recover()
+
+    def start(self):
+        """Start the uploader threads and the thread requeueing failed uploads after their backoff"""
+        self.running = True
+        for _ in range(self.workers):
+            Thread(target=self._upload_loop, daemon=True, name='spool-upload').start()
+        Thread(target=self._retry_loop, daemon=True, name='spool-retry').start()
+
+    def stop(self):
+        """Stop the uploaders after their current upload; the rest is flushed on the next start"""
+        self.running = False
+        for _ in range(self.workers):
+            self._queue.put(None)
+        with self._retry_ready:
+            # Uploads waiting out a backoff go back on the queue, behind the stop markers
+            for _, _, entry in sorted(self._retries):
+                self._queue.put(entry)
+            self._retries.clear()
+            self._retry_ready.notify_all()
+
+    def stats(self):
+        with self._retry_ready:
+            retrying = len(self._retries)
+        with self._lock:
+            return {'pending': len(self._pending), 'bytes': sum(entry.size for entry in self._pending.values()),
+                    'retrying': retrying}
+
+    def open_writer(self, name, content_encoding=None, decoded_size=None):
+        if name.startswith(STAGING_PREFIX):
+            return self.inner.open_writer(name, content_encoding, decoded_size)
+        if content_encoding and not self.stores_content_encoding:
+            raise StorageError("The storage backend does not store content encodings")
+        return _SpoolWriter(self, name, content_encoding, decoded_size)
+
+    def stat(self, name):
+        entry = self._current(name)
+        return entry.info() if entry else self.inner.stat(name)
+
+    def read_range(self, name, start, end, generation=None):
+        entry = self._current(name)
+        if entry and generation in (None, entry.generation):
+            try:
+                with open(entry.data_path, 'rb') as f:
+                    return os.pread(f.fileno(), max(0, min(end, entry.size) - start), start)
+            except FileNotFoundError:
+                pass  # Uploaded meanwhile; read it from the wrapped backend
+        return self.inner.read_range(name, start, end, self._inner_generation(name, generation))
+
+    def read_head(self, name, size):
+        if self._current(name):
+            return super().read_head(name, size)
+        return self.inner.read_head(name, size)
+
+    def open_local(self, name, generation):
+        entry = self._current(name)
+        if entry and entry.generation == generation:
+            try:
+                return open(entry.data_path, 'rb')
+            except FileNotFoundError:
+                pass
+        return self.inner.open_local(name, self._inner_generation(name, generation))
+
+    def list(self, prefix):
+        with self._lock:
+            spooled = sorted((name, entry) for name, entry in self._pending.items() if name.startswith(prefix))
+        i = 0
+        for info in self.inner.list(prefix):
+            while i < len(spooled) and spooled[i][0] < info.name:
+                yield spooled[i][1].info()
+                i += 1
+            if i < len(spooled) and spooled[i][0] == info.name:
+                yield spooled[i][1].info()  # The spooled version replaces the stored one
+                i += 1
+                continue
+            yield info
+        for _, entry in spooled[i:]:
+            yield entry.info()
+
+    def delete(self, name):
+        # An upload of the spooled version still in flight deletes its copy when it finishes
+        with self._lock:
+            entry = self._pending.pop(name, None)
+        if entry:
+            self._discard(entry)
+        try:
+            self.inner.delete(name)
+        except ObjectNotFound:
+            if not entry:
+                raise
+
+    def stat_many(self, names):
+        with self._lock:
+            spooled = {name: self._pending[name] for name in names if name in self._pending}
+        stored = self.inner.stat_many([name for name in names if name not in spooled])
+        return {name: spooled[name].info() if name in spooled else stored[name] for name in names}
+
+    def delete_many(self, names):
+        with self._lock:
+            spooled = {name for name in names if name in self._pending}
+        results = self.inner.delete_many([name for name in names if name not in spooled])
+        for name in spooled:
+            try:
+                self.delete(name)
+                results[name] = None
+            except StorageError as e:
+                results[name] = e
+        return {name: results[name] for name in names}
+
+    def compose(self, sources, destination):
+        with self._lock:
+            spooled = any(source in self._pending for source in sources)
+        if spooled:
+            # Copies the data, so the result is spooled as well
+            return super().compose(sources, destination)
+        return self._write_through(destination, lambda: self.inner.compose(sources, destination))
+
+    def copy(self, source, destination):
+        if self._current(source):
+            return super().copy(source, destination)
+        return self._write_through(destination, lambda: self.inner.copy(source, destination))
+
+    def _write_through(self, name, write):
+        """Run write(), which writes `name` in the wrapped backend directly, and return its result"""
+        with self._name_lock(name):
+            info = write()
+            # The new object replaces any version still waiting in the spool
+            with self._lock:
+                entry = self._pending.pop(name, None)
+            if entry:
+                self._discard(entry)
+        return info
+
+    def _current(self, name):
+        with self._lock:
+            return self._pending.get(name)
+
+    def _inner_generation(self, name, generation):
+        """Map a spool generation of an uploaded object to its generation in the wrapped backend"""
+        if generation is None:
+            return None
+        with self._lock:
+            return self._flushed.get((name, generation), generation)
+
+    def _name_lock(self, name):
+        return self._name_locks[hash(name) % NAME_LOCK_STRIPES]
+
+    def _next_generation(self):
+        with self._lock:
+            self._last_generation = max(time.time_ns(), self._last_generation + 1)
+            return self._last_generation
+
+    def _commit(self, entry):
+        """Make a fully written spool entry the current version of its name and queue its upload"""
+        meta_temp = self.spool_dir / f"{entry.id}.json.tmp"
+        with open(meta_temp, 'w') as f:
+            json.dump(entry.metadata(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(meta_temp, entry.meta_path)
+        self._fsync_dir()
+        with self._lock:
+            previous = self._pending.get(entry.name)
+            self._pending[entry.name] = entry
+        if previous:
+            self._discard(previous)  # Its uploader notices it was replaced and skips it
+        self._queue.put(entry)
+
+    def _upload_loop(self):
+        while self.running:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            self._upload(entry)
+
+    def _upload(self, entry):
+        with self._name_lock(entry.name):
+            if self._current(entry.name) is not entry:
+                return  # Replaced or deleted since it was queued
+            try:
+                info = self._copy_to_inner(entry)
+            except (OSError, StorageError) as e:
+                entry.attempts += 1
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (entry.attempts - 1))
+                self.logger.error(f"Error uploading spooled '{entry.name}' (attempt {entry.attempts}), "
+                                  f"retrying in {delay}s: {e}")
+                with self._retry_ready:
+                    heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_sequence), entry))
+                    self._retry_ready.notify()
+                return
+            with self._lock:
+                current = self._pending.get(entry.name)
+                if current is entry:
+                    del self._pending[entry.name]
+                    self._flushed[(entry.name, entry.generation)] = info.generation
+                    while len(self._flushed) > FLUSHED_GENERATIONS:
+                        self._flushed.popitem(last=False)
+                    if self.on_flush:
+                        # Under the lock, so a newer write's update cannot be overtaken
+                        self.on_flush(info)
+            if current is not entry:
+                if current is None:
+                    # Deleted while uploading; a replacement would instead overwrite this copy next
+                    self._delete_uploaded(entry.name)
+                return
+        self._discard(entry)
+        self.logger.info(f"Flushed spooled '{entry.name}' ({entry.size} bytes) to storage")
+
+    def _retry_loop(self):
+        """Move failed uploads back to the upload queue once their backoff has passed"""
+        with self._retry_ready:
+            while self.running:
+                now = time.monotonic()
+                while self._retries and self._retries[0][0] <= now:
+                    self._queue.put(heapq.heappop(self._retries)[2])
+                self._retry_ready.wait(self._retries[0][0] - now if self._retries else None)
+
+    def _delete_uploaded(self, name):
+        try:
+            self.inner.delete(name)
+        except ObjectNotFound:
+            pass
+        except StorageError as e:
+            self.logger.error(f"Error deleting '{name}', deleted while it was uploading: {e}")
+
+    def _copy_to_inner(self, entry):
+        writer = self.inner.open_writer(entry.name, entry.content_encoding, entry.decoded_size)
+        try:
+            with open(entry.data_path, 'rb') as f:
+                while True:
+                    data = f.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    writer.write(data)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.info
+
+    def _discard(self, entry):
+        for path in (entry.meta_path, entry.data_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _recover(self):
+        """Queue the objects a previous run spooled but did not upload"""
+        entries = []
+        for path in self.spool_dir.iterdir():
+            if path.suffix != '.json':
+                continue
+            try:
+                meta = json.loads(path.read_text())
+                entry = _SpoolEntry(self.spool_dir, path.stem, meta['name'], meta['size'], meta['generation'],
+                                    meta['md5'], meta.get('content_encoding'), meta.get('decoded_size'))
+                if entry.data_path.stat().st_size != entry.size:
+                    raise ValueError("size mismatch")
+            except (OSError, ValueError, KeyError) as e:
+                self.logger.error(f"Discarding damaged spool entry {path.name}: {e}")
+                path.unlink()
+                continue
+            entries.append(entry)
+
+        for entry in sorted(entries, key=lambda entry: entry.generation):
+            previous = self._pending.get(entry.name)
+            if previous:
+                self._discard(previous)
+            self._pending[entry.name] = entry
+            self._last_generation = max(self._last_generation, entry.generation)
+        live = {entry.id for entry in self._pending.values()}
+        for path in self.spool_dir.iterdir():
+            # Data of interrupted writes and of versions replaced before a crash
+            if path.stem.split('.')[0] not in live:
+                path.unlink()
+        for entry in self._pending.values():
+            self._queue.put(entry)
+        if self._pending:
+            self.logger.info(f"Recovered {len(self._pending)} spooled uploads")
+
+    def _fsync_dir(self):
+        fd = os.open(self.spool_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class _SpoolWriter:
+    """Writes one object version into the spool; close() makes it durable and visible"""
+
+    def __init__(self, backend, name, content_encoding=None, decoded_size=None):
+        self.backend = backend
+        self.name = name
+        self.content_encoding = content_encoding
+        self.decoded_size = decoded_size
+        self.id = uuid.uuid4().hex
+        self.path = backend.spool_dir / f"{self.id}.data"
+        try:
+            self.file = open(self.path, 'wb')
+        except OSError as e:
+            raise StorageError(f"Error spooling '{name}': {e}") from e
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.info = None
+
+    def write(self, data):
+        self.file.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        entry = _SpoolEntry(self.backend.spool_dir, self.id, self.name, self.size, self.backend._next_generation(),
+                            base64.b64encode(self.md5.digest()).decode(), self.content_encoding, self.decoded_size)
+        try:
+            self.backend._commit(entry)
+        except OSError as e:
+            self.backend._discard(entry)
+            raise StorageError(f"Error spooling '{self.name}': {e}") from e
+        self.info = entry.info()
+
+    def abort(self):
+        self.file.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,195 @@
+"""
+Directory sync between a local tree and the user's files on the server.
+
+push uploads local files that are new or changed; pull downloads server files
+that are new or changed. Files are compared by size first, then modification
+time and MD5. The transfers run on a pool of extra connections attached to the
+client's session, and progress is printed as each file finishes.
+"""
+import datetime
+import os
+import time
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+from client import MANIFEST_NAME, DownloadManifest, FileTransferClient, file_md5
+from protocol import ProtocolError
+
+DEFAULT_CONNECTIONS = 4  # Parallel transfer connections
+MANIFEST_SAVE_INTERVAL = 100  # Pulled files between manifest saves
+
+
+class SyncStats:
+    """Thread-safe progress counters for one sync run"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = []
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._lock = Lock()
+
+    def failed_with(self, action):
+        """Return an error callback for run_pool that counts the task as failed"""
+        def on_error(name, error):
+            print(f"Connection error during {action} {name}: {error}")
+            self.finished(action, name, 0, False)
+        return on_error
+
+    def finished(self, action, name, size, ok):
+        with self._lock:
+            self.done += 1
+            if ok:
+                self.bytes += size
+                print(f"[{self.done}/{self.total}] {action} {name} ({size} bytes)")
+            else:
+                self.failed.append(name)
+                print(f"[{self.done}/{self.total}] FAILED {action} {name}")
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (f"{self.done - len(self.failed)} of {self.total} files transferred, {self.bytes} bytes "
+                f"in {elapsed:.1f}s ({self.bytes / elapsed / 1024 / 1024:.2f} MiB/s), {len(self.failed)} failed")
+
+
+def run_pool(client, tasks, transfer, on_error, connections=DEFAULT_CONNECTIONS):
+    """Run transfer(worker_client, task) for every task on attached connections.
+
+    A connection that fails reports its task to on_error(task, error) and stops
+    taking tasks. Falls back to the client's own connection if the server
+    refuses to attach extra ones.
+    """
+    pending = Queue()
+    for task in tasks:
+        pending.put(task)
+
+    def work(worker):
+        while True:
+            try:
+                task = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                transfer(worker, task)
+            except (OSError, ProtocolError) as e:
+                on_error(task, e)
+                return
+
+    workers = []
+    for _ in range(min(connections, len(tasks))):
+        worker = FileTransferClient(client.host, client.port, client.certfile, client.legacy)
+        if not worker.connect(*client.credentials, attach=True):
+            if worker.socket:
+                worker.socket.close()
+            break
+        workers.append(worker)
+    if not workers:
+        work(client)
+        return
+
+    threads = [Thread(target=work, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for worker in workers:
+        worker.socket.close()
+
+
+def remote_entries(client, remote_dir):
+    """Map paths relative to remote_dir to the server's listing entries"""
+    prefix = f"{remote_dir.strip('/')}/" if remote_dir else ''
+    return {entry['name'][len(prefix):]: entry for entry in client.list_entries(refresh=True)
+            if entry['name'].startswith(prefix)}
+
+
+def local_files(local_dir):
+    """Map relative POSIX paths of every regular file under local_dir to their stat results"""
+    root = Path(local_dir)
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            if filename.startswith(MANIFEST_NAME):
+                continue
+            files[path.relative_to(root).as_posix()] = path.stat()
+    return files
+
+
+def push(client, local_dir, remote_dir='', connections=DEFAULT_CONNECTIONS, delete=False):
+    """Upload new and changed files under local_dir; returns the SyncStats"""
+    prefix = f"{remote_dir.strip('/')}/" if remote_dir else ''
+    remote = remote_entries(client, remote_dir)
+    local = local_files(local_dir)
+
+    changed = []
+    suspects = []  # Same size but modified locally after the server copy
+    for relative, stat in local.items():
+        entry = remote.get(relative)
+        if not entry or entry['size'] != stat.st_size:
+            changed.append(relative)
+        elif not entry['updated'] or stat.st_mtime > datetime.datetime.fromisoformat(entry['updated']).timestamp():
+            suspects.append(relative)
+    if suspects:
+        # Only an MD5 mismatch proves a same-size file changed
+        results = client.batch_stat([prefix + relative for relative in suspects]) or []
+        remote_md5 = {result['name'][len(prefix):]: result.get('md5') for result in results}
+        for relative in suspects:
+            md5 = remote_md5.get(relative)
+            if not md5 or md5 != file_md5(Path(local_dir) / relative):
+                changed.append(relative)
+
+    stats = SyncStats(len(changed))
+    print(f"{len(changed)} of {len(local)} files to upload")
+
+    def upload(worker, relative):
+        ok = worker.upload_file(str(Path(local_dir) / relative), prefix + relative)
+        stats.finished('uploaded', relative, local[relative].st_size, ok)
+
+    run_pool(client, sorted(changed), upload, stats.failed_with('uploaded'), connections)
+
+    if delete:
+        extra = sorted(set(remote) - set(local))
+        if extra:
+            results = client.batch_delete([prefix + relative for relative in extra]) or []
+            print(f"Deleted {sum(result['status'] == 'success' for result in results)} files from the server")
+    return stats
+
+
+def pull(client, local_dir, remote_dir='', connections=DEFAULT_CONNECTIONS, delete=False):
+    """Download new and changed server files into local_dir; returns the SyncStats"""
+    prefix = f"{remote_dir.strip('/')}/" if remote_dir else ''
+    local_dir = Path(local_dir)
+    local_dir.mkdir(parents=True, exist_ok=True)
+    remote = remote_entries(client, remote_dir)
+    manifest = DownloadManifest(local_dir)
+
+    changed = []
+    for relative, entry in remote.items():
+        known = manifest.lookup(relative, local_dir / relative)
+        if not known or not known['complete'] or known['generation'] != entry['generation']:
+            changed.append(relative)
+
+    stats = SyncStats(len(changed))
+    print(f"{len(changed)} of {len(remote)} files to download")
+
+    def download(worker, relative):
+        ok = worker.download_file(prefix + relative, local_dir, manifest=manifest, local_name=relative)
+        stats.finished('downloaded', relative, remote[relative]['size'], ok)
+        if stats.done % MANIFEST_SAVE_INTERVAL == 0:
+            manifest.save()
+
+    try:
+        run_pool(client, sorted(changed), download, stats.failed_with('downloaded'), connections)
+    finally:
+        manifest.save()
+
+    if delete:
+        for relative in sorted(set(local_files(local_dir)) - set(remote)):
+            (local_dir / relative).unlink()
+            manifest.forget(relative)
+            print(f"Deleted local file {relative}")
+        manifest.save()
+    return stats
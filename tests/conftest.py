@@ -0,0 +1,52 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+from threading import Thread
+
+import pytest
+
+# The server and client are plain modules at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    """(certfile, keyfile) of a self-signed certificate for localhost"""
+    directory = tmp_path_factory.mktemp('tls')
+    certfile, keyfile = directory / 'server.crt', directory / 'server.key'
+    subprocess.run(['openssl', 'req', '-new', '-newkey', 'rsa:2048', '-days', '1', '-nodes', '-x509',
+                    '-keyout', str(keyfile), '-out', str(certfile), '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    return str(certfile), str(keyfile)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch, certificate):
+    """A server on a free port with in-memory storage and a fresh user database"""
+    from server import FileTransferServer
+    from storage_backend import MemoryBackend
+
+    # The server keeps users.db and server.log in the working directory
+    monkeypatch.chdir(tmp_path)
+    certfile, keyfile = certificate
+    server = FileTransferServer(port=0, storage_root=str(tmp_path / 'server_storage'), certfile=certfile,
+                                keyfile=keyfile, storage=MemoryBackend(), slow_log=str(tmp_path / 'slow.log'))
+    server.monitor_activities = False
+    Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    server.port = server.server_socket.getsockname()[1]
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    """A client logged in to the server as admin"""
+    from client import FileTransferClient
+
+    client = FileTransferClient(port=server.port, certfile=server.certfile)
+    assert client.connect('admin', 'admin123')
+    yield client
+    client.close()
@@ -0,0 +1,87 @@
+import gzip
+import io
+import os
+import zlib
+
+import pytest
+
+from compression import (
+    CODECS, MAX_DECODED_CHUNK, FrameReader, FrameWriter, available_codecs, gunzip_chunks
+)
+from protocol import ProtocolError
+
+
+class Channel:
+    """In-memory stand-in for a socket channel"""
+
+    def __init__(self, data=b''):
+        self.stream = io.BytesIO(data)
+
+    def sendall(self, data):
+        self.stream.write(data)
+
+    def recv_exact(self, size):
+        return self.stream.read(size)
+
+
+def framed(codec, data):
+    channel = Channel()
+    out = FrameWriter(channel, codec)
+    out.sendall(data)
+    out.close()
+    return Channel(channel.stream.getvalue())
+
+
+def read_all(reader, size=65536):
+    chunks = []
+    while True:
+        data = reader.recv(size)
+        if not data:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+@pytest.mark.parametrize('codec', available_codecs() + [None])
+def test_round_trip(codec):
+    data = os.urandom(1024) * 3000
+    reader = FrameReader(framed(codec, data), codec)
+    assert read_all(reader) == data
+    reader.finish()
+
+
+def test_expanding_frame_is_decoded_in_bounded_chunks():
+    # One small frame that decompresses to 64 chunks' worth of zeros
+    bomb = zlib.compress(bytes(64 * MAX_DECODED_CHUNK), 9)
+    reader = FrameReader(framed(None, bomb), 'zlib')
+    reader.recv(1)
+    assert len(reader._buffer) < MAX_DECODED_CHUNK
+    assert len(read_all(reader, 10 * MAX_DECODED_CHUNK)) == 64 * MAX_DECODED_CHUNK - 1
+
+
+def test_extra_data_is_rejected():
+    reader = FrameReader(framed('zlib', b'x' * 1000), 'zlib')
+    reader.recv(500)
+    with pytest.raises(ProtocolError):
+        reader.finish()
+
+
+def test_corrupt_frame_is_rejected():
+    channel = Channel()
+    out = FrameWriter(channel, None)
+    out.sendall(b'not compressed')
+    out.close()
+    with pytest.raises(ProtocolError):
+        FrameReader(Channel(channel.stream.getvalue()), 'zlib').recv(100)
+
+
+@pytest.mark.parametrize('start, end', [(0, None), (0, 10), (100000, 100001), (99999, 250000), (300000, None)])
+def test_gunzip_chunks_range(start, end):
+    data = bytes(range(256)) * 1200
+    stored = gzip.compress(data[:150000]) + gzip.compress(data[150000:])
+    chunks = [stored[i:i + 4096] for i in range(0, len(stored), 4096)]
+    assert b''.join(gunzip_chunks(chunks, start, end)) == data[start:end]
+
+
+def test_gzip_codec_reads_concatenated_members():
+    data = os.urandom(5000) * 10
+    assert b''.join(CODECS['gzip'][1]([gzip.compress(data), gzip.compress(data)])) == data * 2
@@ -0,0 +1,43 @@
+import io
+import random
+
+import pytest
+
+import dedup
+
+
+def chunk_sizes(data):
+    return [len(chunk) for chunk in dedup.iter_chunks(io.BytesIO(data))]
+
+
+def sample(seed, size):
+    return random.Random(seed).randbytes(size)
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'x', sample(1, 300_000), sample(2, 12_000_000), bytes(9_000_000),
+    sample(3, 1_000_000) + bytes(5_000_000) + sample(4, 3_000_000),
+])
+def test_chunks_cover_the_data_within_size_limits(data):
+    chunks = list(dedup.iter_chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert all(len(chunk) <= dedup.MAX_CHUNK_SIZE for chunk in chunks)
+    assert all(len(chunk) >= dedup.MIN_CHUNK_SIZE for chunk in chunks[:-1])
+
+
+@pytest.mark.skipif(dedup.numpy is None, reason='numpy is not installed')
+@pytest.mark.parametrize('seed', range(2))
+def test_numpy_and_python_chunkers_agree(seed, monkeypatch):
+    data = sample(seed, 5_000_000)
+    vectorised = chunk_sizes(data)
+    monkeypatch.setattr(dedup, 'numpy', None)
+    assert chunk_sizes(data) == vectorised
+
+
+def test_insertion_only_changes_nearby_chunks(tmp_path):
+    data = sample(5, 12_000_000)
+    (tmp_path / 'a').write_bytes(data)
+    (tmp_path / 'b').write_bytes(data[:6_000_000] + b'inserted' + data[6_000_000:])
+    before = {digest for digest, _, _ in dedup.chunk_file(tmp_path / 'a')}
+    after = [digest for digest, _, _ in dedup.chunk_file(tmp_path / 'b')]
+    assert len([digest for digest in after if digest not in before]) <= 2
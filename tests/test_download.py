@@ -0,0 +1,31 @@
+import pytest
+
+
+def request(client, **fields):
+    client._send_data(dict(fields, command='download'))
+    return client._receive_data()
+
+
+@pytest.fixture
+def stored(client, tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(bytes(range(256)) * 40)
+    assert client.upload_file(str(path))
+    return path.read_bytes()
+
+
+@pytest.mark.parametrize('fields', [
+    {'offset': '10'}, {'offset': 1.5}, {'offset': True}, {'offset': -1}, {'offset': [0]},
+    {'length': '10'}, {'length': 2.0}, {'length': False}, {'length': -5}, {'offset': 20000},
+])
+def test_malformed_range_is_rejected(client, stored, fields):
+    reply = request(client, filename='data.bin', **fields)
+    assert reply == {'status': 'failed', 'message': 'Invalid range'}
+    # The connection is still usable
+    assert client.list_entries(refresh=True)
+
+
+def test_range_download(client, stored):
+    reply = request(client, filename='data.bin', offset=100, length=50)
+    assert reply['status'] == 'success' and reply['size'] == 50 and reply['total_size'] == len(stored)
+    assert client.channel.recv_exact(50) == stored[100:150]
@@ -0,0 +1,27 @@
+import client as client_module
+
+
+def test_upload_in_parts(client, server, tmp_path):
+    path = tmp_path / 'big.bin'
+    path.write_bytes(bytes(range(256)) * 4096)
+    assert client.upload_file_multipart(str(path), connections=3, part_size=100_000)
+    assert server.storage.read_range('admin/big.bin', 0, path.stat().st_size) == path.read_bytes()
+
+
+def test_refused_part_connections_are_closed(client, tmp_path, monkeypatch):
+    workers = []
+    connect = client_module.FileTransferClient.connect
+
+    def refuse_attach(self, username, password=None, attach=False):
+        if not attach:
+            return connect(self, username, password, attach)
+        workers.append(self)
+        connect(self, username, password, attach)
+        return False
+
+    monkeypatch.setattr(client_module.FileTransferClient, 'connect', refuse_attach)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(b'x' * 300_000)
+    assert not client.upload_file_multipart(str(path), connections=3, part_size=100_000)
+    assert len(workers) == 3
+    assert all(worker.socket.fileno() == -1 for worker in workers)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import pytest
+
+import spool
+from storage_backend import MemoryBackend, StorageError
+
+
+class FlakyBackend(MemoryBackend):
+    """Memory backend whose writes fail until `available` is set"""
+
+    def __init__(self):
+        super().__init__()
+        self.available = False
+
+    def open_writer(self, name, content_encoding=None, decoded_size=None):
+        if not self.available:
+            raise StorageError('simulated outage')
+        return super().open_writer(name, content_encoding, decoded_size)
+
+
+def put(backend, name, data):
+    writer = backend.open_writer(name)
+    writer.write(data)
+    writer.close()
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def inner(monkeypatch):
+    monkeypatch.setattr(spool, 'RETRY_BASE_DELAY', 0.5)
+    monkeypatch.setattr(spool, 'RETRY_MAX_DELAY', 1)
+    return FlakyBackend()
+
+
+def test_failed_uploads_share_one_retry_thread(inner, tmp_path):
+    backend = spool.WriteBehindBackend(inner, tmp_path / 'spool', workers=2)
+    threads_before = threading.active_count()
+    backend.start()
+    for i in range(50):
+        put(backend, f'alice/{i}.txt', b'data %d' % i)
+    wait_for(lambda: backend.stats()['retrying'] == 50)
+    # Two uploaders and one retry scheduler, however many uploads are waiting
+    assert threading.active_count() <= threads_before + 3
+
+    inner.available = True
+    wait_for(lambda: backend.stats()['pending'] == 0)
+    assert inner.read_range('alice/7.txt', 0, 100) == b'data 7'
+    backend.stop()
+
+
+def test_stop_requeues_waiting_retries(inner, tmp_path):
+    backend = spool.WriteBehindBackend(inner, tmp_path / 'spool', workers=1)
+    backend.start()
+    put(backend, 'alice/a.txt', b'a')
+    wait_for(lambda: backend.stats()['retrying'] == 1)
+    backend.stop()
+    assert backend.stats()['retrying'] == 0
+
+    inner.available = True
+    backend.start()
+    wait_for(lambda: backend.stats()['pending'] == 0)
+    assert inner.read_range('alice/a.txt', 0, 10) == b'a'
+    backend.stop()
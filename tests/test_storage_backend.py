@@ -0,0 +1,55 @@
+import pytest
+
+from storage_backend import LocalBackend, ObjectNotFound, StorageError
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalBackend(tmp_path / 'objects')
+
+
+def put(backend, name, data):
+    writer = backend.open_writer(name)
+    writer.write(data)
+    writer.close()
+    return writer.info
+
+
+def test_round_trip(backend):
+    info = put(backend, 'alice/notes/todo.txt', b'hello')
+    assert info.name == 'alice/notes/todo.txt'
+    assert backend.read_range('alice/notes/todo.txt', 0, 5) == b'hello'
+    assert [item.name for item in backend.list('alice/')] == ['alice/notes/todo.txt']
+
+
+@pytest.mark.parametrize('name', [
+    'alice/../bob/secret.txt',
+    'alice/notes/../../bob/secret.txt',
+    'alice/./secret.txt',
+    'alice//secret.txt',
+    '/bob/secret.txt',
+    'alice/..\\bob\\secret.txt',
+    '.tmp/anything',
+])
+def test_names_cannot_leave_their_user_directory(backend, name):
+    put(backend, 'bob/secret.txt', b'bob only')
+    with pytest.raises(StorageError):
+        backend.read_range(name, 0, 100)
+    with pytest.raises(StorageError):
+        backend.open_writer(name)
+    with pytest.raises(StorageError):
+        backend.delete(name)
+    assert backend.read_range('bob/secret.txt', 0, 100) == b'bob only'
+
+
+def test_symlink_out_of_user_directory_is_rejected(backend):
+    put(backend, 'bob/secret.txt', b'bob only')
+    (backend.root / 'alice').mkdir()
+    (backend.root / 'alice' / 'link').symlink_to(backend.root / 'bob')
+    with pytest.raises(StorageError):
+        backend.read_range('alice/link/secret.txt', 0, 100)
+
+
+def test_missing_object(backend):
+    with pytest.raises(ObjectNotFound):
+        backend.stat('alice/missing.txt')
@@ -0,0 +1,48 @@
+import sync
+
+
+def test_push_uploads_empty_files_once(server, client, tmp_path):
+    tree = tmp_path / 'tree'
+    (tree / 'sub').mkdir(parents=True)
+    (tree / 'empty.txt').write_bytes(b'')
+    (tree / 'sub' / 'data.bin').write_bytes(b'x' * 1000)
+
+    stats = sync.push(client, tree, 'mirror', connections=2)
+    assert stats.failed == []
+    assert stats.total == 2
+    assert server.storage.stat('admin/mirror/empty.txt').size == 0
+
+    stats = sync.push(client, tree, 'mirror', connections=2)
+    assert stats.failed == []
+    assert stats.total == 0
+
+
+def test_pull_downloads_empty_files(server, client, tmp_path):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'empty.txt').write_bytes(b'')
+    assert sync.push(client, tree, 'mirror').failed == []
+
+    pulled = tmp_path / 'pulled'
+    stats = sync.pull(client, pulled, 'mirror')
+    assert stats.failed == []
+    assert (pulled / 'empty.txt').read_bytes() == b''
+
+
+def test_push_falls_back_to_the_login_connection(client, tmp_path, monkeypatch):
+    workers = []
+    connect = sync.FileTransferClient.connect
+
+    def refuse_attach(self, username, password=None, attach=False):
+        workers.append(self)
+        connect(self, username, password, attach)
+        return False
+
+    monkeypatch.setattr(sync.FileTransferClient, 'connect', refuse_attach)
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'a.txt').write_bytes(b'a')
+    (tree / 'b.txt').write_bytes(b'b')
+    stats = sync.push(client, tree, 'mirror')
+    assert stats.failed == [] and stats.done == 2
+    assert workers and all(worker.socket.fileno() == -1 for worker in workers)
@@ -0,0 +1,39 @@
+import time
+
+import pytest
+
+from tokens import SessionTokens
+
+SECRET = b's' * 32
+
+
+def test_issued_token_verifies():
+    tokens = SessionTokens(SECRET)
+    token, expires = tokens.issue('alice')
+    assert expires > time.time()
+    assert tokens.verify(token) == 'alice'
+
+
+def test_token_from_another_secret_is_rejected():
+    token, _ = SessionTokens(b'o' * 32).issue('alice')
+    assert SessionTokens(SECRET).verify(token) is None
+
+
+def test_expired_token_is_rejected():
+    token, _ = SessionTokens(SECRET, ttl=-1).issue('alice')
+    assert SessionTokens(SECRET).verify(token) is None
+
+
+@pytest.mark.parametrize('token', [
+    None, 42, '', 'no-dot', 'a.b.c', 'a.é', 'é.a', '\ud800.a', 'a.\x00', '.', 'e30.',
+])
+def test_malformed_token_is_rejected(token):
+    assert SessionTokens(SECRET).verify(token) is None
+
+
+def test_tampered_payload_is_rejected():
+    tokens = SessionTokens(SECRET)
+    token, _ = tokens.issue('alice')
+    signature = token.split('.')[1]
+    forged, _ = SessionTokens(b'x' * 32).issue('admin')
+    assert tokens.verify(f"{forged.split('.')[0]}.{signature}") is None
@@ -0,0 +1,80 @@
+"""
+Signed session tokens.
+
+After a password login the server hands out a token that names the user and an
+expiry time, signed with HMAC-SHA256 under a server secret. Presenting the
+token on later connections proves the password was checked recently, so the
+user database is not consulted. Tokens cannot be revoked before they expire;
+deleting a user or changing the secret file only takes effect for new logins
+or after the TTL.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+TOKEN_TTL = 60 * 60  # Seconds a session token stays valid
+SECRET_SIZE = 32  # Bytes of the signing key
+
+
+def load_secret(path):
+    """Read the signing key from `path`, creating it with a random key on first use.
+
+    Every process that reads the same file accepts the others' tokens.
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            secret = f.read()
+        if len(secret) < SECRET_SIZE:
+            raise ValueError(f"Session token secret in {path} is too short")
+        return secret
+    secret = os.urandom(SECRET_SIZE)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+class SessionTokens:
+    """Issues and verifies session tokens"""
+
+    def __init__(self, secret, ttl=TOKEN_TTL):
+        self.secret = secret
+        self.ttl = ttl
+
+    def issue(self, username):
+        """Return (token, expiry as a Unix time) for `username`"""
+        expires = int(time.time()) + self.ttl
+        payload = _encode(json.dumps({'user': username, 'exp': expires}, separators=(',', ':')).encode())
+        return f"{payload}.{self._sign(payload)}", expires
+
+    def verify(self, token):
+        """Return the username a valid, unexpired token was issued to, or None"""
+        # Valid tokens are base64url text; anything else cannot be signed or compared as bytes
+        if not isinstance(token, str) or not token.isascii() or token.count('.') != 1:
+            return None
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            claims = json.loads(_decode(payload))
+        except ValueError:
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get('exp'), int) or claims['exp'] < time.time():
+            return None
+        user = claims.get('user')
+        return user if isinstance(user, str) else None
+
+    def _sign(self, payload):
+        return _encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
@@ -0,0 +1,216 @@
+"""
+Per-request tracing, slow request log and sampled profiling.
+
+Every command gets an id and a Trace that adds up the time spent in each phase:
+auth, queue (waiting for a transfer slot), storage_meta, storage_data, socket
+and cache. Phases are recorded on the thread running the command; work handed
+to helper threads (parallel reads, upload writers) is attributed through
+Tracer.bind. Helper threads overlap the command's own socket I/O, so phases can
+add up to more than the total.
+
+Requests slower than the threshold are written as one JSON object per line to
+the slow log. A fraction of requests can also be run under cProfile, one at a
+time, with the stats saved next to the id in the slow log.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from threading import Lock, local
+
+SLOW_THRESHOLD = 1.0  # Seconds after which a request is written to the slow log
+PROFILE_TOP = 10  # Functions by cumulative time listed in the slow log for a profiled request
+
+
+class Trace:
+    """Phase timings of one request"""
+
+    def __init__(self, request_id, command, username, filename):
+        self.id = request_id
+        self.command = command
+        self.username = username
+        self.filename = filename
+        self.started = time.perf_counter()
+        self.status = None  # Status of the last reply sent
+        self.phases = {}  # phase -> [seconds, count]
+        self.calls = {}  # storage call name -> count
+        self._lock = Lock()
+
+    def add(self, phase, seconds, call=None):
+        with self._lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = [0.0, 0]
+            totals[0] += seconds
+            totals[1] += 1
+            if call:
+                self.calls[call] = self.calls.get(call, 0) + 1
+
+    def record(self, seconds):
+        with self._lock:
+            return {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'id': self.id,
+                'command': self.command,
+                'user': self.username,
+                'filename': self.filename,
+                'status': self.status,
+                'seconds': round(seconds, 6),
+                'phases': {phase: {'seconds': round(total, 6), 'count': n} for phase, (total, n) in self.phases.items()},
+                'storage_calls': dict(self.calls),
+            }
+
+
+class Tracer:
+    """Creates traces for requests and reports the slow and sampled ones"""
+
+    def __init__(self, slow_log='slow.log', slow_threshold=SLOW_THRESHOLD, profile_rate=0.0, profile_dir='profiles'):
+        self.slow_threshold = slow_threshold  # 0 disables the slow log
+        self.profile_rate = profile_rate  # Fraction of requests run under cProfile
+        self.profile_dir = Path(profile_dir)
+        self.slow_requests = 0
+        self.profiled_requests = 0
+        self._ids = count(1)
+        self._prefix = f"{os.getpid():x}"  # Keeps ids unique across pre-fork workers
+        self._local = local()
+        self._profiler_lock = Lock()  # cProfile cannot run on two threads at once
+        self.logger = logging.getLogger(f"dfs.slow.{slow_log}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if slow_log and not self.logger.handlers:
+            # Opened on the first slow request, so servers that have none leave no empty file
+            handler = logging.FileHandler(slow_log, delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+    @contextmanager
+    def request(self, command, username=None, filename=None):
+        """Trace the request run by the block on this thread; yields the Trace"""
+        trace = Trace(f"{self._prefix}-{next(self._ids):x}", command, username, filename)
+        previous = getattr(self._local, 'trace', None)
+        self._local.trace = trace
+        profiler = self._start_profiler()
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+            seconds = time.perf_counter() - trace.started
+            if profiler:
+                self._finish(trace, seconds, self._stop_profiler(profiler, trace))
+            elif self.slow_threshold and seconds >= self.slow_threshold:
+                self._finish(trace, seconds)
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    @contextmanager
+    def span(self, phase):
+        """Add the time the block takes to `phase` of the current request"""
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            trace.add(phase, time.perf_counter() - started)
+
+    def add(self, phase, seconds, call=None):
+        """Add time measured by the caller to `phase` of the current request, if any"""
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.add(phase, seconds, call)
+
+    def replied(self, data):
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.status = data.get('status')
+
+    def bind(self, func):
+        """Wrap func so calls made on other threads count towards the current request"""
+        trace = self.current()
+        if trace is None:
+            return func
+
+        def traced(*args, **kwargs):
+            previous = getattr(self._local, 'trace', None)
+            self._local.trace = trace
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.trace = previous
+        return traced
+
+    def bind_writer(self, writer):
+        """Storage writer whose write, close and abort calls count towards the current request"""
+        return _BoundWriter(writer, self) if self.current() else writer
+
+    def configure(self, **settings):
+        """Change settings at runtime; keys are slow_threshold and profile_rate"""
+        for key, value in settings.items():
+            if key not in ('slow_threshold', 'profile_rate'):
+                raise ValueError(f"Unknown setting: {key}")
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 \
+                    or (key == 'profile_rate' and value > 1):
+                raise ValueError(f"Invalid value for {key}")
+        for key, value in settings.items():
+            setattr(self, key, value)
+
+    def stats(self):
+        return {
+            'slow_threshold': self.slow_threshold,
+            'profile_rate': self.profile_rate,
+            'slow_requests': self.slow_requests,
+            'profiled_requests': self.profiled_requests,
+        }
+
+    def _start_profiler(self):
+        if not self.profile_rate or random.random() >= self.profile_rate:
+            return None
+        if not self._profiler_lock.acquire(blocking=False):
+            return None  # Another request is being profiled
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, profiler, trace):
+        """Stop a sampled request's profiler and save its stats; returns the slow log fields"""
+        profiler.disable()
+        self.profiled_requests += 1
+        self._profiler_lock.release()
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        path = self.profile_dir / f"{trace.id}.prof"
+        profiler.dump_stats(path)
+        profiler.create_stats()
+        top = sorted(profiler.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+        return {
+            'profile': str(path),
+            'profile_top': [{'function': f"{filename}:{line}({function})", 'calls': calls,
+                             'cumulative': round(cumulative, 6)}
+                            for (filename, line, function), (_, calls, _, cumulative, _) in top],
+        }
+
+    def _finish(self, trace, seconds, extra=None):
+        record = trace.record(seconds)
+        if extra:
+            record.update(extra)
+        if seconds >= self.slow_threshold > 0:
+            self.slow_requests += 1
+        self.logger.info(json.dumps(record, default=str))
+
+
+class _BoundWriter:
+    def __init__(self, writer, tracer):
+        self.writer = writer
+        self.write = tracer.bind(writer.write)
+        self.close = tracer.bind(writer.close)
+        self.abort = tracer.bind(writer.abort)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
@@ -0,0 +1,143 @@
+"""
+Streaming helpers for moving file data between client sockets and storage
+"""
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+
+SOCKET_CHUNK_SIZE = 256 * 1024          # Bytes read from the client socket per recv
+UPLOAD_QUEUE_DEPTH = 8                  # Socket chunks buffered ahead of the storage writer
+
+_END = object()
+_ABORT = object()
+
+
+def receive_to_writer(client_socket, size, writer, queue_depth=UPLOAD_QUEUE_DEPTH):
+    """Stream `size` bytes from the socket into a storage writer.
+
+    The socket is read on the calling thread while a background thread writes to
+    storage, connected by a bounded queue so memory per upload stays constant.
+    The writer is only closed (committing the object) when every byte arrived;
+    otherwise it is aborted. Returns (bytes_received, error) where error is None
+    on success.
+    """
+    chunks = queue.Queue(maxsize=queue_depth)
+    state = {'error': None}
+
+    def write_loop():
+        while True:
+            chunk = chunks.get()
+            if chunk is _ABORT or (chunk is _END and state['error']):
+                writer.abort()
+                return
+            if state['error']:
+                continue  # Keep draining so the socket reader never blocks on a dead writer
+            try:
+                if chunk is _END:
+                    writer.close()
+                    return
+                writer.write(chunk)
+            except Exception as e:
+                state['error'] = e
+                if chunk is _END:
+                    writer.abort()
+                    return
+
+    writer_thread = Thread(target=write_loop, daemon=True)
+    writer_thread.start()
+
+    received = 0
+    try:
+        while received < size:
+            chunk = client_socket.recv(min(SOCKET_CHUNK_SIZE, size - received))
+            if not chunk:
+                break
+            received += len(chunk)
+            chunks.put(chunk)
+    finally:
+        chunks.put(_END if received == size else _ABORT)
+        writer_thread.join()
+
+    return received, state['error']
+
+
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024   # Bytes fetched from storage per ranged read
+DOWNLOAD_READ_AHEAD = 2                 # Ranges fetched ahead of the socket writer
+
+
+def iter_ranges(read_range, start, end, chunk_size=DOWNLOAD_CHUNK_SIZE, read_ahead=DOWNLOAD_READ_AHEAD):
+    """Yield the bytes in [start, end) in order, one ranged read at a time.
+
+    `read_range(range_start, range_end)` returns the bytes of a half-open range.
+    Reads run on a background thread at most `read_ahead` ranges ahead of the
+    consumer. Errors raised by `read_range` are re-raised to the consumer.
+    """
+    if start >= end:
+        return
+    ranges = queue.Queue(maxsize=read_ahead)
+    stopped = Event()
+
+    def read_loop():
+        try:
+            for range_start in range(start, end, chunk_size):
+                if stopped.is_set():
+                    return
+                ranges.put(read_range(range_start, min(range_start + chunk_size, end)))
+        except Exception as e:
+            ranges.put(e)
+            return
+        ranges.put(_END)
+
+    reader_thread = Thread(target=read_loop, daemon=True)
+    reader_thread.start()
+    try:
+        while True:
+            data = ranges.get()
+            if data is _END:
+                return
+            if isinstance(data, Exception):
+                raise data
+            yield data
+    finally:
+        # Unblock the reader if the consumer stopped early
+        stopped.set()
+        while reader_thread.is_alive():
+            try:
+                ranges.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+DOWNLOAD_SLICE_SIZE = 8 * 1024 * 1024           # Bytes per concurrently fetched slice
+DOWNLOAD_PARALLELISM = 4                        # Slices fetched from storage at once
+SLICED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024    # Smaller ranges use a single read stream
+
+
+def iter_slices(read_range, start, end, slice_size=DOWNLOAD_SLICE_SIZE, parallelism=DOWNLOAD_PARALLELISM):
+    """Yield the bytes in [start, end) in order, fetching slices concurrently.
+
+    Up to `parallelism` slices are read at once and at most `2 * parallelism`
+    are held in the reorder window, so memory stays bounded by the window
+    size no matter how out of order the reads complete.
+    """
+    if start >= end:
+        return
+    slices = iter(range(start, end, slice_size))
+    window = deque()
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        def submit_next():
+            slice_start = next(slices, None)
+            if slice_start is not None:
+                window.append(pool.submit(read_range, slice_start, min(slice_start + slice_size, end)))
+
+        try:
+            for _ in range(2 * parallelism):
+                submit_next()
+            while window:
+                data = window.popleft().result()
+                submit_next()
+                yield data
+        finally:
+            for future in window:
+                future.cancel()